@@ -0,0 +1,49 @@
+# src/app.py
+
+import os
+import streamlit as st
+from PIL import Image, ImageDraw
+from inference_server import InferenceClient
+
+SERVER_URL = os.environ.get("INFERENCE_SERVER_URL", "http://127.0.0.1:8500")
+
+@st.cache_resource
+def get_client():
+    return InferenceClient(SERVER_URL)
+
+def draw_panels(image, panels):
+    image = image.convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for panel in panels:
+        draw.rectangle(panel["box"], outline=(255, 0, 0), width=3)
+        draw.text((panel["box"][0] + 4, panel["box"][1] + 2), f"{panel['index']} ({panel['score']:.2f})", fill=(255, 0, 0))
+    return image
+
+def main():
+    st.title("SODA figure panelization")
+    client = get_client()
+    try:
+        health = client.health()
+    except OSError as e:
+        st.error(f"The inference server at {SERVER_URL} is not reachable ({e}). Start it with `python src/inference_server.py`.")
+        return
+    st.caption(f"{health['backend']} serving {health['model']}")
+
+    conf = st.slider("Confidence threshold", 0.0, 1.0, 0.3, 0.05)
+    uploaded = st.file_uploader("Figure", type=["jpg", "jpeg", "png"])
+    if uploaded is None:
+        return
+
+    data = uploaded.getvalue()
+    result = client.detect(data, crops="png", conf=conf)
+    image = Image.open(uploaded)
+    st.image(draw_panels(image, result["panels"]), caption=f"{len(result['panels'])} panels")
+    timing = result["timing"]
+    st.caption(f"Queued {timing['queue_ms']} ms, inference {timing['inference_ms']} ms in a batch of {timing['batch_size']}")
+
+    columns = st.columns(4)
+    for panel in result["panels"]:
+        columns[panel["index"] % 4].image(panel["crop"], caption=f"Panel {panel['index']}")
+
+if __name__ == "__main__":
+    main()
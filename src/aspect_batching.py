@@ -0,0 +1,215 @@
+# src/aspect_batching.py
+
+import math
+import json
+import time
+import argparse
+from PIL import Image
+from detectors import load_detector
+from dataset_splits import split_images, image_size
+from instrumentation import stage, count
+
+def resized_size(width, height, imgsz):
+    """
+    Size of an image once its longest side is scaled to `imgsz`, as the YOLO loaders do.
+    """
+    ratio = imgsz / max(width, height)
+    return width * ratio, height * ratio
+
+def bucket_shape(width, height, imgsz, step=64, stride=32):
+    """
+    Rectangular `(height, width)` input shape of the aspect-ratio bucket of an image.
+
+    `imgsz` is first rounded up to a multiple of the stride, as ultralytics'
+    `check_imgsz` does, so that both sides are stride-aligned. The image is scaled so
+    that its longest side is `imgsz`; its short side is then rounded up to a multiple
+    of `step` (itself a multiple of the model stride), so that images of similar
+    aspect ratio share a shape and batches need little padding.
+    """
+    imgsz = math.ceil(imgsz / stride) * stride
+    step = max(stride, step // stride * stride)
+    resized_width, resized_height = resized_size(width, height, imgsz)
+    shape_width = min(imgsz, math.ceil(resized_width / step) * step)
+    shape_height = min(imgsz, math.ceil(resized_height / step) * step)
+    return shape_height, shape_width
+
+class AspectRatioBatcher:
+    """
+    Groups figures into aspect-ratio buckets and builds rectangular batches per bucket.
+
+    `plan` only needs the image sizes (read from the file headers); `run` loads each
+    batch when it is processed and returns the detections in the original order.
+    """
+
+    def __init__(self, imgsz=512, batch_size=16, step=64, stride=32):
+        self.imgsz = imgsz
+        self.batch_size = batch_size
+        self.step = step
+        self.stride = stride
+
+    def shape_for(self, width, height):
+        return bucket_shape(width, height, self.imgsz, self.step, self.stride)
+
+    def plan(self, sizes):
+        """
+        Split images into batches of the same bucket shape.
+
+        Args:
+            sizes (list): `(width, height)` of every image.
+
+        Returns:
+            list: `(shape, indices)` pairs, one per batch, where `indices` point into `sizes`.
+        """
+        buckets = {}
+        for index, (width, height) in enumerate(sizes):
+            buckets.setdefault(self.shape_for(width, height), []).append(index)
+
+        batches = []
+        for shape in sorted(buckets):
+            indices = buckets[shape]
+            for start in range(0, len(indices), self.batch_size):
+                batches.append((shape, indices[start:start + self.batch_size]))
+        return batches
+
+    def run(self, detector, image_paths):
+        """
+        Run a detector over images in bucketed batches.
+
+        Args:
+            detector: Any backend from `detectors` (its `detect` must accept a `shape`).
+            image_paths (list): Paths of the images.
+
+        Returns:
+            tuple: The detections in the order of `image_paths` and a dict with the
+            padding ratio, number of batches and images per second.
+        """
+        sizes = [image_size(path) for path in image_paths]
+        batches = self.plan(sizes)
+        detections = [None] * len(image_paths)
+
+        start = time.perf_counter()
+        for shape, indices in batches:
+            with stage("image_decode"):
+                images = [Image.open(image_paths[index]).convert("RGB") for index in indices]
+            with stage("detect_batch"):
+                predicted = detector.detect(images, shape=shape)
+            count("images_detected", len(indices))
+            for index, boxes in zip(indices, predicted):
+                detections[index] = boxes
+        elapsed = time.perf_counter() - start
+
+        stats = {
+            "mode": "bucketed",
+            "batches": len(batches),
+            "padding_ratio": padding_ratio(sizes, self.imgsz, batches),
+            "images_per_second": len(image_paths) / elapsed if elapsed > 0 else 0.0
+        }
+        return detections, stats
+
+def square_batches(sizes, imgsz, batch_size):
+    """
+    The fixed-size letterboxing of non-rect mode: every image padded to `imgsz` x `imgsz`.
+    """
+    indices = list(range(len(sizes)))
+    return [((imgsz, imgsz), indices[start:start + batch_size]) for start in range(0, len(indices), batch_size)]
+
+def rect_batches(sizes, imgsz, batch_size, stride=32, pad=0.5):
+    """
+    The batches of ultralytics' `rect=True` validation mode: images sorted by aspect
+    ratio, consecutive images batched together, with one shape per batch covering the
+    extreme aspect ratios of the batch.
+    """
+    order = sorted(range(len(sizes)), key=lambda index: sizes[index][1] / sizes[index][0])
+    batches = []
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        ratios = [sizes[index][1] / sizes[index][0] for index in indices]
+        low, high = min(ratios), max(ratios)
+        shape = [1.0, 1.0]
+        if high < 1:
+            shape = [high, 1.0]
+        elif low > 1:
+            shape = [1.0, 1.0 / low]
+        height = math.ceil(shape[0] * imgsz / stride + pad) * stride
+        width = math.ceil(shape[1] * imgsz / stride + pad) * stride
+        batches.append(((height, width), indices))
+    return batches
+
+def padding_ratio(sizes, imgsz, batches):
+    """
+    Fraction of the input pixels of all batches that are padding rather than image.
+    """
+    canvas = 0
+    content = 0
+    for (height, width), indices in batches:
+        for index in indices:
+            resized_width, resized_height = resized_size(*sizes[index], imgsz)
+            scale = min(1.0, width / resized_width, height / resized_height)
+            canvas += height * width
+            content += resized_width * scale * resized_height * scale
+    return 1 - content / canvas if canvas else 0.0
+
+def compare_modes(image_paths, imgsz, batch_size, step=64, detector=None):
+    """
+    Compare the padding (and, given a detector, the throughput) of square, rect and bucketed batching.
+
+    Returns:
+        list: One stats dict per mode.
+    """
+    sizes = [image_size(path) for path in image_paths]
+    batcher = AspectRatioBatcher(imgsz, batch_size, step)
+    modes = {
+        "square": square_batches(sizes, imgsz, batch_size),
+        "rect": rect_batches(sizes, imgsz, batch_size),
+        "bucketed": batcher.plan(sizes)
+    }
+
+    report = []
+    for mode, batches in modes.items():
+        stats = {"mode": mode, "batches": len(batches), "padding_ratio": padding_ratio(sizes, imgsz, batches)}
+        if detector is not None:
+            start = time.perf_counter()
+            for shape, indices in batches:
+                images = [Image.open(image_paths[index]).convert("RGB") for index in indices]
+                detector.detect(images, shape=None if mode == "square" else shape)
+            elapsed = time.perf_counter() - start
+            stats["images_per_second"] = len(image_paths) / elapsed if elapsed > 0 else 0.0
+        report.append(stats)
+    return report
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the batching comparison.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Compare padding and throughput of square, rect and aspect-ratio bucketed batching.")
+    parser.add_argument('--data', type=str, default="data/source_data.yml", help="Path to the data YAML file.")
+    parser.add_argument('--split', type=str, default="test", help="Dataset split to use.")
+    parser.add_argument('--imgsz', type=int, default=512, help="Image size for inference.")
+    parser.add_argument('--batch', type=int, default=16, help="Batch size.")
+    parser.add_argument('--step', type=int, default=64, help="Granularity of the bucket shapes in pixels.")
+    parser.add_argument('--model', type=str, default=None, help="Also time inference with this model (a .pt checkpoint or a dynamic ONNX/OpenVINO export).")
+    parser.add_argument('--model_version', type=int, default=10, help="YOLO model version to use (e.g., 8, 10).")
+    parser.add_argument('--device', type=str, default="cpu", help="Device to run the model on.")
+    parser.add_argument('--limit', type=int, default=None, help="Maximum number of images.")
+    parser.add_argument('--output', type=str, default=None, help="Write the comparison to this JSON file.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    image_paths = split_images(args.data, args.split)[:args.limit]
+    detector = load_detector(args.model, args.model_version, imgsz=args.imgsz, device=args.device) if args.model else None
+    report = compare_modes(image_paths, args.imgsz, args.batch, args.step, detector)
+
+    for stats in report:
+        throughput = f", {stats['images_per_second']:.2f} images/s" if "images_per_second" in stats else ""
+        print(f"{stats['mode']:>9}: {stats['batches']} batches, {stats['padding_ratio']:.1%} padding{throughput}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()
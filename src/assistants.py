@@ -1,31 +1,28 @@
+import math
 import openai
 from io import BytesIO
-import base64
-from PIL import Image
+from image_encoding import PanelEncoder, EncodedImage
+from rate_limiter import RateLimitScheduler
+from content_keys import prompt_version
+from instrumentation import stage, count, observe
 
-client = openai.OpenAI()
+# Retries are handled by `scheduler`, which also reads the rate-limit headers
+client = openai.OpenAI(max_retries=0)
+async_client = openai.AsyncOpenAI(max_retries=0)
 
-def map_panel_to_description(panel: BytesIO, caption: str) -> str:
-    """
-    Map a single panel to its description using AI.
+MODEL = "gpt-4o"
 
-    Parameters:
-        panel (BytesIO): The panel image.
-        caption (str): The figure caption.
+# Completion tokens budgeted per described panel when reserving tokens-per-minute
+COMPLETION_TOKENS_PER_PANEL = 300
 
-    Returns:
-        str: The description for the panel.
-    """
-    panel_image = Image.open(panel)
-    buffered = BytesIO()
-    panel_image.save(buffered, format="JPEG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+encoder = PanelEncoder()
 
-    response = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": """
+scheduler = RateLimitScheduler()
+
+# Running totals of the requests sent and the tokens reported in `response.usage`
+usage_totals = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+SYSTEM_PROMPT = """
                     You will receive a text with the caption of a scientific figure. 
                     This figure will be generally composed of several panels. 
                     Extract the relevant part of the figure caption so that it matches the panel given as an image file. 
@@ -41,23 +38,315 @@ def map_panel_to_description(panel: BytesIO, caption: str) -> str:
                     }
                     ```
                 """
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": f"{caption}"},
-                    {
-                        "type": "image_url", 
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{img_str}"
+
+FIGURE_SYSTEM_PROMPT = """
+                    You will receive a text with the caption of a scientific figure, followed by several images. 
+                    Each image is one panel cropped from that figure and is introduced by its position, e.g. 'Image 1:'. 
+                    For every image, extract the relevant part of the figure caption so that it matches that panel. 
+                    If a generic description of several panels is in place, return the generic and the specific descriptions for a given panel. 
+                    Make sure that the information in the panel caption you return is enough to interpret the panel. 
+                    For simplicity in post-processing begin each caption always with 'Panel X:' where X is the label of the panel in the figure.
+                    
+                    Output format: a JSON array with exactly one object per image, in the same order as the images.
+                    ```
+                    [
+                        {
+                            "panel_label": "X",
+                            "panel_caption": "Description of the panel."
                         }
-                    }
-                ]
-            }
-        ],
-        model="gpt-4o",
-        n=1,
-        temperature=0.5
-    )
+                    ]
+                    ```
+                """
+
+# Part of the description cache keys: changing the model or the prompts invalidates cached answers
+PROMPT_VERSION = prompt_version(MODEL, SYSTEM_PROMPT, FIGURE_SYSTEM_PROMPT)
+
+def record_usage(response):
+    usage_totals["requests"] += 1
+    count("llm_requests")
+    if response.usage is not None:
+        usage_totals["prompt_tokens"] += response.usage.prompt_tokens
+        usage_totals["completion_tokens"] += response.usage.completion_tokens
+        count("llm_prompt_tokens", response.usage.prompt_tokens)
+        count("llm_completion_tokens", response.usage.completion_tokens)
+        observe("llm_prompt_tokens_per_request", response.usage.prompt_tokens)
+        observe("llm_completion_tokens_per_request", response.usage.completion_tokens)
+
+def encode_panel(panel) -> EncodedImage:
+    """
+    Encode a panel for a prompt, timed and counted by the instrumentation.
+    """
+    with stage("encode"):
+        encoded = encoder.encode(panel)
+    count("image_payload_bytes", len(encoded.data))
+    observe("image_payload_bytes_per_panel", len(encoded.data))
+    return encoded
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    Rough token count of a text, using the usual four characters per token.
+    """
+    return math.ceil(len(text) / 4)
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Token cost of an image input, following OpenAI's tiling rules for gpt-4o.
+
+    Parameters:
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        detail (str): "low" or "high".
+
+    Returns:
+        int: The number of prompt tokens the image is billed for.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def configure_encoder(detail: str = "high", max_side: int = None, max_bytes: int = None, cache_dir: str = None) -> PanelEncoder:
+    """
+    Replace the encoder used for the panel images of every prompt.
+
+    Parameters:
+        detail (str): Detail level requested from the model ("low", "high" or "auto").
+        max_side (int): Maximum length of the longest side in pixels.
+        max_bytes (int): Maximum size of each JPEG payload in bytes.
+        cache_dir (str): Directory where encoded payloads are cached across runs.
+
+    Returns:
+        PanelEncoder: The new encoder.
+    """
+    global encoder
+    encoder = PanelEncoder(detail=detail, max_side=max_side, max_bytes=max_bytes, cache_dir=cache_dir)
+    return encoder
+
+def configure_scheduler(rpm: int = None, tpm: int = None, max_concurrency: int = 1, max_retries: int = 6, timeout: float = None) -> RateLimitScheduler:
+    """
+    Replace the scheduler every request goes through, and the request timeout of the clients.
+
+    Parameters:
+        rpm (int): Requests per minute, None to learn it from the rate-limit headers.
+        tpm (int): Tokens per minute, None to learn it from the rate-limit headers.
+        max_concurrency (int): Upper bound of the adaptive number of requests in flight.
+        max_retries (int): Retries of a rate-limited, timed-out or failed request.
+        timeout (float): Request timeout in seconds, None keeps the client default.
+
+    Returns:
+        RateLimitScheduler: The new scheduler.
+    """
+    global scheduler, client, async_client
+    scheduler = RateLimitScheduler(rpm=rpm, tpm=tpm, max_concurrency=max_concurrency, max_retries=max_retries)
+    if timeout is not None:
+        client = openai.OpenAI(max_retries=0, timeout=timeout)
+        async_client = openai.AsyncOpenAI(max_retries=0, timeout=timeout)
+    return scheduler
+
+def estimate_request_tokens(messages: list, images: list = ()) -> int:
+    """
+    Tokens a request counts against the tokens-per-minute limit: its prompt plus the
+    budgeted completion of every panel image in it.
+
+    Parameters:
+        messages (list): The messages for the chat completions endpoint.
+        images (list): The encoded images (EncodedImage) of the messages, whose
+            dimensions are known from encoding.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += estimate_text_tokens(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                tokens += estimate_text_tokens(part["text"])
+    for image in images:
+        tokens += estimate_image_tokens(image.width, image.height, image.detail)
+    return tokens + COMPLETION_TOKENS_PER_PANEL * max(len(images), 1)
+
+def request_body(messages: list) -> dict:
+    """
+    Parameters of a chat completion request, as sent by the client or written to a Batch API file.
+
+    Parameters:
+        messages (list): The messages for the chat completions endpoint.
+
+    Returns:
+        dict: The request body.
+    """
+    return {
+        "messages": messages,
+        "model": MODEL,
+        "n": 1,
+        "temperature": 0.5
+    }
+
+def create_completion(messages: list, images: list = ()) -> str:
+    """
+    Send a chat completion request through the scheduler.
+
+    Parameters:
+        messages (list): The messages for the chat completions endpoint.
+        images (list): The encoded images of the messages, to estimate the tokens of the request.
+
+    Returns:
+        str: The content of the answer.
+    """
+    with stage("llm_request"):
+        response = scheduler.call(
+            lambda: client.chat.completions.with_raw_response.create(**request_body(messages)),
+            estimate_request_tokens(messages, images)
+        )
+    record_usage(response)
+
+    return response.choices[0].message.content.strip()
+
+async def acreate_completion(messages: list, images: list = ()) -> str:
+    """
+    Asynchronous variant of `create_completion` built on `AsyncOpenAI`.
+
+    Parameters:
+        messages (list): The messages for the chat completions endpoint.
+        images (list): The encoded images of the messages, to estimate the tokens of the request.
+
+    Returns:
+        str: The content of the answer.
+    """
+    with stage("llm_request"):
+        response = await scheduler.acall(
+            lambda: async_client.chat.completions.with_raw_response.create(**request_body(messages)),
+            estimate_request_tokens(messages, images)
+        )
+    record_usage(response)
 
     return response.choices[0].message.content.strip()
+
+def panel_request(panel: BytesIO, caption: str) -> tuple:
+    """
+    Build the chat messages asking the model to describe a single panel.
+
+    Parameters:
+        panel (BytesIO): The panel image.
+        caption (str): The figure caption.
+
+    Returns:
+        tuple: The messages for the chat completions endpoint, and the list of their encoded images.
+    """
+    encoded = encode_panel(panel)
+    messages = [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": f"{caption}"},
+                encoded.to_content_part()
+            ]
+        }
+    ]
+    return messages, [encoded]
+
+def build_panel_messages(panel: BytesIO, caption: str) -> list:
+    """
+    The messages of `panel_request`, e.g. for a Batch API file.
+    """
+    return panel_request(panel, caption)[0]
+
+def map_panel_to_description(panel: BytesIO, caption: str) -> str:
+    """
+    Map a single panel to its description using AI.
+
+    Parameters:
+        panel (BytesIO): The panel image.
+        caption (str): The figure caption.
+
+    Returns:
+        str: The description for the panel.
+    """
+    return create_completion(*panel_request(panel, caption))
+
+async def amap_panel_to_description(panel: BytesIO, caption: str) -> str:
+    """
+    Asynchronous variant of `map_panel_to_description` built on `AsyncOpenAI`.
+
+    Parameters:
+        panel (BytesIO): The panel image.
+        caption (str): The figure caption.
+
+    Returns:
+        str: The description for the panel.
+    """
+    return await acreate_completion(*panel_request(panel, caption))
+
+def figure_request(panels: list, caption: str) -> tuple:
+    """
+    Build the chat messages asking the model to describe several panels of one figure at once.
+
+    Parameters:
+        panels (list): The panel images (BytesIO), in the order the answers are expected.
+        caption (str): The figure caption.
+
+    Returns:
+        tuple: The messages for the chat completions endpoint, and the list of their encoded images.
+    """
+    content = [{"type": "text", "text": f"{caption}"}]
+    images = []
+    for position, panel in enumerate(panels, start=1):
+        encoded = encode_panel(panel)
+        images.append(encoded)
+        content.append({"type": "text", "text": f"Image {position}:"})
+        content.append(encoded.to_content_part())
+
+    messages = [
+        {
+            "role": "system",
+            "content": FIGURE_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
+    return messages, images
+
+def build_figure_messages(panels: list, caption: str) -> list:
+    """
+    The messages of `figure_request`, e.g. for a Batch API file.
+    """
+    return figure_request(panels, caption)[0]
+
+def map_figure_to_descriptions(panels: list, caption: str) -> str:
+    """
+    Map all the panels of a figure to their descriptions with a single request.
+
+    Parameters:
+        panels (list): The panel images (BytesIO).
+        caption (str): The figure caption.
+
+    Returns:
+        str: A JSON array with one `{panel_label, panel_caption}` object per panel.
+    """
+    return create_completion(*figure_request(panels, caption))
+
+async def amap_figure_to_descriptions(panels: list, caption: str) -> str:
+    """
+    Asynchronous variant of `map_figure_to_descriptions` built on `AsyncOpenAI`.
+
+    Parameters:
+        panels (list): The panel images (BytesIO).
+        caption (str): The figure caption.
+
+    Returns:
+        str: A JSON array with one `{panel_label, panel_caption}` object per panel.
+    """
+    return await acreate_completion(*figure_request(panels, caption))
@@ -0,0 +1,132 @@
+# src/batch_requests.py
+
+import os
+import json
+import time
+from description_cache import JsonlDescriptionCache
+
+# Limits of a single OpenAI Batch API input file
+MAX_REQUESTS_PER_SHARD = 50000
+MAX_BYTES_PER_SHARD = 190 * 1024 * 1024
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+def batch_line(custom_id, body, url="/v1/chat/completions"):
+    """
+    One request of a Batch API input file.
+    """
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": url, "body": body}) + '\n'
+
+class BatchLedger:
+    """
+    Status of every custom_id written to a batch shard, kept in an append-only log.
+
+    Each entry records the panel filenames a request describes (and the cache keys
+    their answers are stored under), the shard it was written to and whether its
+    result is still pending, was ingested, or failed (in which case the panels are
+    written again by the next `write_batch`).
+    """
+
+    def __init__(self, path):
+        self._log = JsonlDescriptionCache(path, sync_every=1)
+
+    def get(self, custom_id):
+        value = self._log.get(custom_id)
+        return json.loads(value) if value is not None else None
+
+    def set(self, custom_id, filenames, status, shard, keys=None):
+        self._log.put(custom_id, json.dumps({"filenames": filenames, "keys": keys or filenames, "status": status, "shard": shard}))
+
+    def entries(self, status=None):
+        for custom_id, value in self._log.items():
+            entry = json.loads(value)
+            if status is None or entry["status"] == status:
+                yield custom_id, entry
+
+    def pending_filenames(self):
+        return {filename for _, entry in self.entries(PENDING) for filename in entry["filenames"]}
+
+    def close(self):
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class ShardWriter:
+    """
+    Writes batch lines to `batch_dir/<prefix>_<n>.jsonl` shards within the Batch API limits.
+
+    A shard is written under a `.tmp` name and renamed when it is complete; the
+    custom_ids it contains are then recorded as pending in the ledger.
+    """
+
+    def __init__(self, batch_dir, ledger, max_requests=MAX_REQUESTS_PER_SHARD, max_bytes=MAX_BYTES_PER_SHARD):
+        self.batch_dir = batch_dir
+        self.ledger = ledger
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.prefix = time.strftime("requests_%Y%m%d_%H%M%S")
+        self.shards = []
+        self._file = None
+        self._entries = []
+        self._bytes = 0
+        os.makedirs(batch_dir, exist_ok=True)
+
+    def _path(self):
+        return os.path.join(self.batch_dir, f"{self.prefix}_{len(self.shards):03d}.jsonl")
+
+    def write(self, custom_id, filenames, body, keys=None):
+        line = batch_line(custom_id, body).encode('utf-8')
+        if self._file is not None and (len(self._entries) >= self.max_requests or self._bytes + len(line) > self.max_bytes):
+            self._close_shard()
+        if self._file is None:
+            self._file = open(self._path() + '.tmp', 'wb')
+            self._entries = []
+            self._bytes = 0
+        self._file.write(line)
+        self._entries.append((custom_id, filenames, keys))
+        self._bytes += len(line)
+
+    def _close_shard(self):
+        path = self._path()
+        self._file.close()
+        os.replace(path + '.tmp', path)
+        shard = os.path.basename(path)
+        for custom_id, filenames, keys in self._entries:
+            self.ledger.set(custom_id, filenames, PENDING, shard, keys)
+        self.shards.append(path)
+        self._file = None
+
+    def close(self):
+        if self._file is not None:
+            self._close_shard()
+        return self.shards
+
+def iter_batch_results(results_file):
+    """
+    Yield `(custom_id, content, error)` for every line of a Batch API output or error file.
+
+    `content` is the stripped answer of a successful request and None otherwise, in
+    which case `error` describes what went wrong.
+    """
+    with open(results_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                error = record.get("error") or (response.get("body") or {}).get("error") or f"status {response.get('status_code')}"
+                yield record["custom_id"], None, error
+                continue
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                yield record["custom_id"], None, "response without a completion"
+                continue
+            yield record["custom_id"], (content or "").strip(), None
@@ -0,0 +1,153 @@
+# src/benchmark_cpu_inference.py
+
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from detectors import load_detector
+from dataset_splits import split_images
+from detection_metrics import load_ground_truth, sweep
+
+def measure_latency(detector, images, warmup):
+    """
+    Time single-image inference.
+
+    Returns:
+        dict: Median, 95th percentile and mean latency in milliseconds.
+    """
+    for image in images[:warmup]:
+        detector.detect([image])
+
+    latencies = []
+    for image in images:
+        start = time.perf_counter()
+        detector.detect([image])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p95_ms": float(np.percentile(latencies, 95)),
+        "latency_mean_ms": float(np.mean(latencies))
+    }
+
+def measure_throughput(detector, images, batch_size):
+    """
+    Time batched inference over all the images.
+
+    Returns:
+        dict: Images per second.
+    """
+    start = time.perf_counter()
+    for offset in range(0, len(images), batch_size):
+        detector.detect(images[offset:offset + batch_size])
+    elapsed = time.perf_counter() - start
+    return {"images_per_second": len(images) / elapsed if elapsed > 0 else 0.0}
+
+def measure_map(detector, images, ground_truth, batch_size):
+    """
+    Score the detections of the benchmarked backend itself, with the confidence and
+    NMS thresholds it was timed with, against the labels of the same images.
+
+    Returns:
+        dict: mAP@0.5, mAP@0.5:0.95, and precision and recall at IoU 0.5.
+    """
+    predictions = []
+    for offset in range(0, len(images), batch_size):
+        predictions.extend(detections.astype(np.float64) for detections in detector.detect(images[offset:offset + batch_size]))
+    results = sweep(predictions, ground_truth, [detector.conf], [0.5], detector.max_det)
+    return {
+        "map50": results["map50"],
+        "map50_95": results["map50_95"],
+        "precision50": float(results["precision"][0, 0]),
+        "recall50": float(results["recall"][0, 0])
+    }
+
+def benchmark_models(model_paths, data_yaml, split, img_size, batch_size, threads, limit, warmup, model_version, skip_map):
+    """
+    Compare latency, throughput and mAP of several detector backends on the same images of a split.
+
+    Args:
+        model_paths (list): `.pt` checkpoints and their `.onnx`/OpenVINO exports.
+        data_yaml (str): Path to the data YAML file.
+        split (str): Dataset split to benchmark on.
+        img_size (int): Inference size.
+        batch_size (int): Batch size for the throughput and mAP runs.
+        threads (int): Intra-op threads for every backend.
+        limit (int): Number of split images used for latency, throughput and mAP.
+        warmup (int): Untimed warm-up images per backend.
+        model_version (int): YOLO model version (e.g., 8, 10).
+        skip_map (bool): Skip the mAP runs.
+
+    Returns:
+        list: One result dict per model.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    image_paths = split_images(data_yaml, split)[:limit]
+    images = [Image.open(path).convert("RGB") for path in image_paths]
+    ground_truth = None if skip_map else load_ground_truth(image_paths)
+
+    results = []
+    for model_path in model_paths:
+        detector = load_detector(model_path, model_version, imgsz=img_size, device="cpu", intra_op_threads=threads)
+        result = {"model": model_path, "threads": threads, "images": len(images)}
+        result.update(measure_latency(detector, images, warmup))
+        result.update(measure_throughput(detector, images, batch_size))
+        if not skip_map:
+            result.update(measure_map(detector, images, ground_truth, batch_size))
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+def print_report(results):
+    baseline = results[0]
+    print(f"{'model':<60} {'p50 ms':>8} {'p95 ms':>8} {'img/s':>8} {'speedup':>8} {'mAP50':>7} {'mAP50-95':>9}")
+    for result in results:
+        speedup = result["images_per_second"] / baseline["images_per_second"] if baseline["images_per_second"] else 0.0
+        print(f"{result['model']:<60} {result['latency_p50_ms']:>8.1f} {result['latency_p95_ms']:>8.1f} "
+              f"{result['images_per_second']:>8.2f} {speedup:>7.2f}x "
+              f"{result.get('map50', float('nan')):>7.3f} {result.get('map50_95', float('nan')):>9.3f}")
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the CPU inference benchmark.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Compare PyTorch, ONNX Runtime and OpenVINO detectors on CPU.")
+    parser.add_argument('--models', type=str, nargs='+', required=True, help="Model files to compare; the first one is the baseline.")
+    parser.add_argument('--data', type=str, default="data/source_data.yml", help="Path to the data YAML file.")
+    parser.add_argument('--split', type=str, default="test", help="Dataset split to benchmark on.")
+    parser.add_argument('--imgsz', type=int, default=512, help="Image size for inference.")
+    parser.add_argument('--batch', type=int, default=8, help="Batch size for the throughput and mAP runs.")
+    parser.add_argument('--threads', type=int, default=0, help="Intra-op threads (0 lets each runtime decide).")
+    parser.add_argument('--limit', type=int, default=200, help="Number of images used for latency, throughput and mAP.")
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed warm-up images per model.")
+    parser.add_argument('--model_version', type=int, default=10, help="YOLO model version to use (e.g., 8, 10).")
+    parser.add_argument('--skip_map', action='store_true', help="Only measure latency and throughput.")
+    parser.add_argument('--output', type=str, default="runs/cpu_inference_report.json", help="Path to the JSON report.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    results = benchmark_models(
+        model_paths=args.models,
+        data_yaml=args.data,
+        split=args.split,
+        img_size=args.imgsz,
+        batch_size=args.batch,
+        threads=args.threads,
+        limit=args.limit,
+        warmup=args.warmup,
+        model_version=args.model_version,
+        skip_map=args.skip_map
+    )
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print_report(results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+# src/benchmark_suite.py
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import xml.etree.ElementTree as ET
+import zipfile
+from PIL import Image, ImageDraw, ImageFont, __version__ as pillow_version
+import instrumentation
+from detectors import crop_panels
+from image_encoding import PanelEncoder
+from description_cache import open_cache
+from extract_figure_captions import extract_captions
+from convert_imageclef_annotations import convert_annotations
+from stub_openai_server import start_stub_server
+
+STAGES = ("captions", "annotations", "crop_encode", "cache", "matching")
+
+WORDS = ("cells", "were", "treated", "with", "the", "indicated", "antibody", "and", "imaged", "after", "hours",
+         "quantification", "of", "signal", "in", "control", "mutant", "mice", "scale", "bar", "shows", "mean",
+         "protein", "levels", "measured", "by", "western", "blot", "expression", "tissue", "sections")
+
+def sentence(rng, words=12):
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+def panel_layout(rng, width, height, max_panels, gutter=12):
+    """
+    Boxes of a compound figure: rows of panels with random heights, each split into
+    columns of random widths, in reading order.
+    """
+    rows = rng.randint(1, max(1, min(3, max_panels)))
+    per_row = [1] * rows
+    for _ in range(rng.randint(rows, max_panels) - rows):
+        per_row[rng.randrange(rows)] += 1
+    weights = [rng.uniform(0.6, 1.4) for _ in range(rows)]
+    boxes = []
+    y = gutter
+    for row, columns in enumerate(per_row):
+        row_height = int((height - gutter * (rows + 1)) * weights[row] / sum(weights))
+        column_weights = [rng.uniform(0.6, 1.4) for _ in range(columns)]
+        x = gutter
+        for column in range(columns):
+            column_width = int((width - gutter * (columns + 1)) * column_weights[column] / sum(column_weights))
+            boxes.append((x, y, x + column_width, y + row_height))
+            x += column_width + gutter
+        y += row_height + gutter
+    return boxes
+
+def draw_panel(rng, draw, box, label, font):
+    """
+    Fill a panel with a plot-like drawing (bars, a line chart or blobs) and print its label in the top-left corner.
+    """
+    x1, y1, x2, y2 = box
+    draw.rectangle(box, outline=(60, 60, 60), width=2)
+    inner = (x1 + 40, y1 + 40, x2 - 12, y2 - 12)
+    kind = rng.choice(("bars", "line", "blobs"))
+    if inner[2] - inner[0] > 20 and inner[3] - inner[1] > 20:
+        if kind == "bars":
+            bars = rng.randint(3, 8)
+            bar_width = (inner[2] - inner[0]) / bars
+            for bar in range(bars):
+                top = rng.uniform(inner[1], inner[3] - 5)
+                colour = tuple(rng.randint(30, 220) for _ in range(3))
+                draw.rectangle((inner[0] + bar * bar_width + 2, top, inner[0] + (bar + 1) * bar_width - 2, inner[3]), fill=colour)
+        elif kind == "line":
+            points = [(inner[0] + (inner[2] - inner[0]) * step / 9, rng.uniform(inner[1], inner[3])) for step in range(10)]
+            draw.line(points, fill=tuple(rng.randint(0, 200) for _ in range(3)), width=3)
+            draw.line((inner[0], inner[3], inner[2], inner[3]), fill=(0, 0, 0), width=2)
+            draw.line((inner[0], inner[1], inner[0], inner[3]), fill=(0, 0, 0), width=2)
+        else:
+            for _ in range(rng.randint(5, 25)):
+                cx, cy = rng.uniform(inner[0], inner[2]), rng.uniform(inner[1], inner[3])
+                radius = rng.uniform(3, 20)
+                draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+    draw.text((x1 + 8, y1 + 6), label, fill=(0, 0, 0), font=font)
+
+def figure_caption(rng, labels):
+    """
+    HTML caption in the SourceData style: a title, a shared preamble and one "(X)" segment per panel.
+    """
+    parts = [f"<b>{sentence(rng, 6)}</b> {sentence(rng)}"]
+    for label in labels:
+        parts.append(f"<b>({label})</b> {sentence(rng, rng.randint(8, 30))}")
+    return '<p>' + ' '.join(parts) + '</p>'
+
+def generate_dataset(root, figures=200, seed=0, max_panels=8, size=(1600, 1200)):
+    """
+    Write synthetic compound figures with known panel layouts, labels and captions.
+
+    Args:
+        root (str): Output directory.
+        figures (int): Number of figures.
+        seed (int): Random seed; the same seed writes the same dataset.
+        max_panels (int): Largest number of panels per figure.
+        size (tuple): Largest figure `(width, height)`; every figure is scaled down randomly from it.
+
+    Returns:
+        dict: Paths of the figures (`figures/<id>.jpg`), the panel crops
+        (`segmented/<id>_<label>.png`), the SourceData-style `annotated_data.json`,
+        the ImageCLEF-style zip and XML, and the `layouts.json` of panel boxes.
+    """
+    rng = random.Random(seed)
+    paths = {
+        "figures": os.path.join(root, "figures"),
+        "segmented": os.path.join(root, "segmented"),
+        "annotated": os.path.join(root, "annotated_data.json"),
+        "zip": os.path.join(root, "imageclef.zip"),
+        "xml": os.path.join(root, "imageclef.xml"),
+        "layouts": os.path.join(root, "layouts.json")
+    }
+    os.makedirs(paths["figures"], exist_ok=True)
+    os.makedirs(paths["segmented"], exist_ok=True)
+
+    layouts = {}
+    items = []
+    annotations = ET.Element("annotations")
+    with zipfile.ZipFile(paths["zip"], 'w', zipfile.ZIP_STORED) as archive:
+        for index in range(figures):
+            figure_id = f"synthetic-{seed}-{index:05d}"
+            scale = rng.uniform(0.5, 1.0)
+            width, height = int(size[0] * scale), int(size[1] * scale)
+            boxes = panel_layout(rng, width, height, max_panels)
+            labels = [chr(ord('A') + position) for position in range(len(boxes))]
+            font = ImageFont.load_default(rng.randint(20, 36))
+
+            figure = Image.new("RGB", (width, height), (255, 255, 255))
+            draw = ImageDraw.Draw(figure)
+            for box, label in zip(boxes, labels):
+                draw_panel(rng, draw, box, label, font)
+            figure_path = os.path.join(paths["figures"], f"{figure_id}.jpg")
+            figure.save(figure_path, quality=90)
+            archive.write(figure_path, f"images/{figure_id}.jpg")
+            for box, label in zip(boxes, labels):
+                figure.crop(box).save(os.path.join(paths["segmented"], f"{figure_id}_{label}.png"))
+
+            layouts[figure_id] = {"size": [width, height], "boxes": [list(box) for box in boxes], "labels": labels}
+            items.append({"data": {"figure_id": figure_id, "caption": figure_caption(rng, labels)}})
+            annotation = ET.SubElement(annotations, "annotation")
+            ET.SubElement(annotation, "filename").text = figure_id
+            for x1, y1, x2, y2 in boxes:
+                element = ET.SubElement(annotation, "object")
+                for x, y in ((x1, y1), (x2, y1), (x2, y2), (x1, y2)):
+                    ET.SubElement(element, "point", x=str(x), y=str(y))
+
+    with open(paths["annotated"], 'w') as f:
+        json.dump(items, f)
+    ET.ElementTree(annotations).write(paths["xml"])
+    with open(paths["layouts"], 'w') as f:
+        json.dump(layouts, f)
+    return paths
+
+def throughput(items, seconds, unit):
+    return {"items": items, "seconds": round(seconds, 4), "throughput": round(items / seconds, 2) if seconds > 0 else None, "unit": unit}
+
+def bench_captions(paths, work_dir, workers):
+    output = os.path.join(work_dir, "figure_captions.jsonl")
+    start = time.perf_counter()
+    written = extract_captions(paths["annotated"], output, workers=workers)
+    return throughput(written, time.perf_counter() - start, "figures/s")
+
+def bench_annotations(paths, work_dir, workers):
+    output = os.path.join(work_dir, "imageclef")
+    start = time.perf_counter()
+    converted = convert_annotations(paths["xml"], paths["zip"], output, workers=workers, force=True)
+    return throughput(converted, time.perf_counter() - start, "figures/s")
+
+def bench_crop_encode(paths, detail="high"):
+    """
+    Crop the panels of every figure in memory from their known boxes and encode them for upload.
+    """
+    with open(paths["layouts"], 'r') as f:
+        layouts = json.load(f)
+    encoder = PanelEncoder(detail=detail)
+    panels = 0
+    payload_bytes = 0
+    crop_seconds = 0.0
+    start = time.perf_counter()
+    for figure_id, layout in layouts.items():
+        crop_start = time.perf_counter()
+        with Image.open(os.path.join(paths["figures"], f"{figure_id}.jpg")) as figure:
+            figure = figure.convert("RGB")
+            detections = np.array([box + [1.0] for box in layout["boxes"]], dtype=np.float32)
+            crops = crop_panels(figure, detections)
+        crop_seconds += time.perf_counter() - crop_start
+        for _, _, crop in crops:
+            payload_bytes += len(encoder.encode(crop).data)
+            panels += 1
+    report = throughput(panels, time.perf_counter() - start, "panels/s")
+    report.update(crop_seconds=round(crop_seconds, 4), mean_payload_bytes=round(payload_bytes / max(panels, 1)))
+    return report
+
+def bench_cache(work_dir, entries=20000, seed=0):
+    """
+    Write, read back and reopen (replay) `entries` descriptions with every cache backend.
+    """
+    rng = random.Random(seed)
+    keys = [f"content:bench:{rng.getrandbits(64):016x}:{rng.getrandbits(256):064x}" for _ in range(entries)]
+    value = json.dumps({"panel_label": "A", "panel_caption": "Panel A: " + sentence(rng, 40)})
+    report = {}
+    for suffix in ("jsonl", "sqlite"):
+        path = os.path.join(work_dir, f"bench_cache.{suffix}")
+        start = time.perf_counter()
+        with open_cache(path) as cache:
+            for key in keys:
+                cache.put(key, value)
+        write_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        with open_cache(path) as cache:
+            reopen_seconds = time.perf_counter() - start
+            lookups = rng.sample(keys, min(len(keys), 5000))
+            start = time.perf_counter()
+            found = sum(cache.get(key) is not None for key in lookups)
+            read_seconds = time.perf_counter() - start
+        report[suffix] = {
+            "writes_per_second": round(entries / write_seconds, 1),
+            "reads_per_second": round(len(lookups) / read_seconds, 1),
+            "reopen_seconds": round(reopen_seconds, 4),
+            "found": found
+        }
+    report["throughput"] = report["jsonl"]["writes_per_second"]
+    report["unit"] = "jsonl writes/s"
+    return report
+
+def bench_matching(paths, work_dir, workers, concurrency=16, latency=0.05, jitter=0.0, error_rate=0.0, local_labels=False):
+    """
+    Run the label matching evaluation against the local stub of the chat-completions
+    endpoint, once with a cold and once with a warm description cache.
+    """
+    captions_file = os.path.join(work_dir, "figure_captions.jsonl")
+    if not os.path.exists(captions_file):
+        extract_captions(paths["annotated"], captions_file, workers=workers)
+
+    server = start_stub_server(latency=latency, jitter=jitter, error_rate=error_rate, retry_after=0.05)
+    # The clients read the endpoint when `assistants` is imported, so point them at the stub first
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["OPENAI_API_KEY"] = "stub"
+    import assistants
+    import panel_label_matching
+    from label_recognizer import LabelRecognizer, DEFAULT_CONFIDENCE
+    assistants.client = assistants.openai.OpenAI(max_retries=0, base_url=server.base_url, api_key="stub")
+    assistants.async_client = assistants.openai.AsyncOpenAI(max_retries=0, base_url=server.base_url, api_key="stub")
+    assistants.configure_encoder()
+    recognizer = LabelRecognizer() if local_labels else None
+
+    report = {"latency": latency, "error_rate": error_rate, "concurrency": concurrency, "local_labels": local_labels}
+    cache_file = os.path.join(work_dir, "matching_cache.jsonl")
+    try:
+        for run in ("cold", "warm"):
+            scheduler = assistants.configure_scheduler(max_concurrency=concurrency, max_retries=8)
+            requests_before = server.request_count
+            rate_limited_before = server.rate_limited_count
+            metrics = instrumentation.configure_metrics()
+            start = time.perf_counter()
+            result = panel_label_matching.evaluate_accuracy(
+                paths["segmented"], captions_file, paths["figures"], os.path.join(work_dir, "failures"), cache_file,
+                concurrency=concurrency, recognizer=recognizer, label_confidence=DEFAULT_CONFIDENCE if local_labels else None,
+                shard_dir=os.path.join(work_dir, f"shards_{run}"), force=True
+            )
+            elapsed = time.perf_counter() - start
+            summary = metrics.summary()
+            instrumentation.configure_metrics(False)
+
+            requests = server.request_count - requests_before
+            errors = server.rate_limited_count - rate_limited_before
+            report[run] = throughput(result["counts"]["panels"], elapsed, "panels/s")
+            report[run].update(
+                requests=requests,
+                injected_errors=errors,
+                error_rate=round(errors / requests, 4) if requests else 0.0,
+                retries=scheduler.stats["retries"],
+                failures=scheduler.stats["failures"],
+                described=result["counts"]["total"],
+                llm_request_seconds=summary["histograms"].get("llm_request_seconds", {"count": 0}),
+                stage_seconds={name[:-len("_seconds")]: histogram["sum"] for name, histogram in summary["histograms"].items()
+                        if name.endswith("_seconds") and histogram["count"]}
+            )
+    finally:
+        server.shutdown()
+    report["throughput"] = report["cold"]["throughput"]
+    report["unit"] = "panels/s"
+    return report
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": pillow_version,
+        "commit": commit
+    }
+
+def compare(report, baseline):
+    """
+    Throughput of every stage relative to a previous report (above 1 is faster).
+    """
+    ratios = {}
+    for stage, result in report["stages"].items():
+        previous = baseline.get("stages", {}).get(stage, {})
+        if result.get("throughput") and previous.get("throughput"):
+            ratios[stage] = round(result["throughput"] / previous["throughput"], 3)
+    return ratios
+
+def run_suite(work_dir, stages=STAGES, figures=200, seed=0, max_panels=8, workers=None, concurrency=16,
+              latency=0.05, jitter=0.0, error_rate=0.0, local_labels=False, cache_entries=20000):
+    """
+    Generate the synthetic dataset in `work_dir` and benchmark the selected stages on it.
+
+    Returns:
+        dict: The configuration, the environment and one result per stage.
+    """
+    workers = workers or os.cpu_count()
+    config = {"figures": figures, "seed": seed, "max_panels": max_panels, "workers": workers, "concurrency": concurrency,
+              "latency": latency, "jitter": jitter, "error_rate": error_rate, "local_labels": local_labels, "cache_entries": cache_entries}
+    start = time.perf_counter()
+    paths = generate_dataset(os.path.join(work_dir, "dataset"), figures, seed, max_panels)
+    generation_seconds = time.perf_counter() - start
+    panels = len(os.listdir(paths["segmented"]))
+    print(f"Generated {figures} figures with {panels} panels in {generation_seconds:.1f}s")
+
+    results = {}
+    for stage in stages:
+        print(f"Running the {stage} benchmark...")
+        if stage == "captions":
+            results[stage] = bench_captions(paths, work_dir, workers)
+        elif stage == "annotations":
+            results[stage] = bench_annotations(paths, work_dir, workers)
+        elif stage == "crop_encode":
+            results[stage] = bench_crop_encode(paths)
+        elif stage == "cache":
+            results[stage] = bench_cache(work_dir, cache_entries, seed)
+        elif stage == "matching":
+            results[stage] = bench_matching(paths, work_dir, workers, concurrency, latency, jitter, error_rate, local_labels)
+        print(f"  {stage}: {results[stage]['throughput']} {results[stage]['unit']}")
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+        "environment": environment(),
+        "dataset": {"figures": figures, "panels": panels, "generation_seconds": round(generation_seconds, 3)},
+        "stages": results
+    }
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the benchmark suite.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the caption, annotation, encoding, cache and matching stages on synthetic figures, offline and on the CPU.")
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help="Where to write the JSON report.")
+    parser.add_argument('--baseline', type=str, default=None, help="Previous report to compare the throughput of every stage with.")
+    parser.add_argument('--stages', type=str, nargs='+', default=list(STAGES), choices=STAGES, help="Stages to benchmark.")
+    parser.add_argument('--figures', type=int, default=200, help="Number of synthetic figures.")
+    parser.add_argument('--max_panels', type=int, default=8, help="Largest number of panels per figure.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the synthetic dataset.")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes of the caption and annotation stages (defaults to the number of CPUs).")
+    parser.add_argument('--concurrency', type=int, default=16, help="LLM requests kept in flight by the matching stage.")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds the stub LLM server waits before answering.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra uniformly distributed stub latency in seconds.")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="Fraction of the stub answers that are 429s.")
+    parser.add_argument('--local_labels', action='store_true', help="Recognise the panel labels locally in the matching stage.")
+    parser.add_argument('--cache_entries', type=int, default=20000, help="Entries written to each description cache backend.")
+    parser.add_argument('--work_dir', type=str, default=None, help="Keep the dataset and outputs in this directory instead of a temporary one.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="soda_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        report = run_suite(work_dir, args.stages, args.figures, args.seed, args.max_panels, args.workers, args.concurrency,
+                           args.latency, args.jitter, args.error_rate, args.local_labels, args.cache_entries)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report["relative_to_baseline"] = compare(report, json.load(f))
+        for stage, ratio in report["relative_to_baseline"].items():
+            print(f"{stage}: {ratio:.2f}x the baseline throughput")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote the benchmark report to {args.output}")
+
+if __name__ == "__main__":
+    main()
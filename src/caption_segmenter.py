@@ -0,0 +1,215 @@
+# src/caption_segmenter.py
+
+import re
+import math
+import json
+import argparse
+from tqdm import tqdm
+
+# Bump when the segmentation rules change, so stored boundaries are recomputed
+SEGMENTER_VERSION = 2
+
+RANGE = r'\s*(?:[-‐-―−]|to)\s*'
+ITEM = rf'[A-Za-z](?:{RANGE}[A-Za-z])?'
+SEPARATOR = r'\s*(?:,|;|&|and)\s*|\s+'
+LABEL_LIST = rf'{ITEM}(?:(?:{SEPARATOR}){ITEM})*'
+
+# "(A)", "(A, B)", "(A-C)", "(a and b)"; "A)" or "a," at the start of a sentence
+MARKER = re.compile(
+    rf'(?<![A-Za-z])\((?P<parenthesised>{LABEL_LIST})\)'
+    rf'|(?:^|(?<=[.;]\s))(?P<closing>{LABEL_LIST})\)'
+    rf'|(?:^|(?<=[.;]\s))(?P<lowercase>[a-z](?:{RANGE}[a-z])?(?:(?:,\s*|\s+and\s+)[a-z](?:{RANGE}[a-z])?)*),\s'
+)
+LABEL_ITEM = re.compile(rf'([A-Za-z])(?:{RANGE}([A-Za-z]))?')
+CONNECTORS = re.compile(r'\band\b|\bto\b|&')
+# Text left between two markers that does not describe anything, e.g. "(A) and (B)"
+EMPTY_SEGMENT = re.compile(r'^[\s,;&.:]*(?:and[\s,;&.:]*)?$')
+# End of the text before a marker that starts a sentence, or only a clause
+SENTENCE_END = re.compile(r'[.!?]$')
+CLAUSE_END = re.compile(r'[,;:]$')
+# Connectors between the markers of a group, e.g. "(A) and (B)", "(A) & (B)"
+JOINER = re.compile(r'(?:\s|&|\band)*$')
+
+def parse_labels(text):
+    """
+    Upper-case labels of a marker such as "A, B", "a-c" or "A to C and E", in order.
+    """
+    labels = []
+    for match in LABEL_ITEM.finditer(CONNECTORS.sub(lambda m: '-' if m.group(0) == 'to' else ',', text)):
+        first = match.group(1).upper()
+        last = (match.group(2) or match.group(1)).upper()
+        for code in range(ord(first), max(ord(first), ord(last)) + 1):
+            if chr(code) not in labels:
+                labels.append(chr(code))
+    return labels
+
+def marker_boundary(caption, start, previous_end):
+    """
+    Whether a marker at `start` opens a sentence ("sentence"), a clause ("clause"), or
+    sits inside running text (None), like the reference in "data from (C)".
+
+    A marker directly following the previous marker, possibly joined by "and" or "&",
+    opens a clause too, so that "(A) and (B) text" keeps both labels.
+    """
+    prefix = caption[:start].rstrip()
+    if not prefix or SENTENCE_END.search(prefix) or '\n' in caption[len(prefix):start]:
+        return "sentence"
+    if CLAUSE_END.search(prefix):
+        return "clause"
+    if previous_end is not None and len(JOINER.sub('', prefix)) == previous_end:
+        return "clause"
+    return None
+
+def find_markers(caption):
+    """
+    Candidate panel markers of a caption as `(start, end, labels, sentence)`: only those
+    opening a sentence or a clause, `sentence` telling which.
+    """
+    markers = []
+    for match in MARKER.finditer(caption):
+        text = match.group('parenthesised') or match.group('closing') or match.group('lowercase')
+        labels = parse_labels(text)
+        if not labels:
+            continue
+        boundary = marker_boundary(caption, match.start(), markers[-1][1] if markers else None)
+        if boundary is not None:
+            markers.append((match.start(), match.end(), labels, boundary == "sentence"))
+    return markers
+
+def increasing_markers(markers):
+    """
+    The longest sequence of markers whose labels strictly increase, so that references
+    such as "(B) as in (A); (C) ..." are not taken as segment starts. Among the longest
+    sequences, the one with the most markers at a sentence start wins, so that of two
+    candidates for a label the one opening a sentence is preferred to an earlier one.
+    """
+    if not markers:
+        return []
+    scores = [(1, int(sentence)) for _, _, _, sentence in markers]
+    previous = [None] * len(markers)
+    for i, (_, _, labels, sentence) in enumerate(markers):
+        for j in range(i):
+            score = (scores[j][0] + 1, scores[j][1] + int(sentence))
+            if min(labels) > max(markers[j][2]) and score > scores[i]:
+                scores[i] = score
+                previous[i] = j
+    # Prefer the earliest sequence among the best ones
+    i = scores.index(max(scores))
+    sequence = []
+    while i is not None:
+        sequence.append(markers[i])
+        i = previous[i]
+    return sequence[::-1]
+
+def segment_caption(caption):
+    """
+    Split a caption into a shared preamble and one segment per panel marker.
+
+    Args:
+        caption (str): The figure caption.
+
+    Returns:
+        dict: `preamble` is the end offset of the text before the first marker, and
+        `segments` lists `[labels, start, end]` character spans, where `labels` is the
+        string of upper-case panel labels the segment describes. Captions without
+        markers have no segments.
+    """
+    markers = increasing_markers(find_markers(caption))
+    if not markers:
+        return {"preamble": len(caption), "segments": []}
+
+    segments = []
+    group_labels, group_start = "", None
+    for i, (start, marker_end, labels, _) in enumerate(markers):
+        end = markers[i + 1][0] if i + 1 < len(markers) else len(caption)
+        group_labels += ''.join(labels)
+        group_start = start if group_start is None else group_start
+        if i + 1 < len(markers) and EMPTY_SEGMENT.match(caption[marker_end:end]):
+            # "(A) and (B) text": the labels share the text of the next segment
+            continue
+        segments.append([group_labels, group_start, end])
+        group_labels, group_start = "", None
+    return {"preamble": markers[0][0], "segments": segments}
+
+def panel_context(caption, segmentation, label):
+    """
+    The part of a caption a panel needs: the preamble and the segments of its label.
+
+    Args:
+        caption (str): The figure caption.
+        segmentation (dict): As returned by `segment_caption`.
+        label (str): Known or predicted panel label, in any case.
+
+    Returns:
+        str: The reduced caption, or the whole caption if the label has no segment.
+    """
+    if not label:
+        return caption
+    spans = [(start, end) for labels, start, end in segmentation["segments"] if label.upper() in labels]
+    if not spans:
+        return caption
+    preamble = caption[:segmentation["preamble"]].strip()
+    body = ' '.join(caption[start:end].strip() for start, end in spans)
+    return f"{preamble}\n{body}" if preamble else body
+
+def estimate_tokens(text):
+    # Same four-characters-per-token estimate as `assistants.estimate_text_tokens`
+    return math.ceil(len(text) / 4)
+
+def token_report(captions):
+    """
+    Caption tokens of one request per segmented panel, with the whole caption and with
+    the reduced context, across every figure of a caption store.
+
+    Args:
+        captions (CaptionStore): The figure captions; their segmentations are stored.
+
+    Returns:
+        dict: Figure and panel counts and the token totals of both prompts.
+    """
+    report = {"figures": 0, "segmented_figures": 0, "panels": 0, "full_caption_tokens": 0, "reduced_caption_tokens": 0}
+    for figure_id in tqdm(list(captions.figure_ids()), desc="Segmenting captions"):
+        caption = captions.get(figure_id) or ""
+        segmentation = captions.segments(figure_id)
+        report["figures"] += 1
+        labels = sorted(set(''.join(labels for labels, _, _ in segmentation["segments"])))
+        if not labels:
+            continue
+        report["segmented_figures"] += 1
+        report["panels"] += len(labels)
+        report["full_caption_tokens"] += len(labels) * estimate_tokens(caption)
+        report["reduced_caption_tokens"] += sum(estimate_tokens(panel_context(caption, segmentation, label)) for label in labels)
+    if report["full_caption_tokens"]:
+        report["reduction"] = 1 - report["reduced_caption_tokens"] / report["full_caption_tokens"]
+    return report
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the caption segmentation report.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Segment the figure captions per panel label and report the prompt token reduction.")
+    parser.add_argument('--captions', type=str, default='data/figure_captions.jsonl', help="Path to the figure captions JSONL file.")
+    parser.add_argument('--output', type=str, default=None, help="Write the report to this JSON file.")
+
+    return parser.parse_args()
+
+def main():
+    from caption_store import CaptionStore
+
+    args = parse_arguments()
+    with CaptionStore(args.captions) as captions:
+        report = token_report(captions)
+
+    print(f"Segmented {report['segmented_figures']} of {report['figures']} captions into {report['panels']} panel contexts")
+    if report["full_caption_tokens"]:
+        print(f"Caption tokens per panel request: {report['reduced_caption_tokens']} instead of {report['full_caption_tokens']} "
+              f"({report['reduction']:.1%} fewer)")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()
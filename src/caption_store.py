@@ -0,0 +1,175 @@
+# src/caption_store.py
+
+import os
+import json
+import mmap
+from caption_segmenter import segment_caption, SEGMENTER_VERSION
+
+INDEX_SUFFIX = '.idx'
+SEGMENTS_SUFFIX = '.segments'
+
+def index_path_for(jsonl_path):
+    return jsonl_path + INDEX_SUFFIX
+
+def write_index(jsonl_path, offsets, index_path=None):
+    """
+    Write the byte-offset index of a figure captions JSONL file.
+
+    Args:
+        jsonl_path (str): Path to the indexed JSONL file.
+        offsets (dict): Maps figure_id to `[offset, length]` of its line in bytes.
+        index_path (str): Destination of the index, `<jsonl_path>.idx` by default.
+    """
+    stat = os.stat(jsonl_path)
+    index = {
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "offsets": offsets
+    }
+    index_path = index_path or index_path_for(jsonl_path)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+def build_index(jsonl_path, index_path=None):
+    """
+    Scan a figure captions JSONL file once and record where each figure's line starts.
+
+    Args:
+        jsonl_path (str): Path to the JSONL file.
+        index_path (str): Destination of the index, `<jsonl_path>.idx` by default.
+
+    Returns:
+        dict: Maps figure_id to `[offset, length]`.
+    """
+    offsets = {}
+    offset = 0
+    with open(jsonl_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                # Keep the first occurrence of duplicated figure_ids
+                offsets.setdefault(str(json.loads(line)['figure_id']), [offset, len(line)])
+            offset += len(line)
+    write_index(jsonl_path, offsets, index_path)
+    return offsets
+
+def load_index(jsonl_path, index_path=None):
+    """
+    Load the byte-offset index, rebuilding it when it is missing or older than the JSONL file.
+
+    Returns:
+        dict: Maps figure_id to `[offset, length]`.
+    """
+    index_path = index_path or index_path_for(jsonl_path)
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        stat = os.stat(jsonl_path)
+        if index["source_size"] == stat.st_size and index["source_mtime_ns"] == stat.st_mtime_ns:
+            return index["offsets"]
+    return build_index(jsonl_path, index_path)
+
+def load_segments(jsonl_path):
+    """
+    Load the stored caption segmentations, or an empty dict when they are missing, older
+    than the JSONL file or were computed by another version of the segmenter.
+    """
+    segments_path = jsonl_path + SEGMENTS_SUFFIX
+    if os.path.exists(segments_path):
+        with open(segments_path, 'r') as f:
+            stored = json.load(f)
+        stat = os.stat(jsonl_path)
+        if (stored["source_size"], stored["source_mtime_ns"], stored["version"]) == (stat.st_size, stat.st_mtime_ns, SEGMENTER_VERSION):
+            return stored["segments"]
+    return {}
+
+def write_segments(jsonl_path, segments):
+    stat = os.stat(jsonl_path)
+    stored = {
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "version": SEGMENTER_VERSION,
+        "segments": segments
+    }
+    segments_path = jsonl_path + SEGMENTS_SUFFIX
+    tmp_path = segments_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stored, f)
+    os.replace(tmp_path, segments_path)
+
+class CaptionStore:
+    """
+    Read-only, figure_id-keyed access to a figure captions JSONL file.
+
+    The file is memory-mapped and only the line of the requested figure is decoded,
+    so lookups are O(1) and the captions are never loaded into memory as a whole.
+
+    Caption segmentations (see `caption_segmenter`) are computed on first use and
+    saved next to the index (`<jsonl_path>.segments`) when the store is closed.
+    """
+
+    def __init__(self, jsonl_path, index_path=None):
+        self.path = jsonl_path
+        self._offsets = load_index(jsonl_path, index_path)
+        self._file = open(jsonl_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets else None
+        self._segments = None
+        self._segments_changed = False
+
+    def __contains__(self, figure_id):
+        return str(figure_id) in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def figure_ids(self):
+        return self._offsets.keys()
+
+    def get_record(self, figure_id):
+        """
+        Return the full JSONL record of a figure, or None if it is not in the file.
+        """
+        location = self._offsets.get(str(figure_id))
+        if location is None:
+            return None
+        offset, length = location
+        return json.loads(self._mmap[offset:offset + length])
+
+    def get(self, figure_id, default=None):
+        """
+        Return the caption of a figure, or `default` if it is not in the file.
+        """
+        record = self.get_record(figure_id)
+        return record['figure_caption'] if record else default
+
+    def segments(self, figure_id):
+        """
+        Return the segmentation of a figure's caption (see `caption_segmenter.segment_caption`),
+        or None if the figure is not in the file.
+        """
+        if self._segments is None:
+            self._segments = load_segments(self.path)
+        figure_id = str(figure_id)
+        if figure_id not in self._segments:
+            caption = self.get(figure_id)
+            if caption is None:
+                return None
+            self._segments[figure_id] = segment_caption(caption)
+            self._segments_changed = True
+        return self._segments[figure_id]
+
+    def close(self):
+        if self._segments_changed:
+            write_segments(self.path, self._segments)
+            self._segments_changed = False
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,127 @@
+# src/content_keys.py
+
+import hashlib
+import numpy as np
+from PIL import Image
+
+KEY_PREFIX = "content"
+# Side of the difference-hash grid: HASH_SIZE ** 2 bits per image
+HASH_SIZE = 16
+# Grey-level step below which neighbours count as equal, so flat backgrounds hash stably
+HASH_TOLERANCE = 2
+DEFAULT_MAX_DISTANCE = 10
+
+def image_hash(image):
+    """
+    Perceptual (difference) hash of a panel crop as a hex string.
+
+    The crop is reduced to a `HASH_SIZE + 1` by `HASH_SIZE` greyscale thumbnail and
+    every bit tells whether a pixel is brighter than its left neighbour (by more than
+    `HASH_TOLERANCE`), so the hash survives re-encoding, resizing and slightly
+    different crop boxes. It also barely changes with a small printed label, so two
+    panels of a figure that differ by their letter can hash the same: it only proposes
+    near-duplicate candidates, and exact lookups use `pixel_digest`.
+
+    Args:
+        image: A PIL image, or a path or file object PIL can open.
+
+    Returns:
+        str: `HASH_SIZE ** 2 / 4` hex digits.
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+        # JPEG figures can be decoded at a fraction of their size
+        image.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+    pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX), dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1] + HASH_TOLERANCE).tobytes().hex()
+
+def pixel_digest(image):
+    """
+    Digest of the decoded RGB pixels and size of a crop: the same for re-encoded copies
+    of identical pixels, different as soon as a single pixel (e.g. of the label) differs.
+    """
+    image = image.convert("RGB")
+    digest = hashlib.sha1(f"{image.width}x{image.height}".encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()[:24]
+
+def image_digests(path):
+    """
+    `(pixel_digest, image_hash)` of a crop, decoded once.
+    """
+    with Image.open(path) as image:
+        image.load()
+        return pixel_digest(image), image_hash(image)
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+def prompt_version(*parts):
+    """
+    Short digest of everything that shapes an answer besides the panel and the caption
+    (model name, system prompts), so changing the prompt does not reuse stale answers.
+    """
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()[:8]
+
+def content_key(pixels, image_digest, caption_digest, version):
+    """
+    Description cache key of a crop: exact matches need the same pixels, caption and
+    prompt version; the perceptual hash is kept for near-duplicate lookups.
+    """
+    return f"{KEY_PREFIX}:{version}:{caption_digest}:{pixels}:{image_digest}"
+
+def parse_content_key(key):
+    """
+    `(version, caption_digest, pixels, image_digest)` of a content key, or None for
+    other keys (e.g. filenames, or keys of the earlier layout without a pixel digest).
+    """
+    parts = key.split(':')
+    if len(parts) != 5 or parts[0] != KEY_PREFIX:
+        return None
+    return parts[1], parts[2], parts[3], parts[4]
+
+def hash_bits(image_digest):
+    return np.unpackbits(np.frombuffer(bytes.fromhex(image_digest), dtype=np.uint8))
+
+class NearDuplicateIndex:
+    """
+    Content keys grouped by prompt version and caption, for nearest-image lookups.
+
+    A crop cut with a slightly different box, or re-encoded, hashes a few bits away
+    from the original; `candidates` returns the cached keys of the same caption and
+    prompt version whose image hash is within `max_distance` bits, nearest first. The
+    hash cannot tell panels apart by their label alone, so callers must verify a
+    candidate before reusing its answer.
+    """
+
+    def __init__(self, keys=(), max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._groups = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        parsed = parse_content_key(key)
+        if parsed is None:
+            return
+        version, caption_digest, _, image_digest = parsed
+        keys, bits = self._groups.setdefault((version, caption_digest), ([], []))
+        keys.append(key)
+        bits.append(hash_bits(image_digest))
+
+    def candidates(self, key):
+        """
+        `(cached_key, distance)` of the cached crops within `max_distance`, nearest first.
+        """
+        parsed = parse_content_key(key)
+        if parsed is None:
+            return []
+        version, caption_digest, _, image_digest = parsed
+        group = self._groups.get((version, caption_digest))
+        if not group:
+            return []
+        keys, bits = group
+        distances = np.count_nonzero(np.stack(bits) != hash_bits(image_digest), axis=1)
+        order = np.argsort(distances, kind='stable')
+        return [(keys[index], int(distances[index])) for index in order
+                if distances[index] <= self.max_distance and keys[index] != key]
@@ -1,93 +1,191 @@
 import os
+import argparse
 import xml.etree.ElementTree as ET
 import zipfile
 import shutil
-import random
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw
+from dataset_manifest import find_manifest, load_manifest
 
-def extract_zip(zip_path, extract_to):
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
-
-def get_extracted_dir(base_dir):
-    sub_dirs = os.listdir(base_dir)
-    if len(sub_dirs) == 1 and os.path.isdir(os.path.join(base_dir, sub_dirs[0])):
-        return os.path.join(base_dir, sub_dirs[0])
-    return base_dir
-
-def convert_annotations(xml_path, images_dir, output_dir):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    images_output_dir = os.path.join(output_dir, 'images')
-    labels_output_dir = os.path.join(output_dir, 'labels')
-    visualize_output_dir = os.path.join(output_dir, 'test_image_clef')
+# Opened once per worker process by `open_zip`
+_zip_file = None
 
-    os.makedirs(images_output_dir, exist_ok=True)
-    os.makedirs(labels_output_dir, exist_ok=True)
-    os.makedirs(visualize_output_dir, exist_ok=True)
+def open_zip(zip_path):
+    global _zip_file
+    _zip_file = zipfile.ZipFile(zip_path, 'r')
 
-    missing_images = []
-    processed_images = 0
-
-    for annotation in root.findall('annotation'):
-        filename = annotation.find('filename').text
-        image_file = os.path.join(images_dir, f"{filename}.jpg")
-        if not os.path.exists(image_file):
-            missing_images.append(image_file)
+def index_zip_images(zip_path):
+    """
+    Map each figure name (the image file name without extension) to its member in the zip.
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        return {
+            os.path.splitext(os.path.basename(name))[0]: name
+            for name in zip_ref.namelist()
+            if name.lower().endswith('.jpg')
+        }
+
+def iter_annotations(xml_path):
+    """
+    Parse the ground-truth XML incrementally, yielding one annotation at a time.
+
+    Yields:
+        tuple: The figure filename and the list of its 4-point objects as `[(x, y), ...]`.
+    """
+    for _, element in ET.iterparse(xml_path, events=('end',)):
+        if element.tag != 'annotation':
             continue
-
-        image_output_path = os.path.join(images_output_dir, f"{filename}.jpg")
-        shutil.copy(image_file, image_output_path)
-
-        label_file = os.path.join(labels_output_dir, f"{filename}.txt")
-        label_content = []
-        bounding_boxes = []
-
-        img = Image.open(image_file)
-        img_width, img_height = img.size
-
-        for obj in annotation.findall('object'):
+        filename = element.find('filename').text
+        objects = []
+        for obj in element.findall('object'):
             points = obj.findall('point')
             if len(points) != 4:
                 continue
-            x1, y1 = float(points[0].get('x')), float(points[0].get('y'))
-            x2, y2 = float(points[1].get('x')), float(points[1].get('y'))
-            x3, y3 = float(points[2].get('x')), float(points[2].get('y'))
-            x4, y4 = float(points[3].get('x')), float(points[3].get('y'))
-
-            min_x = min(x1, x2, x3, x4)
-            max_x = max(x1, x2, x3, x4)
-            min_y = min(y1, y2, y3, y4)
-            max_y = max(y1, y2, y3, y4)
+            objects.append([(float(point.get('x')), float(point.get('y'))) for point in points])
+        element.clear()
+        yield filename, objects
+
+def is_up_to_date(filename, output_dir, source_mtime):
+    image_output_path = os.path.join(output_dir, 'images', f"{filename}.jpg")
+    label_file = os.path.join(output_dir, 'labels', f"{filename}.txt")
+    return (os.path.exists(image_output_path) and os.path.getmtime(image_output_path) >= source_mtime
+            and os.path.exists(label_file) and os.path.getmtime(label_file) >= source_mtime)
+
+def convert_figure(task):
+    """
+    Convert the annotation of one figure, reading its image straight from the zip.
+
+    Only the image header is parsed to get its dimensions; the image bytes are copied
+    to the output without decoding unless a visualisation is requested. Figures known
+    to the manifest of the output split are neither parsed nor, if their output is
+    unchanged, copied again.
+
+    Args:
+        task (tuple): `(filename, member, objects, output_dir, visualize, known)`, where
+            `known` is None or the `(width, height, copied)` from `known_figures`.
+
+    Returns:
+        bool: Whether a label file was written.
+    """
+    filename, member, objects, output_dir, visualize, known = task
+
+    if known is not None:
+        img_width, img_height, copied = known
+    else:
+        with _zip_file.open(member) as image_file:
+            img_width, img_height = Image.open(image_file).size
+        copied = False
+
+    image_output_path = os.path.join(output_dir, 'images', f"{filename}.jpg")
+    if not copied:
+        with _zip_file.open(member) as source, open(image_output_path, 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+
+    label_file = os.path.join(output_dir, 'labels', f"{filename}.txt")
+    label_content = []
+    bounding_boxes = []
+
+    for points in objects:
+        min_x = min(x for x, _ in points)
+        max_x = max(x for x, _ in points)
+        min_y = min(y for _, y in points)
+        max_y = max(y for _, y in points)
+
+        if max_x - min_x == img_width and max_y - min_y == img_height:
+            continue
 
-            if max_x - min_x == img_width and max_y - min_y == img_height:
+        center_x = ((min_x + max_x) / 2) / img_width
+        center_y = ((min_y + max_y) / 2) / img_height
+        width = (max_x - min_x) / img_width
+        height = (max_y - min_y) / img_height
+
+        label_content.append(f"0 {center_x} {center_y} {width} {height}")
+        bounding_boxes.append(((min_x, min_y), (max_x, max_y)))
+
+    if label_content:
+        with open(label_file, 'w') as f:
+            for line in label_content:
+                f.write(line + "\n")
+
+    if visualize and bounding_boxes:
+        visualize_image(image_output_path, bounding_boxes, os.path.join(output_dir, 'test_image_clef', f"{filename}.jpg"))
+
+    return bool(label_content)
+
+def known_figures(output_dir, zip_path, members):
+    """
+    Figures of the zip already recorded in the manifest of the `images/` output split
+    (built by `dataset_manifest.py`) with the same CRC-32 and size.
+
+    Returns:
+        dict: `(width, height, copied)` by figure name, where `copied` tells whether the
+        output image is still the one the manifest recorded.
+    """
+    path = find_manifest(os.path.join(output_dir, 'images'))
+    manifest = load_manifest(path) if path else None
+    if manifest is None:
+        return {}
+    known = {}
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for filename, member in members.items():
+            position = manifest.positions.get(f"{filename}.jpg")
+            if position is None:
                 continue
+            info = zip_ref.getinfo(member)
+            if info.CRC != manifest.crc32[position] or info.file_size != manifest.file_size[position]:
+                continue
+            image_output_path = os.path.join(output_dir, 'images', f"{filename}.jpg")
+            copied = bool(os.path.exists(image_output_path) and os.path.getsize(image_output_path) == manifest.file_size[position]
+                          and os.stat(image_output_path).st_mtime_ns == manifest.mtime_ns[position])
+            known[filename] = (*manifest.size(position), copied)
+    return known
+
+def convert_annotations(xml_path, zip_path, output_dir, workers=None, visualize=False, force=False):
+    """
+    Convert the ImageCLEF ground truth to YOLO labels, streaming the images from the zip.
+
+    Args:
+        xml_path (str): Path to the ground-truth XML file.
+        zip_path (str): Path to the zip with the figure images.
+        output_dir (str): Output directory for `images/`, `labels/` and the optional visualisations.
+        workers (int): Number of worker processes (defaults to the number of CPUs).
+        visualize (bool): Also draw the boxes onto copies of the figures.
+        force (bool): Convert figures whose outputs are already newer than the inputs.
+
+    Returns:
+        int: Number of figures with a label file, including up-to-date ones that were skipped.
+    """
+    os.makedirs(os.path.join(output_dir, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'labels'), exist_ok=True)
+    if visualize:
+        os.makedirs(os.path.join(output_dir, 'test_image_clef'), exist_ok=True)
+
+    members = index_zip_images(zip_path)
+    known = known_figures(output_dir, zip_path, members)
+    source_mtime = max(os.path.getmtime(xml_path), os.path.getmtime(zip_path))
 
-            center_x = ((min_x + max_x) / 2) / img_width
-            center_y = ((min_y + max_y) / 2) / img_height
-            width = (max_x - min_x) / img_width
-            height = (max_y - min_y) / img_height
-
-            label_content.append(f"0 {center_x} {center_y} {width} {height}")
-            bounding_boxes.append(((min_x, min_y), (max_x, max_y)))
-
-        if label_content:
-            with open(label_file, 'w') as f:
-                for line in label_content:
-                    f.write(line + "\n")
-            processed_images += 1
+    missing_images = []
+    tasks = []
+    skipped = 0
+    for filename, objects in iter_annotations(xml_path):
+        if filename not in members:
+            missing_images.append(f"{filename}.jpg")
+            continue
+        if not force and is_up_to_date(filename, output_dir, source_mtime):
+            skipped += 1
+            continue
+        tasks.append((filename, members[filename], objects, output_dir, visualize, known.get(filename)))
 
-        if bounding_boxes:
-            visualize_image(image_file, bounding_boxes, os.path.join(visualize_output_dir, f"{filename}.jpg"))
+    with ProcessPoolExecutor(max_workers=workers, initializer=open_zip, initargs=(zip_path,)) as executor:
+        processed_images = sum(executor.map(convert_figure, tasks, chunksize=16))
 
     if missing_images:
-        print(f"Warning: The following images were not found in the directory '{images_dir}':")
+        print(f"Warning: The following images were not found in '{zip_path}':")
         for img in missing_images:
             print(img)
 
-    print(f"Processed {processed_images} images.")
-    return processed_images
+    print(f"Processed {processed_images} images, skipped {skipped} up-to-date images.")
+    return processed_images + skipped
 
 def visualize_image(image_path, bounding_boxes, save_path):
     img = Image.open(image_path)
@@ -99,34 +197,33 @@ def visualize_image(image_path, bounding_boxes, save_path):
 
     img.save(save_path)
 
-def main():
-    zip_path = 'data/FigureSeparationTest2016.zip'
-    extract_dir = 'data/FigureSeparationTest2016'
-    xml_path = 'data/FigureSeparationTest2016GT.xml'
-    output_dir = 'data/ImageCLEF/test'
+def parse_arguments():
+    """
+    Parse command-line arguments for the annotation conversion.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Convert the ImageCLEF 2016 figure separation ground truth to YOLO labels.")
+    parser.add_argument('--zip', type=str, default='data/FigureSeparationTest2016.zip', help="Path to the zip with the figure images.")
+    parser.add_argument('--xml', type=str, default='data/FigureSeparationTest2016GT.xml', help="Path to the ground-truth XML file.")
+    parser.add_argument('--output', type=str, default='data/ImageCLEF/test', help="Output directory.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (defaults to the number of CPUs).")
+    parser.add_argument('--visualize', action='store_true', help="Also write copies of the figures with their boxes drawn.")
+    parser.add_argument('--force', action='store_true', help="Convert every figure even if its outputs are up to date.")
 
-    print(f"Extracting images from {zip_path} to {extract_dir}...")
-    extract_zip(zip_path, extract_dir)
+    return parser.parse_args()
 
-    extract_dir = get_extracted_dir(extract_dir)
-    if not os.path.exists(extract_dir):
-        print(f"Error: Extraction failed or directory {extract_dir} does not exist.")
-        return
+def main():
+    args = parse_arguments()
 
-    print(f"Converting annotations from {xml_path}...")
-    processed_images = convert_annotations(xml_path, extract_dir, output_dir)
+    print(f"Converting annotations from {args.xml} with images from {args.zip}...")
+    processed_images = convert_annotations(args.xml, args.zip, args.output, workers=args.workers, visualize=args.visualize, force=args.force)
 
     if processed_images == 0:
         print("Error: Conversion failed, no files written to the output directory.")
     else:
-        print(f"Completed conversion. Output saved to {output_dir}")
-
-    images_output_dir = os.path.join(output_dir, 'images')
-    labels_output_dir = os.path.join(output_dir, 'labels')
-    print(f"Images in output directory: {os.listdir(images_output_dir)}")
-    print(f"Labels in output directory: {os.listdir(labels_output_dir)}")
-
-    shutil.rmtree(extract_dir)
+        print(f"Completed conversion. Output saved to {args.output}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,287 @@
+# src/dataset_manifest.py
+
+import os
+import io
+import json
+import zlib
+import time
+import yaml
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from dataset_splits import IMAGE_EXTENSIONS, split_images_dir, label_path, read_label_file
+
+# Bump when the stored columns change, so manifests are rebuilt
+MANIFEST_VERSION = 1
+MANIFEST_DIR = 'data/manifests/'
+COLUMNS = ("names", "width", "height", "file_size", "mtime_ns", "crc32", "sha1", "label_mtime_ns",
+           "box_offsets", "boxes", "crop_names", "crop_figure", "crop_labels")
+
+def describe_image(path):
+    """
+    Dimensions (from the header), CRC-32 and SHA-1 of an image file, read once.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+    return width, height, zlib.crc32(data), hashlib.sha1(data).hexdigest()
+
+def split_crop_name(filename):
+    """
+    `(figure_id, panel_label)` of a panel crop named `<figure_id>_<label>.png`, or None.
+    """
+    if not filename.endswith(".png") or '_' not in filename:
+        return None
+    figure_id, panel_label = filename.rsplit('_', 1)
+    return figure_id, panel_label.split('.')[0]
+
+def scan(directory, extensions):
+    """
+    `{name: stat}` of the files of a directory with the given extensions, in one pass.
+    """
+    if not os.path.isdir(directory):
+        return {}
+    with os.scandir(directory) as entries:
+        return {entry.name: entry.stat() for entry in entries if entry.name.lower().endswith(extensions) and entry.is_file()}
+
+class DatasetManifest:
+    """
+    Per-image metadata of a dataset split as numpy columns.
+
+    Images are sorted by name, with their dimensions, file size, mtime, CRC-32 and
+    SHA-1, and the mtime of their label file (-1 without one). The labels of all the
+    images are a single `boxes` array of `class, x, y, w, h` rows; those of image `i`
+    are `boxes[box_offsets[i]:box_offsets[i + 1]]`. When built with a crops directory,
+    `crop_names`, `crop_figure` (index of the figure image) and `crop_labels` map the
+    panel crops `<figure_id>_<label>.png` to their figures.
+    """
+
+    def __init__(self, metadata, columns):
+        self.metadata = metadata
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        self._positions = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def images_dir(self):
+        return self.metadata["images_dir"]
+
+    @property
+    def positions(self):
+        if self._positions is None:
+            self._positions = {name: position for position, name in enumerate(self.names.tolist())}
+        return self._positions
+
+    def image_paths(self):
+        return [os.path.join(self.images_dir, name) for name in self.names.tolist()]
+
+    def figure_ids(self):
+        return [os.path.splitext(name)[0] for name in self.names.tolist()]
+
+    def size(self, position):
+        return int(self.width[position]), int(self.height[position])
+
+    def labels(self, position):
+        return self.boxes[self.box_offsets[position]:self.box_offsets[position + 1]]
+
+    def crops(self):
+        """
+        `(filename, figure_id, panel_label)` of the panel crops of the figures of the split.
+        """
+        figure_ids = self.figure_ids()
+        return [(name, figure_ids[figure], label) for name, figure, label
+                in zip(self.crop_names.tolist(), self.crop_figure.tolist(), self.crop_labels.tolist())]
+
+    def save(self, path):
+        """
+        Write the manifest as a single uncompressed `.npz`, replaced atomically.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, metadata=np.array(json.dumps(self.metadata)), **{name: getattr(self, name) for name in COLUMNS})
+        os.replace(path + '.tmp', path)
+
+def manifest_path(data_yaml, split, manifest_dir=MANIFEST_DIR):
+    name = os.path.splitext(os.path.basename(data_yaml))[0]
+    return os.path.join(manifest_dir, f"{name}_{split}.npz")
+
+def read_metadata(path):
+    with np.load(path, allow_pickle=False) as stored:
+        return json.loads(stored["metadata"].item())
+
+def load_manifest(path):
+    """
+    Open a stored manifest, or return None if it is missing or of another version.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as stored:
+        metadata = json.loads(stored["metadata"].item())
+        if metadata.get("version") != MANIFEST_VERSION:
+            return None
+        return DatasetManifest(metadata, {name: stored[name] for name in COLUMNS})
+
+def find_manifest(images_dir, manifest_dir=MANIFEST_DIR):
+    """
+    Path of the manifest of the split stored in `images_dir`, or None.
+    """
+    if not os.path.isdir(manifest_dir):
+        return None
+    target = os.path.abspath(images_dir)
+    for name in sorted(os.listdir(manifest_dir)):
+        path = os.path.join(manifest_dir, name)
+        if name.endswith('.npz') and os.path.abspath(read_metadata(path)["images_dir"]) == target:
+            return path
+    return None
+
+def update_manifest(data_yaml, split, manifest_dir=MANIFEST_DIR, crops_dir=None, workers=8, force=False):
+    """
+    Build the manifest of a split, or bring a stored one up to date.
+
+    Only images whose size or mtime changed since they were recorded are read again,
+    and only label files whose mtime changed are parsed again; the others are merely
+    stat'ed. The crop mapping is rebuilt from a listing of `crops_dir` (the one the
+    manifest was built with, if not given). The manifest is only rewritten if
+    something changed.
+
+    Args:
+        data_yaml (str): Path to the data YAML file.
+        split (str): Split name ('train', 'val' or 'test').
+        manifest_dir (str): Directory of the manifests.
+        crops_dir (str): Directory of the panel crops to map to the figures of the split.
+        workers (int): Threads reading new and changed images.
+        force (bool): Read every image and label file again.
+
+    Returns:
+        DatasetManifest: The current manifest.
+    """
+    path = manifest_path(data_yaml, split, manifest_dir)
+    images_dir = split_images_dir(data_yaml, split)
+    previous = None if force else load_manifest(path)
+    if previous is not None and os.path.abspath(previous.images_dir) != os.path.abspath(images_dir):
+        previous = None
+    if crops_dir is None and previous is not None:
+        crops_dir = previous.metadata.get("crops_dir")
+
+    images = scan(images_dir, IMAGE_EXTENSIONS)
+    names = sorted(images)
+    count = len(names)
+    width = np.zeros(count, dtype=np.int32)
+    height = np.zeros(count, dtype=np.int32)
+    file_size = np.array([images[name].st_size for name in names], dtype=np.int64)
+    mtime_ns = np.array([images[name].st_mtime_ns for name in names], dtype=np.int64)
+    crc32 = np.zeros(count, dtype=np.uint32)
+    sha1 = np.zeros(count, dtype='U40')
+    label_mtime_ns = np.full(count, -1, dtype=np.int64)
+    labels = [None] * count
+
+    changed = previous is None or previous.names.tolist() != names
+    stale = []
+    labels_dir = os.path.dirname(label_path(os.path.join(images_dir, "image.jpg")))
+    label_files = scan(labels_dir, ('.txt',))
+    for position, name in enumerate(names):
+        label_stat = label_files.get(os.path.splitext(name)[0] + '.txt')
+        if label_stat is not None:
+            label_mtime_ns[position] = label_stat.st_mtime_ns
+        known = None if previous is None else previous.positions.get(name)
+        if known is not None and previous.file_size[known] == file_size[position] and previous.mtime_ns[known] == mtime_ns[position]:
+            width[position], height[position] = previous.width[known], previous.height[known]
+            crc32[position], sha1[position] = previous.crc32[known], previous.sha1[known]
+        else:
+            stale.append(position)
+        if known is not None and previous.label_mtime_ns[known] == label_mtime_ns[position]:
+            labels[position] = previous.labels(known)
+        else:
+            changed = True
+            labels[position] = read_label_file(label_path(os.path.join(images_dir, name))) if label_stat is not None else np.zeros((0, 5), dtype=np.float32)
+
+    if stale:
+        changed = True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            described = executor.map(describe_image, [os.path.join(images_dir, names[position]) for position in stale])
+            for position, (w, h, crc, digest) in zip(stale, described):
+                width[position], height[position], crc32[position], sha1[position] = w, h, crc, digest
+
+    positions = {os.path.splitext(name)[0]: position for position, name in enumerate(names)}
+    crops = []
+    for crop_name in sorted(scan(crops_dir, ('.png',))) if crops_dir else []:
+        parsed = split_crop_name(crop_name)
+        if parsed is not None and parsed[0] in positions:
+            crops.append((crop_name, positions[parsed[0]], parsed[1]))
+    crop_names = np.array([crop[0] for crop in crops], dtype=str)
+    if previous is None or previous.metadata.get("crops_dir") != crops_dir or previous.crop_names.tolist() != crop_names.tolist():
+        changed = True
+
+    if not changed:
+        return previous
+
+    box_offsets = np.zeros(count + 1, dtype=np.int64)
+    box_offsets[1:] = np.cumsum([len(rows) for rows in labels])
+    metadata = {
+        "version": MANIFEST_VERSION,
+        "data": data_yaml,
+        "split": split,
+        "images_dir": images_dir,
+        "labels_dir": labels_dir,
+        "crops_dir": crops_dir,
+        "updated": time.time()
+    }
+    manifest = DatasetManifest(metadata, {
+        "names": np.array(names, dtype=str),
+        "width": width,
+        "height": height,
+        "file_size": file_size,
+        "mtime_ns": mtime_ns,
+        "crc32": crc32,
+        "sha1": sha1,
+        "label_mtime_ns": label_mtime_ns,
+        "box_offsets": box_offsets,
+        "boxes": np.concatenate(labels).astype(np.float32) if count else np.zeros((0, 5), dtype=np.float32),
+        "crop_names": crop_names,
+        "crop_figure": np.array([crop[1] for crop in crops], dtype=np.int32),
+        "crop_labels": np.array([crop[2] for crop in crops], dtype=str)
+    })
+    manifest.save(path)
+    print(f"Updated the manifest of {data_yaml} [{split}]: {count} images ({len(stale)} read), "
+          f"{box_offsets[-1]} boxes, {len(crops)} panel crops")
+    return manifest
+
+def parse_arguments():
+    """
+    Parse command-line arguments for building the dataset manifests.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Record the dimensions, hashes, labels and panel crops of the dataset splits in manifests.")
+    parser.add_argument('--data', type=str, nargs='+', default=['data/source_data.yml', 'data/imageCLEF_data.yml'], help="Data YAML files.")
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val', 'test'], help="Splits to record (splits missing from a YAML file are skipped).")
+    parser.add_argument('--crops_dir', type=str, default=None, help="Directory of the panel crops to map to their figures (data/segmented_images/).")
+    parser.add_argument('--manifest_dir', type=str, default=MANIFEST_DIR, help="Directory of the manifests.")
+    parser.add_argument('--workers', type=int, default=8, help="Threads reading new and changed images.")
+    parser.add_argument('--force', action='store_true', help="Read every image and label file again.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    for data_yaml in args.data:
+        if not os.path.exists(data_yaml):
+            print(f"Skipping {data_yaml}: not found")
+            continue
+        with open(data_yaml, 'r') as f:
+            data = yaml.safe_load(f)
+        splits = [split for split in args.splits if split in data]
+        for split in splits:
+            start = time.perf_counter()
+            manifest = update_manifest(data_yaml, split, args.manifest_dir, args.crops_dir, args.workers, args.force)
+            print(f"{data_yaml} [{split}]: {len(manifest)} images up to date in {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# src/dataset_splits.py
+
+import os
+import yaml
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+# Splits with a manifest in this directory are listed from it (None always lists the directories)
+manifest_dir = 'data/manifests/'
+# `(manifest, position)` of every image listed from a manifest, by absolute path
+_manifest_entries = {}
+
+def configure_manifests(directory='data/manifests/'):
+    """
+    Set the directory of the manifests `split_images` reads, or disable them with None.
+    """
+    global manifest_dir
+    manifest_dir = directory
+    _manifest_entries.clear()
+
+def split_images_dir(data_yaml, split):
+    """
+    Directory holding the images of a split of an ultralytics data YAML file.
+    """
+    with open(data_yaml, 'r') as f:
+        data = yaml.safe_load(f)
+    return os.path.join(data.get('path', ''), data[split])
+
+def split_images(data_yaml, split):
+    """
+    List the image files of a split of an ultralytics data YAML file.
+
+    If the split has a manifest (see `dataset_manifest.py`), it is updated and the
+    sizes and labels of the images are then served from it.
+
+    Args:
+        data_yaml (str): Path to the data YAML file (e.g. `data/source_data.yml`).
+        split (str): Split name ('train', 'val' or 'test').
+
+    Returns:
+        list: Sorted image paths of the split.
+    """
+    if manifest_dir is not None:
+        from dataset_manifest import manifest_path, update_manifest
+        if os.path.exists(manifest_path(data_yaml, split, manifest_dir)):
+            # Brought up to date by mtime, so only new or changed images are read
+            manifest = update_manifest(data_yaml, split, manifest_dir)
+            image_paths = manifest.image_paths()
+            for position, path in enumerate(image_paths):
+                _manifest_entries[os.path.abspath(path)] = (manifest, position)
+            return image_paths
+
+    images_dir = split_images_dir(data_yaml, split)
+    return sorted(
+        os.path.join(images_dir, filename)
+        for filename in os.listdir(images_dir)
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+def label_path(image_path):
+    """
+    YOLO label file of an image: the last `images` directory becomes `labels`, as in ultralytics.
+    """
+    sep_images, sep_labels = f"{os.sep}images{os.sep}", f"{os.sep}labels{os.sep}"
+    return sep_labels.join(image_path.rsplit(sep_images, 1)).rsplit('.', 1)[0] + '.txt'
+
+def read_label_file(path):
+    """
+    Rows of a YOLO label file as a float32 `(n, 5)` array of `class, x, y, w, h`, unmodified.
+    """
+    with open(path, 'r') as f:
+        rows = [line.split()[:5] for line in f if len(line.split()) >= 5]
+    return np.array(rows, dtype=np.float32).reshape(-1, 5)
+
+def image_size(path):
+    entry = _manifest_entries.get(os.path.abspath(path))
+    if entry is not None:
+        return entry[0].size(entry[1])
+    # Opening without loading only parses the header
+    with Image.open(path) as image:
+        return image.size
+
+def image_labels(path):
+    """
+    YOLO labels of an image as a read-only float32 `(n, 5)` array of `class, x, y, w, h`,
+    empty if it has no label file.
+    """
+    entry = _manifest_entries.get(os.path.abspath(path))
+    if entry is not None:
+        labels = entry[0].labels(entry[1])
+    elif os.path.exists(label_path(path)):
+        labels = read_label_file(label_path(path))
+    else:
+        labels = np.zeros((0, 5), dtype=np.float32)
+    labels.flags.writeable = False
+    return labels
@@ -0,0 +1,423 @@
+# src/description_cache.py
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from content_keys import KEY_PREFIX
+
+# Keys of the filename aliases, whose value is the content key of the panel's description
+FILENAME_PREFIX = "file:"
+
+def decode_record(line):
+    """
+    `(key, value)` of a line of a JSON Lines cache, or None if the line is corrupt.
+    """
+    try:
+        record = json.loads(line)
+        return record['key'], record['value']
+    except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+        return None
+
+class JsonlDescriptionCache:
+    """
+    Append-only JSON Lines log of panel descriptions.
+
+    Every `put` appends one `{"key": ..., "value": ...}` record, so inserts cost O(1)
+    regardless of the cache size. The log is replayed on open (the last record for a
+    key wins): a torn trailing record left by a killed process is discarded, and
+    corrupt records elsewhere are skipped and reported.
+    Records are flushed to the OS on every write and fsync'ed in batches of
+    `sync_every` writes or every `sync_interval` seconds, whichever comes first.
+    """
+
+    def __init__(self, path, sync_every=64, sync_interval=5.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._entries = {}
+        self._records = 0
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._replay()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+
+        complete_size = 0
+        corrupt = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Only the last line can lack its newline: a write cut short by a crash
+                    break
+                complete_size += len(line)
+                record = decode_record(line)
+                if record is None:
+                    corrupt += 1
+                    continue
+                self._entries[record[0]] = record[1]
+                self._records += 1
+
+        if corrupt:
+            # Kept in the log until the next compaction, which drops them
+            print(f"Skipped {corrupt} corrupt records in {self.path}")
+            self._records += corrupt
+        if complete_size != os.path.getsize(self.path):
+            print(f"Discarding a torn record at the end of {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete_size)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        return self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        return self._entries.get(key, default)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def items(self):
+        return self._entries.items()
+
+    def put(self, key, value):
+        line = json.dumps({"key": key, "value": value}) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._entries[key] = value
+            self._records += 1
+            self._pending += 1
+            if self._pending >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def update(self, entries):
+        for key, value in entries.items():
+            self.put(key, value)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def compact(self):
+        """
+        Rewrite the log with one record per key, dropping superseded records.
+
+        The new log is written next to the old one and atomically renamed over it,
+        so a crash during compaction leaves the previous log intact.
+        """
+        with self._lock:
+            self._sync()
+            tmp_path = self.path + '.compact'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for key, value in self._entries.items():
+                    f.write(json.dumps({"key": key, "value": value}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._records = len(self._entries)
+
+    @property
+    def stale_records(self):
+        return self._records - len(self._entries)
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class SqliteDescriptionCache:
+    """
+    SQLite-backed panel description cache in WAL mode.
+
+    Inserts are committed in batches of `sync_every` writes or every `sync_interval`
+    seconds; with `synchronous=NORMAL` a crash can lose at most the uncommitted batch
+    but never corrupts the database.
+    """
+
+    def __init__(self, path, sync_every=64, sync_interval=5.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS descriptions (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.commit()
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM descriptions WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM descriptions").fetchone()[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM descriptions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def keys(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT key FROM descriptions")]
+
+    def items(self):
+        with self._lock:
+            return self._connection.execute("SELECT key, value FROM descriptions").fetchall()
+
+    def put(self, key, value):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO descriptions (key, value) VALUES (?, ?)", (key, value))
+            self._pending += 1
+            if self._pending >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def update(self, entries):
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO descriptions (key, value) VALUES (?, ?)", list(entries.items())
+            )
+            self._sync()
+
+    def _sync(self):
+        self._connection.commit()
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def compact(self):
+        """
+        Checkpoint the write-ahead log into the database and reclaim free pages.
+        """
+        with self._lock:
+            self._sync()
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.execute("VACUUM")
+
+    def close(self):
+        if self._connection is not None:
+            self.flush()
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+BACKENDS = {
+    'jsonl': JsonlDescriptionCache,
+    'sqlite': SqliteDescriptionCache,
+}
+
+def backend_for_path(path):
+    """
+    Pick the cache backend from the file extension (`.sqlite`/`.db` or JSON Lines).
+    """
+    return 'sqlite' if os.path.splitext(path)[1] in ('.sqlite', '.db') else 'jsonl'
+
+def legacy_json_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+def migrate_json_cache(json_path, cache):
+    """
+    Import a legacy `{filename: description}` JSON cache into `cache`.
+
+    Args:
+        json_path (str): Path to the legacy JSON cache.
+        cache: An open cache backend.
+
+    Returns:
+        int: Number of migrated entries.
+    """
+    with open(json_path, 'r') as f:
+        entries = json.load(f)
+    cache.update(entries)
+    cache.flush()
+    return len(entries)
+
+def open_cache(path, backend=None, migrate_from=None, **kwargs):
+    """
+    Open a panel description cache, migrating the legacy JSON file the first time.
+
+    Args:
+        path (str): Path to the cache file (`.jsonl`, `.sqlite` or `.db`).
+        backend (str): 'jsonl' or 'sqlite'; inferred from the extension when None.
+        migrate_from (str): Legacy JSON cache imported when `path` does not exist yet.
+            Defaults to the `.json` file next to `path`.
+        **kwargs: Forwarded to the backend (sync_every, sync_interval).
+
+    Returns:
+        The opened cache backend.
+    """
+    if os.path.splitext(path)[1] == '.json':
+        raise ValueError(f"{path} is a legacy JSON cache; open a .jsonl or .sqlite cache and migrate from it instead")
+
+    backend = backend or backend_for_path(path)
+    migrate_from = migrate_from or legacy_json_path(path)
+    if not os.path.exists(path) and os.path.exists(migrate_from):
+        # Built next to the cache and renamed over it once complete, so an interrupted
+        # migration leaves no partial cache behind and is simply run again
+        tmp_path = path + '.tmp'
+        for leftover in (tmp_path, tmp_path + '-wal', tmp_path + '-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        with BACKENDS[backend](tmp_path, **kwargs) as migration:
+            migrated = migrate_json_cache(migrate_from, migration)
+        # Closing synced the log, or checkpointed the write-ahead log into the database
+        os.replace(tmp_path, path)
+        print(f"Migrated {migrated} cached descriptions from {migrate_from} to {path}")
+
+    return BACKENDS[backend](path, **kwargs)
+
+def filename_alias(filename):
+    return f"{FILENAME_PREFIX}{filename}"
+
+def set_filename_alias(cache, filename, key):
+    """
+    Point the alias of a panel filename at the content key its description is stored under.
+    """
+    alias = filename_alias(filename)
+    if cache.get(alias) != key:
+        cache.put(alias, key)
+
+def filename_view(entries):
+    """
+    `{filename: description}` of the raw entries of a cache: legacy filename keys, and
+    the descriptions the filename aliases point to (which take precedence).
+    """
+    view = {key: value for key, value in entries.items() if not key.startswith((FILENAME_PREFIX, f"{KEY_PREFIX}:"))}
+    for key, value in entries.items():
+        if key.startswith(FILENAME_PREFIX) and value in entries:
+            view[key[len(FILENAME_PREFIX):]] = entries[value]
+    return view
+
+def load_cache(path, raw=False):
+    """
+    Read a panel description cache into a plain `{filename: description}` dict.
+
+    Accepts any backend as well as the legacy JSON file, and falls back to the legacy
+    JSON file next to `path` when the cache has not been migrated yet. Descriptions
+    stored under content keys are listed under the filenames that alias them.
+
+    Args:
+        path (str): Path to the cache file.
+        raw (bool): Return the stored keys (content keys and aliases) instead.
+
+    Returns:
+        dict: The cached descriptions.
+    """
+    entries = read_entries(path)
+    return entries if raw else filename_view(entries)
+
+def read_entries(path):
+    if not os.path.exists(path) and os.path.exists(legacy_json_path(path)):
+        path = legacy_json_path(path)
+
+    extension = os.path.splitext(path)[1]
+    if extension == '.json':
+        with open(path, 'r') as f:
+            return json.load(f)
+    if extension in ('.sqlite', '.db'):
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return dict(connection.execute("SELECT key, value FROM descriptions"))
+        finally:
+            connection.close()
+
+    entries = {}
+    corrupt = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            record = decode_record(line)
+            if record is None:
+                corrupt += 1
+                continue
+            entries[record[0]] = record[1]
+    if corrupt:
+        print(f"Skipped {corrupt} corrupt records in {path}")
+    return entries
+
+def parse_arguments():
+    """
+    Parse command-line arguments for cache maintenance.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Maintain the panel description cache.")
+    parser.add_argument('command', choices=['migrate', 'compact', 'export'], help="Maintenance action to run.")
+    parser.add_argument('--cache', type=str, default='data/panel_description_cache.jsonl', help="Path to the cache file.")
+    parser.add_argument('--legacy', type=str, default=None, help="Legacy JSON cache to migrate from.")
+    parser.add_argument('--output', type=str, default=None, help="Destination of the exported JSON file (<cache>.export.json by default).")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+
+    if args.command == 'export':
+        # Not the legacy `.json` path, which is the file `migrate` reads from
+        output = args.output or os.path.splitext(args.cache)[0] + '.export.json'
+        with open(output, 'w') as f:
+            json.dump(load_cache(args.cache), f, indent=4)
+        print(f"Exported {args.cache} to {output}")
+        return
+
+    with open_cache(args.cache, migrate_from=args.legacy) as cache:
+        if args.command == 'compact':
+            cache.compact()
+        print(f"{args.cache}: {len(cache)} entries")
+
+if __name__ == "__main__":
+    main()
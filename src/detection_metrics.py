@@ -0,0 +1,283 @@
+# src/detection_metrics.py
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from dataset_splits import split_images, image_size, image_labels
+from prediction_store import PredictionStore
+from detectors import nms
+
+# The IoU thresholds of mAP@0.5:0.95
+MAP_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Pairwise IoU of two sets of xyxy boxes, broadcast over any leading dimensions.
+
+    Args:
+        boxes_a (np.ndarray): `(..., n, 4)` boxes.
+        boxes_b (np.ndarray): `(..., m, 4)` boxes.
+
+    Returns:
+        np.ndarray: `(..., n, m)` IoU matrix.
+    """
+    a = boxes_a[..., :, None, :]
+    b = boxes_b[..., None, :, :]
+    width = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    height = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = width * height
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return intersection / (area_a + area_b - intersection + 1e-9)
+
+def yolo_to_xyxy(labels, width, height):
+    """
+    Convert normalised `cx cy w h` rows to pixel xyxy boxes.
+    """
+    cx, cy, w, h = labels[:, 0] * width, labels[:, 1] * height, labels[:, 2] * width, labels[:, 3] * height
+    return np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+
+def load_ground_truth(image_paths):
+    """
+    Read the YOLO labels of the images as pixel xyxy boxes (sizes come from the image
+    headers, or from the split manifest along with the labels).
+
+    Returns:
+        list: One `(n, 4)` float array per image; images without a label file have no boxes.
+    """
+    ground_truth = []
+    for path in image_paths:
+        labels = image_labels(path)
+        boxes = np.zeros((0, 4), dtype=np.float64)
+        if len(labels):
+            boxes = yolo_to_xyxy(labels[:, 1:5].astype(np.float64), *image_size(path))
+        ground_truth.append(boxes)
+    return ground_truth
+
+def load_predictions(predictions_file, image_paths):
+    """
+    Read detections aligned to `image_paths`, either saved by `evaluate_on_soda.save_predictions`
+    or from the `<key>.json` manifest of a `prediction_store` entry.
+
+    Returns:
+        list: One `(n, 5)` array of `x1, y1, x2, y2, score` per image.
+    """
+    with open(predictions_file, 'r') as f:
+        stored = json.load(f)
+    if "images" in stored and "boxes" in stored:
+        root, filename = os.path.split(predictions_file)
+        entry = PredictionStore(root).load(filename.rsplit('.', 1)[0])
+        detections = entry.lookup(image_paths)
+        return [np.zeros((0, 5)) if boxes is None else boxes.astype(np.float64) for boxes in detections]
+    return [np.asarray(stored.get(os.path.basename(path), []), dtype=np.float64).reshape(-1, 5) for path in image_paths]
+
+def pad_batch(predictions, ground_truth, max_det=None):
+    """
+    Stack per-image predictions (sorted by decreasing score) and ground truth into padded arrays.
+
+    Returns:
+        tuple: `(I, P, 4)` predicted boxes, `(I, P)` scores (-inf for padding),
+        `(I, G, 4)` ground-truth boxes and `(I, G)` ground-truth mask.
+    """
+    sorted_predictions = [p[np.argsort(-p[:, 4], kind='stable')][:max_det] for p in predictions]
+    n_images = len(predictions)
+    max_predictions = max((len(p) for p in sorted_predictions), default=0)
+    max_ground_truth = max((len(g) for g in ground_truth), default=0)
+
+    pred_boxes = np.zeros((n_images, max_predictions, 4))
+    scores = np.full((n_images, max_predictions), -np.inf)
+    gt_boxes = np.zeros((n_images, max_ground_truth, 4))
+    gt_mask = np.zeros((n_images, max_ground_truth), dtype=bool)
+    for index, (p, g) in enumerate(zip(sorted_predictions, ground_truth)):
+        pred_boxes[index, :len(p)] = p[:, :4]
+        scores[index, :len(p)] = p[:, 4]
+        gt_boxes[index, :len(g)] = g
+        gt_mask[index, :len(g)] = True
+    return pred_boxes, scores, gt_boxes, gt_mask
+
+def match_predictions(pred_boxes, scores, gt_boxes, gt_mask, iou_thresholds):
+    """
+    Greedily match predictions to ground truth, by decreasing score, at every IoU threshold at once.
+
+    Each prediction takes the unmatched ground-truth box it overlaps most (COCO-style).
+    Since a prediction is matched before any lower-scoring one, the matches of the
+    predictions above a confidence threshold do not depend on the ones below it, so a
+    single matching gives exact results for every confidence threshold.
+
+    Args:
+        pred_boxes, scores, gt_boxes, gt_mask: The padded arrays of `pad_batch`.
+        iou_thresholds (np.ndarray): `(T,)` IoU thresholds.
+
+    Returns:
+        np.ndarray: `(T, I, P)` true-positive flags.
+    """
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    ious = np.where(gt_mask[:, None, :], box_iou(pred_boxes, gt_boxes), -1.0)
+    n_thresholds, (n_images, n_predictions, n_ground_truth) = len(iou_thresholds), ious.shape
+    matched = np.zeros((n_thresholds, n_images, n_ground_truth), dtype=bool)
+    true_positives = np.zeros((n_thresholds, n_images, n_predictions), dtype=bool)
+    if n_ground_truth == 0:
+        return true_positives
+
+    image_index = np.arange(n_images)[None, :]
+    threshold_index = np.arange(n_thresholds)[:, None]
+    for column in range(n_predictions):
+        candidates = (ious[None, :, column, :] >= iou_thresholds[:, None, None]) & ~matched
+        candidate_ious = np.where(candidates, ious[None, :, column, :], -1.0)
+        best = candidate_ious.argmax(axis=2)
+        hit = candidates.any(axis=2) & np.isfinite(scores[:, column])[None, :]
+        true_positives[:, :, column] = hit
+        matched[threshold_index, image_index, best] |= hit
+    return true_positives
+
+def average_precision(recall, precision):
+    """
+    Area under the precision envelope, sampled at 101 recall points as in ultralytics/COCO.
+
+    Args:
+        recall, precision (np.ndarray): `(T, N)` curves ordered by decreasing score.
+
+    Returns:
+        np.ndarray: `(T,)` average precisions.
+    """
+    n_thresholds = recall.shape[0]
+    recall = np.concatenate([np.zeros((n_thresholds, 1)), recall, np.ones((n_thresholds, 1))], axis=1)
+    precision = np.concatenate([np.ones((n_thresholds, 1)), precision, np.zeros((n_thresholds, 1))], axis=1)
+    envelope = np.flip(np.maximum.accumulate(np.flip(precision, axis=1), axis=1), axis=1)
+    samples = np.linspace(0, 1, 101)
+    interpolated = np.stack([np.interp(samples, r, p) for r, p in zip(recall, envelope)])
+    return ((interpolated[:, 1:] + interpolated[:, :-1]) / 2 * np.diff(samples)).sum(axis=1)
+
+def sweep(predictions, ground_truth, conf_thresholds, iou_thresholds, max_det=None):
+    """
+    Precision, recall and F1 over a confidence x IoU grid, plus mAP, from one matching pass.
+
+    Args:
+        predictions (list): Per-image `(n, 5)` xyxy + score arrays, stored at a low confidence.
+        ground_truth (list): Per-image `(m, 4)` xyxy arrays.
+        conf_thresholds (np.ndarray): `(C,)` confidence thresholds.
+        iou_thresholds (np.ndarray): `(T,)` IoU thresholds for a prediction to count as a match.
+        max_det (int): Keep only the top-scoring detections of each image.
+
+    Returns:
+        dict: `(T, C)` precision, recall and F1 grids, mAP@0.5 and mAP@0.5:0.95.
+    """
+    conf_thresholds = np.asarray(conf_thresholds, dtype=np.float64)
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    all_thresholds = np.concatenate([iou_thresholds, MAP_IOU_THRESHOLDS])
+
+    pred_boxes, scores, gt_boxes, gt_mask = pad_batch(predictions, ground_truth, max_det)
+    true_positives = match_predictions(pred_boxes, scores, gt_boxes, gt_mask, all_thresholds)
+
+    valid = np.isfinite(scores).ravel()
+    flat_scores = scores.ravel()[valid]
+    order = np.argsort(-flat_scores, kind='stable')
+    sorted_scores = flat_scores[order]
+    cumulative_tp = np.cumsum(true_positives.reshape(len(all_thresholds), -1)[:, valid][:, order], axis=1)
+    detections = np.arange(1, len(sorted_scores) + 1)
+    n_ground_truth = int(gt_mask.sum())
+
+    precision_curve = cumulative_tp / detections
+    recall_curve = cumulative_tp / max(n_ground_truth, 1)
+    ap = average_precision(recall_curve, precision_curve) if len(sorted_scores) else np.zeros(len(all_thresholds))
+
+    # Number of detections kept at each confidence threshold
+    kept = np.searchsorted(-sorted_scores, -conf_thresholds, side='right')
+    tp_at_conf = np.where(kept > 0, cumulative_tp[:len(iou_thresholds), np.maximum(kept - 1, 0)], 0)
+    precision = np.where(kept > 0, tp_at_conf / np.maximum(kept, 1), 0.0)
+    recall = tp_at_conf / max(n_ground_truth, 1)
+    f1 = np.where(precision + recall > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-12), 0.0)
+
+    map_ap = ap[len(iou_thresholds):]
+    return {
+        "conf_thresholds": conf_thresholds,
+        "iou_thresholds": iou_thresholds,
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "map50": float(map_ap[0]),
+        "map50_95": float(map_ap.mean()),
+        "images": len(predictions),
+        "ground_truth_boxes": n_ground_truth,
+        "predicted_boxes": int(valid.sum())
+    }
+
+def apply_nms(predictions, iou_threshold):
+    """
+    Re-run non-maximum suppression on stored predictions at a stricter IoU threshold.
+    """
+    return [p[nms(p[:, :4], p[:, 4], iou_threshold)] if len(p) else p for p in predictions]
+
+def best_cell(results):
+    """
+    The (IoU, conf) cell of the grid with the highest F1.
+    """
+    t, c = np.unravel_index(np.argmax(results["f1"]), results["f1"].shape)
+    return {
+        "iou": float(results["iou_thresholds"][t]),
+        "conf": float(results["conf_thresholds"][c]),
+        "precision": float(results["precision"][t, c]),
+        "recall": float(results["recall"][t, c]),
+        "f1": float(results["f1"][t, c])
+    }
+
+def to_json(results):
+    return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in results.items()}
+
+def parse_range(value):
+    """
+    Parse `start:stop:step` (inclusive of stop) or a comma-separated list of thresholds.
+    """
+    if ':' in value:
+        start, stop, step = (float(part) for part in value.split(':'))
+        return np.round(np.arange(start, stop + step / 2, step), 6)
+    return np.array([float(part) for part in value.split(',')])
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the threshold sweep.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Compute detection metrics over a grid of confidence and IoU thresholds from stored predictions.")
+    parser.add_argument('--predictions', type=str, required=True, help="Predictions saved by evaluate_on_soda.py --bucketed, or a prediction store manifest (runs/predictions/<key>.json).")
+    parser.add_argument('--data', type=str, default="data/source_data.yml", help="Path to the data YAML file.")
+    parser.add_argument('--split', type=str, default="test", help="Dataset split the predictions were made on.")
+    parser.add_argument('--conf', type=str, default="0.05:0.95:0.05", help="Confidence thresholds, as start:stop:step or a comma-separated list.")
+    parser.add_argument('--iou', type=str, default="0.5:0.95:0.05", help="Matching IoU thresholds, as start:stop:step or a comma-separated list.")
+    parser.add_argument('--nms_iou', type=str, default=None, help="Also re-apply NMS at these IoU thresholds (for NMS-based heads such as YOLOv8).")
+    parser.add_argument('--max_det', type=int, default=None, help="Maximum number of detections per image.")
+    parser.add_argument('--output', type=str, default=None, help="Write the grids to this JSON file.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    image_paths = split_images(args.data, args.split)
+    ground_truth = load_ground_truth(image_paths)
+    predictions = load_predictions(args.predictions, image_paths)
+    conf_thresholds, iou_thresholds = parse_range(args.conf), parse_range(args.iou)
+
+    report = []
+    for nms_iou in parse_range(args.nms_iou) if args.nms_iou else [None]:
+        start = time.perf_counter()
+        filtered = apply_nms(predictions, nms_iou) if nms_iou is not None else predictions
+        results = sweep(filtered, ground_truth, conf_thresholds, iou_thresholds, args.max_det)
+        elapsed = time.perf_counter() - start
+
+        best = best_cell(results)
+        label = f"NMS IoU {nms_iou:.2f}: " if nms_iou is not None else ""
+        print(f"{label}mAP50 {results['map50']:.4f}, mAP50-95 {results['map50_95']:.4f}; "
+              f"best F1 {best['f1']:.4f} (P {best['precision']:.4f}, R {best['recall']:.4f}) at conf {best['conf']:.2f}, IoU {best['iou']:.2f} "
+              f"[{len(conf_thresholds) * len(iou_thresholds)} points in {elapsed:.2f}s]")
+        report.append(dict(to_json(results), nms_iou=nms_iou, best=best, seconds=elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()
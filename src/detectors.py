@@ -0,0 +1,241 @@
+# src/detectors.py
+
+import os
+import numpy as np
+from PIL import Image
+
+def load_yolo(model_path, model_version=10):
+    """
+    Load a YOLO checkpoint with the class matching its version.
+
+    Args:
+        model_path (str): Path to the trained YOLO model file.
+        model_version (int): YOLO model version (e.g., 8, 10).
+    """
+    # Imported here so that the exported backends and the crop helpers do not need ultralytics
+    from ultralytics import YOLO, YOLOv10
+
+    if model_version < 10:
+        return YOLO(model_path)  # load the model for YOLOv8 and below
+    return YOLOv10(model_path)  # load the model for YOLOv10
+
+class YoloDetector:
+    """
+    Panel detector running a YOLO checkpoint through ultralytics.
+
+    `detect` takes a batch of PIL images and returns, for each of them, a float32
+    array of shape (n, 5) holding `x1, y1, x2, y2, score` in original pixel coordinates.
+    An optional `(height, width)` shape letterboxes the batch to a rectangle instead
+    of the `imgsz` square.
+    """
+
+    def __init__(self, model_path, model_version=10, imgsz=512, conf=0.3, iou=0.7, max_det=20, device="cpu", half=False):
+        self.model = load_yolo(model_path, model_version)
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+        self.device = device
+        self.half = half
+
+    def detect(self, images, shape=None):
+        results = self.model.predict(
+            images,
+            imgsz=list(shape) if shape else self.imgsz,
+            conf=self.conf,
+            iou=self.iou,
+            max_det=self.max_det,
+            device=self.device,
+            half=self.half,
+            verbose=False
+        )
+        detections = []
+        for result in results:
+            boxes = result.boxes.xyxy.cpu().numpy()
+            scores = result.boxes.conf.cpu().numpy()
+            detections.append(np.concatenate([boxes, scores[:, None]], axis=1).astype(np.float32))
+        return detections
+
+def letterbox(image, imgsz):
+    """
+    Resize a PIL image to fit an `imgsz` x `imgsz` square, or an `(height, width)`
+    rectangle, and pad it with grey, as ultralytics does.
+
+    Returns:
+        tuple: The float32 CHW array scaled to [0, 1], the resize ratio and the (x, y) padding.
+    """
+    target_height, target_width = (imgsz, imgsz) if isinstance(imgsz, int) else imgsz
+    width, height = image.size
+    ratio = min(target_width / width, target_height / height)
+    new_width, new_height = max(1, round(width * ratio)), max(1, round(height * ratio))
+    resized = image.convert("RGB").resize((new_width, new_height), Image.BILINEAR)
+    canvas = Image.new("RGB", (target_width, target_height), (114, 114, 114))
+    pad_x, pad_y = (target_width - new_width) // 2, (target_height - new_height) // 2
+    canvas.paste(resized, (pad_x, pad_y))
+    array = np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1) / 255.0
+    return array, ratio, (pad_x, pad_y)
+
+def nms(boxes, scores, iou_threshold):
+    """
+    Greedy non-maximum suppression on xyxy boxes; returns the kept indices by decreasing score.
+    """
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        x1 = np.maximum(boxes[best, 0], boxes[rest, 0])
+        y1 = np.maximum(boxes[best, 1], boxes[rest, 1])
+        x2 = np.minimum(boxes[best, 2], boxes[rest, 2])
+        y2 = np.minimum(boxes[best, 3], boxes[rest, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def crop_panels(image, detections):
+    """
+    Cut the detected panels out of a figure in memory.
+
+    Args:
+        image (PIL.Image.Image): The figure.
+        detections (np.ndarray): Array of shape (n, 5) with `x1, y1, x2, y2, score`.
+
+    Returns:
+        list: `(box, score, crop)` tuples with integer pixel boxes clipped to the figure.
+    """
+    width, height = image.size
+    panels = []
+    for x1, y1, x2, y2, score in detections:
+        box = (max(0, int(x1)), max(0, int(y1)), min(width, int(round(x2))), min(height, int(round(y2))))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            continue
+        panels.append((box, float(score), image.crop(box)))
+    return panels
+
+class ExportedDetector:
+    """
+    Shared pre- and post-processing for detectors exported from ultralytics.
+
+    Handles both output layouts: the NMS-free YOLOv10 head, shaped (batch, max_det, 6)
+    with `x1, y1, x2, y2, score, class`, and the YOLOv8 head, shaped
+    (batch, 4 + classes, anchors) with `cx, cy, w, h` followed by class scores,
+    which still needs NMS. Subclasses implement `_infer` for one input batch.
+    Rectangular batch shapes need a model exported with dynamic input dimensions.
+    """
+
+    def __init__(self, imgsz=512, conf=0.3, iou=0.7, max_det=20, fixed_batch=None, fixed_shape=False):
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+        self.fixed_batch = fixed_batch
+        self.fixed_shape = fixed_shape
+
+    def _infer(self, batch):
+        raise NotImplementedError
+
+    def _postprocess(self, output, ratio, padding, size):
+        if output.shape[-1] == 6:
+            predictions = output[output[:, 4] >= self.conf]
+            boxes, scores = predictions[:, :4], predictions[:, 4]
+            order = scores.argsort()[::-1][:self.max_det]
+        else:
+            predictions = output.T
+            class_scores = predictions[:, 4:]
+            scores = class_scores.max(axis=1)
+            predictions, scores = predictions[scores >= self.conf], scores[scores >= self.conf]
+            centers, sizes = predictions[:, :2], predictions[:, 2:4]
+            boxes = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+            order = nms(boxes, scores, self.iou)[:self.max_det]
+
+        boxes, scores = boxes[order].copy(), scores[order]
+        boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - padding[0]) / ratio).clip(0, size[0])
+        boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - padding[1]) / ratio).clip(0, size[1])
+        return np.concatenate([boxes, scores[:, None]], axis=1).astype(np.float32)
+
+    def detect(self, images, shape=None):
+        if shape and self.fixed_shape and tuple(shape) != (self.imgsz, self.imgsz):
+            raise ValueError(f"The model was exported with a static {self.imgsz}x{self.imgsz} input; export it with --dynamic to use rectangular batches")
+        prepared = [letterbox(image, tuple(shape) if shape else self.imgsz) for image in images]
+        step = self.fixed_batch or max(len(prepared), 1)
+        detections = []
+        for start in range(0, len(prepared), step):
+            chunk = prepared[start:start + step]
+            outputs = self._infer(np.stack([array for array, _, _ in chunk]))
+            for output, (_, ratio, padding), image in zip(outputs, chunk, images[start:start + step]):
+                detections.append(self._postprocess(output, ratio, padding, image.size))
+        return detections
+
+class OnnxDetector(ExportedDetector):
+    """
+    Panel detector running an exported ONNX model with ONNX Runtime on CPU.
+
+    Args:
+        model_path (str): Path to the `.onnx` file.
+        intra_op_threads (int): Threads used inside each operator; 0 lets ONNX Runtime decide.
+    """
+
+    def __init__(self, model_path, imgsz=512, conf=0.3, iou=0.7, max_det=20, intra_op_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+        shape = self.session.get_inputs()[0].shape
+        fixed_batch = shape[0] if isinstance(shape[0], int) else None
+        fixed_shape = isinstance(shape[2], int)
+        if fixed_shape:
+            imgsz = shape[2]
+        super().__init__(imgsz=imgsz, conf=conf, iou=iou, max_det=max_det, fixed_batch=fixed_batch, fixed_shape=fixed_shape)
+
+    def _infer(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+class OpenVinoDetector(ExportedDetector):
+    """
+    Panel detector running an exported OpenVINO model on CPU.
+
+    Args:
+        model_path (str): The `*_openvino_model` directory or its `.xml` file.
+        intra_op_threads (int): Inference threads; 0 lets OpenVINO decide.
+    """
+
+    def __init__(self, model_path, imgsz=512, conf=0.3, iou=0.7, max_det=20, intra_op_threads=0):
+        import openvino
+
+        if os.path.isdir(model_path):
+            model_path = next(os.path.join(model_path, f) for f in os.listdir(model_path) if f.endswith(".xml"))
+        core = openvino.Core()
+        model = core.read_model(model_path)
+        config = {"INFERENCE_NUM_THREADS": intra_op_threads} if intra_op_threads else {}
+        self.compiled_model = core.compile_model(model, "CPU", config)
+        self.output = self.compiled_model.output(0)
+
+        shape = model.input(0).get_partial_shape()
+        fixed_batch = shape[0].get_length() if shape[0].is_static else None
+        fixed_shape = shape[2].is_static
+        if fixed_shape:
+            imgsz = shape[2].get_length()
+        super().__init__(imgsz=imgsz, conf=conf, iou=iou, max_det=max_det, fixed_batch=fixed_batch, fixed_shape=fixed_shape)
+
+    def _infer(self, batch):
+        return self.compiled_model(batch)[self.output]
+
+def load_detector(model_path, model_version=10, imgsz=512, conf=0.3, iou=0.7, max_det=20, device="cpu", intra_op_threads=0):
+    """
+    Load the detector backend matching a model file.
+
+    `.onnx` files run on ONNX Runtime, OpenVINO exports (`*_openvino_model` directories
+    or `.xml` files) on OpenVINO, and anything else is loaded as a PyTorch checkpoint.
+    """
+    if model_path.endswith(".onnx"):
+        return OnnxDetector(model_path, imgsz=imgsz, conf=conf, iou=iou, max_det=max_det, intra_op_threads=intra_op_threads)
+    if model_path.rstrip("/").endswith("_openvino_model") or model_path.endswith(".xml"):
+        return OpenVinoDetector(model_path, imgsz=imgsz, conf=conf, iou=iou, max_det=max_det, intra_op_threads=intra_op_threads)
+    return YoloDetector(model_path, model_version, imgsz=imgsz, conf=conf, iou=iou, max_det=max_det, device=device)
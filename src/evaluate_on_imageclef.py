@@ -1,38 +1,110 @@
+import argparse
 import shutil
 import os
 from ultralytics import YOLOv10
+from evaluate_on_soda import predict_bucketed, report_batching, save_predictions, validate
+from prediction_store import PredictionStore
+from instrumentation import stage, recording
 
-# Load the model
-model = YOLOv10("/app/runs/soda_figure_segmentation/train/weights/best.pt")
-
-# Validate the model
-metrics = model.val(
-    data="data/imageCLEF_data.yml",
-    imgsz=512,
-    batch=32,
-    conf=0.8,
-    iou=0.3,
-    # device=device_str,
-    save_json=True,
-    max_det=20,
-    half=True,
-    dnn=True,
-    plots=True,
-    rect=True,
-    split="val"
-    )
-
-# Define the source and destination directories
-source_dir = "runs/detect"
-destination_dir = "runs/imageCLEF"
-
-# Check if the source directory exists
-if os.path.exists(source_dir):
-    # Rename the directory
-    shutil.move(source_dir, destination_dir)
-    print(f"Renamed '{source_dir}' to '{destination_dir}'")
-else:
-    print(f"The directory '{source_dir}' does not exist")
-
-# Print metrics
-print(metrics)
+def evaluate_model(model_path, data_yaml, img_size, batch_size, conf_threshold, iou_threshold, max_det, split, store=None):
+    # Load the model
+    model = YOLOv10(model_path)
+
+    # Validate the model, reading the detections from the prediction store when it has them all
+    with stage("model_val"):
+        metrics = validate(
+            model,
+            model_path,
+            data_yaml,
+            split,
+            store=store,
+            imgsz=img_size,
+            batch=batch_size,
+            conf=conf_threshold,
+            iou=iou_threshold,
+            # device=device_str,
+            save_json=True,
+            max_det=max_det,
+            half=True,
+            dnn=True,
+            plots=True,
+            rect=True
+            )
+    return metrics
+
+def rename_output_folder():
+    # Define the source and destination directories
+    source_dir = "runs/detect"
+    destination_dir = "runs/imageCLEF"
+
+    # Check if the source directory exists
+    if os.path.exists(source_dir):
+        # Rename the directory
+        shutil.move(source_dir, destination_dir)
+        print(f"Renamed '{source_dir}' to '{destination_dir}'")
+    else:
+        print(f"The directory '{source_dir}' does not exist")
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the ImageCLEF evaluation.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Evaluate the trained YOLO model on the ImageCLEF 2016 figure separation set.")
+    parser.add_argument('--model', type=str, default="/app/runs/soda_figure_segmentation/train/weights/best.pt", help="Path to the trained YOLO model file.")
+    parser.add_argument('--data', type=str, default="data/imageCLEF_data.yml", help="Path to the data YAML file.")
+    parser.add_argument('--imgsz', type=int, default=512, help="Image size for validation.")
+    parser.add_argument('--batch', type=int, default=32, help="Batch size for validation.")
+    parser.add_argument('--conf', type=float, default=0.8, help="Confidence threshold for predictions.")
+    parser.add_argument('--iou', type=float, default=0.3, help="IoU threshold for evaluation.")
+    parser.add_argument('--max_det', type=int, default=20, help="Maximum number of detections per image.")
+    parser.add_argument('--split', type=str, default="val", help="Dataset split to use for validation.")
+    parser.add_argument('--device', type=str, default="0", help="Device to use for --bucketed predictions.")
+    parser.add_argument('--bucketed', action='store_true', help="Predict in aspect-ratio bucketed batches instead of running model.val().")
+    parser.add_argument('--bucket_step', type=int, default=64, help="Granularity of the bucket shapes in pixels.")
+    parser.add_argument('--predictions', type=str, default="runs/imageCLEF/bucketed_predictions.json", help="Where --bucketed saves the detections.")
+    parser.add_argument('--prediction_store', type=str, default="runs/predictions", help="Directory where the evaluation keeps raw detections and reuses them on reruns.")
+    parser.add_argument('--store_conf', type=float, default=0.01, help="Confidence down to which --bucketed keeps detections in the prediction store.")
+    parser.add_argument('--no_store', action='store_true', help="Always run inference and do not keep the raw detections.")
+    parser.add_argument('--metrics', type=str, default=None, help="Record per-stage timings and store hit ratios and write them to this file (.prom for the Prometheus text format, JSON otherwise).")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    with recording(args.metrics):
+        run_evaluation(args)
+
+def run_evaluation(args):
+
+    if args.bucketed:
+        image_paths, detections, stats = predict_bucketed(
+            model_path=args.model,
+            data_yaml=args.data,
+            img_size=args.imgsz,
+            batch_size=args.batch,
+            conf_threshold=args.conf,
+            iou_threshold=args.iou,
+            device=args.device,
+            max_det=args.max_det,
+            split=args.split,
+            model_version=10,
+            bucket_step=args.bucket_step,
+            store=None if args.no_store else PredictionStore(args.prediction_store),
+            store_conf=args.store_conf
+        )
+        save_predictions(args.predictions, image_paths, detections)
+        report_batching(image_paths, args.imgsz, args.batch, args.bucket_step, stats)
+        return
+
+    metrics = evaluate_model(args.model, args.data, args.imgsz, args.batch, args.conf, args.iou, args.max_det, args.split,
+                             store=None if args.no_store else PredictionStore(args.prediction_store))
+    rename_output_folder()
+
+    # Print metrics
+    print(metrics)
+
+if __name__ == "__main__":
+    main()
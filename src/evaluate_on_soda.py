@@ -1,10 +1,101 @@
 import argparse
 import os
+import json
 import shutil
 from ultralytics import YOLO, YOLOv10
 import torch
+import numpy as np
+from aspect_batching import AspectRatioBatcher, compare_modes
+from dataset_splits import split_images, split_images_dir
+from detectors import load_detector
+from detection_metrics import load_ground_truth, sweep
+from prediction_store import PredictionStore
+from instrumentation import stage, count, recording
 
-def evaluate_model(model_path, data_yaml, img_size, batch_size, conf_threshold, iou_threshold, device, save_json, max_det, half, dnn, plots, rect, split, model_version):
+# `model.val()` arguments that change the detections, and so the prediction store key
+VAL_SETTINGS = ("imgsz", "batch", "conf", "iou", "max_det", "half", "dnn", "rect")
+
+def store_settings(data_yaml, split, **settings):
+    """
+    Prediction store settings of a run over a split: the images directory is part of
+    the key, so that images of the same name in two splits or datasets do not collide.
+    """
+    return dict(settings, images_dir=os.path.abspath(split_images_dir(data_yaml, split)))
+
+def recording_validator(model, detections):
+    """
+    The validator class of `model`, extended to keep the detections it scores in
+    `detections` as `{image basename: (n, 5) xyxy + score array}` in original pixels.
+    """
+    base = model.task_map[model.task]["validator"]
+
+    class RecordingValidator(base):
+        def update_metrics(self, preds, batch):
+            super().update_metrics(preds, batch)
+            for si, pred in enumerate(preds):
+                predn = self._prepare_pred(pred, self._prepare_batch(si, batch))
+                detections[os.path.basename(batch["im_file"][si])] = predn[:, :5].float().cpu().numpy()
+
+    return RecordingValidator
+
+def validate(model, model_path, data_yaml, split, model_version=10, store=None, **val_args):
+    """
+    Run `model.val()` on a split, through a prediction store.
+
+    With a `store`, the detections scored by the validator are kept under a key made of
+    the checkpoint hash, the validation settings and the images directory. When the
+    store already holds unchanged detections of every image of the split for that key,
+    inference is skipped and the metrics are computed from them with `detection_metrics`.
+
+    Args:
+        model: The loaded YOLO model.
+        model_path (str): Path to the model file, hashed into the store key.
+        data_yaml (str): Path to the data YAML file.
+        split (str): Dataset split to validate on.
+        model_version (int): YOLO model version, part of the store key.
+        store (PredictionStore): Where to read and keep the detections.
+        **val_args: Forwarded to `model.val()`.
+
+    Returns:
+        The ultralytics metrics, or a dict with mAP@0.5, mAP@0.5:0.95 and the precision
+        and recall at IoU 0.5 and `conf` when read from the store.
+    """
+    if store is None:
+        return model.val(data=data_yaml, split=split, **val_args)
+
+    image_paths = split_images(data_yaml, split)
+    settings = store_settings(data_yaml, split, mode="val", model_version=model_version,
+                              **{name: val_args[name] for name in VAL_SETTINGS if name in val_args})
+    with stage("prediction_store_read"):
+        key = store.key(model_path, settings)
+        stored = store.load(key)
+        detections = stored.lookup(image_paths) if stored is not None else [None] * len(image_paths)
+    missing = sum(1 for boxes in detections if boxes is None)
+    count("prediction_store_hits", len(image_paths) - missing)
+    count("prediction_store_misses", missing)
+
+    if image_paths and not missing:
+        print(f"Read the detections of all {len(image_paths)} images from the prediction store; model.val() skipped")
+        with stage("store_metrics"):
+            results = sweep([boxes.astype(np.float64) for boxes in detections], load_ground_truth(image_paths),
+                            [val_args.get("conf") or 0.001], [0.5], val_args.get("max_det"))
+        return {
+            "map50": results["map50"],
+            "map50_95": results["map50_95"],
+            "precision50": float(results["precision"][0, 0]),
+            "recall50": float(results["recall"][0, 0]),
+            "images": results["images"]
+        }
+
+    recorded = {}
+    results = model.val(data=data_yaml, split=split, validator=recording_validator(model, recorded), **val_args)
+    scored = [path for path in image_paths if os.path.basename(path) in recorded]
+    with stage("prediction_store_write"):
+        store.save(key, scored, [recorded[os.path.basename(path)] for path in scored], {"model": model_path, "settings": settings})
+    print(f"Kept the detections of {len(scored)} images in the prediction store")
+    return results
+
+def evaluate_model(model_path, data_yaml, img_size, batch_size, conf_threshold, iou_threshold, device, save_json, max_det, half, dnn, plots, rect, split, model_version, store=None):
     """
     Evaluate a trained YOLO model on a given dataset.
 
@@ -24,6 +115,8 @@ def evaluate_model(model_path, data_yaml, img_size, batch_size, conf_threshold,
         rect (bool): Whether to use rectangular training.
         split (str): Dataset split to use for validation.
         model_version (int): YOLO model version to use (e.g., 8, 10).
+        store (PredictionStore): Where to keep the detections, and read them instead of
+            running inference when every image of the split is stored.
     """
     if model_version < 10:
         model = YOLO(model_path)  # load the model for YOLOv8 and below
@@ -40,24 +133,105 @@ def evaluate_model(model_path, data_yaml, img_size, batch_size, conf_threshold,
         torch.cuda.set_device(int(device))
 
     # Evaluate the model
-    results = model.val(
-        data=data_yaml,
-        imgsz=img_size,
-        batch=batch_size,
-        conf=conf_threshold,
-        iou=iou_threshold,
-        device=device_str,
-        save_json=save_json,
-        max_det=max_det,
-        half=half,
-        dnn=dnn,
-        plots=plots,
-        rect=rect,
-        split=split
-    )
+    with stage("model_val"):
+        results = validate(
+            model,
+            model_path,
+            data_yaml,
+            split,
+            model_version=model_version,
+            store=store,
+            imgsz=img_size,
+            batch=batch_size,
+            conf=conf_threshold,
+            iou=iou_threshold,
+            device=device_str,
+            save_json=save_json,
+            max_det=max_det,
+            half=half,
+            dnn=dnn,
+            plots=plots,
+            rect=rect
+        )
     
     return results
 
+def predict_bucketed(model_path, data_yaml, img_size, batch_size, conf_threshold, iou_threshold, device, max_det, split, model_version, bucket_step, store=None, store_conf=0.01):
+    """
+    Run the model over a split in aspect-ratio bucketed batches.
+
+    With a `store`, the detections are kept down to `store_conf` under a key made of the
+    checkpoint hash, the preprocessing settings and the images directory; images already in the store for that
+    key are not predicted again, and `conf_threshold` is applied when reading.
+
+    Args:
+        model_path (str): Path to the trained YOLO model file or its ONNX/OpenVINO export.
+        data_yaml (str): Path to the data YAML file.
+        img_size (int): Longest side of the inputs.
+        batch_size (int): Batch size.
+        conf_threshold (float): Confidence threshold for predictions.
+        iou_threshold (float): IoU threshold for non-maximum suppression.
+        device (str): Device to use ('cpu' or a CUDA index).
+        max_det (int): Maximum number of detections per image.
+        split (str): Dataset split to predict on.
+        model_version (int): YOLO model version to use (e.g., 8, 10).
+        bucket_step (int): Granularity of the bucket shapes in pixels.
+        store (PredictionStore): Where to read and keep the raw detections.
+        store_conf (float): Confidence down to which detections are stored.
+
+    Returns:
+        tuple: The image paths, their detections and the batching stats.
+    """
+    image_paths = split_images(data_yaml, split)
+    detections = [None] * len(image_paths)
+    stats = {"mode": "stored", "batches": 0, "padding_ratio": 0.0}
+    predict_conf = conf_threshold
+
+    if store is not None:
+        predict_conf = min(conf_threshold, store_conf)
+        settings = store_settings(data_yaml, split, imgsz=img_size, iou=iou_threshold, max_det=max_det, conf=predict_conf,
+                                  model_version=model_version, bucket_step=bucket_step)
+        with stage("prediction_store_read"):
+            key = store.key(model_path, settings)
+            stored = store.load(key)
+            if stored is not None:
+                detections = stored.lookup(image_paths)
+
+    missing = [index for index, boxes in enumerate(detections) if boxes is None]
+    if store is not None:
+        count("prediction_store_hits", len(image_paths) - len(missing))
+        count("prediction_store_misses", len(missing))
+    if missing:
+        device_str = f"cuda:{device}" if device.lower() != "cpu" else "cpu"
+        detector = load_detector(model_path, model_version, imgsz=img_size, conf=predict_conf, iou=iou_threshold, max_det=max_det, device=device_str)
+        missing_paths = [image_paths[index] for index in missing]
+        predicted, stats = AspectRatioBatcher(img_size, batch_size, bucket_step).run(detector, missing_paths)
+        for index, boxes in zip(missing, predicted):
+            detections[index] = boxes
+        if store is not None:
+            with stage("prediction_store_write"):
+                store.merge(key, missing_paths, predicted, {"model": model_path, "settings": settings})
+    print(f"Predicted {len(missing)} images, read {len(image_paths) - len(missing)} from the prediction store")
+
+    detections = [boxes[boxes[:, 4] >= conf_threshold] for boxes in detections]
+    return image_paths, detections, stats
+
+def report_batching(image_paths, img_size, batch_size, bucket_step, bucketed_stats):
+    """
+    Print the padding of the square and rect modes next to the bucketed run.
+    """
+    for stats in compare_modes(image_paths, img_size, batch_size, bucket_step)[:2] + [bucketed_stats]:
+        throughput = f", {stats['images_per_second']:.2f} images/s" if "images_per_second" in stats else ""
+        print(f"{stats['mode']:>9}: {stats['batches']} batches, {stats['padding_ratio']:.1%} padding{throughput}")
+
+def save_predictions(output_file, image_paths, detections):
+    """
+    Save the detections as `{image: [[x1, y1, x2, y2, score], ...]}`.
+    """
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump({os.path.basename(path): boxes.tolist() for path, boxes in zip(image_paths, detections)}, f)
+
 def rename_output_folder():
     """
     Rename the default output folder 'runs/detect' to 'runs/soda'.
@@ -93,6 +267,13 @@ def parse_arguments():
     parser.add_argument('--rect', action='store_true', help="Use rectangular training.")
     parser.add_argument('--split', type=str, default="test", help="Dataset split to use for validation.")
     parser.add_argument('--model_version', type=int, default=10, help="YOLO model version to use (e.g., 8, 10).")
+    parser.add_argument('--bucketed', action='store_true', help="Predict in aspect-ratio bucketed batches instead of running model.val().")
+    parser.add_argument('--bucket_step', type=int, default=64, help="Granularity of the bucket shapes in pixels.")
+    parser.add_argument('--predictions', type=str, default="runs/soda/bucketed_predictions.json", help="Where --bucketed saves the detections.")
+    parser.add_argument('--prediction_store', type=str, default="runs/predictions", help="Directory where the evaluation keeps raw detections and reuses them on reruns.")
+    parser.add_argument('--store_conf', type=float, default=0.01, help="Confidence down to which --bucketed keeps detections in the prediction store.")
+    parser.add_argument('--no_store', action='store_true', help="Always run inference and do not keep the raw detections.")
+    parser.add_argument('--metrics', type=str, default=None, help="Record per-stage timings and store hit ratios and write them to this file (.prom for the Prometheus text format, JSON otherwise).")
 
     return parser.parse_args()
 
@@ -101,6 +282,30 @@ def main():
     Main function to evaluate the YOLO model on the SODA dataset.
     """
     args = parse_arguments()
+    with recording(args.metrics):
+        run_evaluation(args)
+
+def run_evaluation(args):
+    if args.bucketed:
+        image_paths, detections, stats = predict_bucketed(
+            model_path=args.model,
+            data_yaml=args.data,
+            img_size=args.imgsz,
+            batch_size=args.batch,
+            conf_threshold=args.conf,
+            iou_threshold=args.iou,
+            device=args.device,
+            max_det=args.max_det,
+            split=args.split,
+            model_version=args.model_version,
+            bucket_step=args.bucket_step,
+            store=None if args.no_store else PredictionStore(args.prediction_store),
+            store_conf=args.store_conf
+        )
+        save_predictions(args.predictions, image_paths, detections)
+        report_batching(image_paths, args.imgsz, args.batch, args.bucket_step, stats)
+        return
+
     results = evaluate_model(
         model_path=args.model,
         data_yaml=args.data,
@@ -116,7 +321,8 @@ def main():
         plots=args.plots,
         rect=args.rect,
         split=args.split,
-        model_version=args.model_version
+        model_version=args.model_version,
+        store=None if args.no_store else PredictionStore(args.prediction_store)
     )
     
     print("Evaluation results:", results)
@@ -0,0 +1,142 @@
+# src/evaluation_shards.py
+
+import os
+import json
+import hashlib
+from prediction_store import image_signature
+from content_keys import text_hash
+
+def parse_shard(value):
+    """
+    `(index, count)` of a shard given as "i/N", with `0 <= i < N`.
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{value}', expected i/N (e.g. 0/4)")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{value}', the index must be between 0 and {count - 1}")
+    return index, count
+
+def shard_of(figure_id, count):
+    """
+    Shard of a figure, from a hash of its id so that every process and node agrees on it.
+    """
+    return int(hashlib.sha1(figure_id.encode('utf-8')).hexdigest()[:8], 16) % count
+
+def shard_path(shard_dir, index, count, suffix="json"):
+    return os.path.join(shard_dir, f"shard_{index:04d}_of_{count:04d}.{suffix}")
+
+def inputs_fingerprint(panels, settings):
+    """
+    Digest of everything a shard's results depend on: the panel crops (name, size and
+    mtime), their captions, the prompt version and the evaluation settings.
+
+    Args:
+        panels (list): Panels of the shard as returned by `collect_panels`.
+        settings (dict): JSON-serialisable settings that decide the predicted labels.
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for panel in sorted(panels, key=lambda panel: panel['filename']):
+        size, mtime = image_signature(panel['image_path'])
+        digest.update(f"{panel['filename']}\0{size}\0{mtime}\0{text_hash(panel['caption'])}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def load_shard(shard_dir, index, count):
+    path = shard_path(shard_dir, index, count)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+def is_current(result, fingerprint):
+    """
+    Whether a stored shard result is complete and was computed from the same inputs.
+    """
+    return result is not None and result["fingerprint"] == fingerprint and not result["counts"]["missing"]
+
+def write_shard(shard_dir, index, count, fingerprint, outcomes, failures):
+    """
+    Store the results of a shard: its counts and per-panel outcomes as JSON, and its
+    mismatched panels as JSONL next to it. Both are replaced atomically, the results
+    last, so a shard that crashed while writing is simply run again.
+
+    Args:
+        shard_dir (str): Directory of the shard files.
+        index (int): Shard index.
+        count (int): Number of shards.
+        fingerprint (str): As returned by `inputs_fingerprint`.
+        outcomes (list): `{"filename", "expected", "predicted", "described"}` per panel;
+            panels that have no description yet are not `described` and not scored.
+        failures (list): One record per mismatched panel.
+
+    Returns:
+        dict: The stored shard result.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    failures_path = shard_path(shard_dir, index, count, "failures.jsonl")
+    with open(failures_path + '.tmp', 'w') as f:
+        for failure in failures:
+            f.write(json.dumps(failure) + '\n')
+    os.replace(failures_path + '.tmp', failures_path)
+
+    scored = [outcome for outcome in outcomes if outcome["described"]]
+    counts = {
+        "panels": len(outcomes),
+        "total": len(scored),
+        "correct": sum(outcome["predicted"] == outcome["expected"] for outcome in scored),
+        "false_positives": sum(bool(outcome["predicted"]) and outcome["predicted"] != outcome["expected"] for outcome in scored),
+        "false_negatives": sum(not outcome["predicted"] for outcome in scored),
+        "missing": len(outcomes) - len(scored)
+    }
+    result = {"shard": index, "shards": count, "fingerprint": fingerprint, "counts": counts, "outcomes": outcomes}
+    path = shard_path(shard_dir, index, count)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+    return result
+
+def merge_shards(shard_dir, count, fingerprints=None):
+    """
+    Combine the results of the `count` shards of a run.
+
+    Args:
+        shard_dir (str): Directory of the shard files.
+        count (int): Number of shards.
+        fingerprints (dict): Current input fingerprint of every shard index; shards
+            computed from other inputs are reported as stale.
+
+    Returns:
+        tuple: The merged results (accuracy, false positives and negatives and panel
+        counts), or None if some shards are missing or stale, and the list of
+        `(index, reason)` of the shards to run again. Shards with panels that had no
+        description are merged, and listed to be run again as well.
+    """
+    totals = {"panels": 0, "total": 0, "correct": 0, "false_positives": 0, "false_negatives": 0, "missing": 0}
+    rerun = []
+    complete = True
+    for index in range(count):
+        result = load_shard(shard_dir, index, count)
+        if result is None or (fingerprints is not None and result["fingerprint"] != fingerprints[index]):
+            rerun.append((index, "missing" if result is None else "stale"))
+            complete = False
+            continue
+        if result["counts"]["missing"]:
+            rerun.append((index, f"{result['counts']['missing']} panels without a description"))
+        for key in totals:
+            totals[key] += result["counts"][key]
+    if not complete:
+        return None, rerun
+
+    results = {
+        "accuracy": totals["correct"] / totals["total"] if totals["total"] > 0 else 0,
+        "false_positives": totals["false_positives"],
+        "false_negatives": totals["false_negatives"],
+        "panels": totals["total"],
+        "missing": totals["missing"],
+        "shards": count
+    }
+    return results, rerun
@@ -0,0 +1,137 @@
+# src/export_detector.py
+
+import os
+import random
+import argparse
+from PIL import Image
+from detectors import load_yolo, letterbox
+from dataset_splits import split_images
+
+def calibration_reader(image_paths, input_name, imgsz):
+    """
+    A reader feeding letterboxed calibration images to ONNX Runtime's static quantizer one at a time.
+    """
+    # Imported here so that OpenVINO exports do not need onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class LetterboxCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self.image_paths = iter(image_paths)
+
+        def get_next(self):
+            path = next(self.image_paths, None)
+            if path is None:
+                return None
+            with Image.open(path) as image:
+                array, _, _ = letterbox(image, imgsz)
+            return {input_name: array[None]}
+
+    return LetterboxCalibrationReader()
+
+def quantize_onnx(onnx_path, output_path, calibration_images, imgsz):
+    """
+    Quantize an exported ONNX detector to INT8 with static (QDQ) quantization.
+
+    Args:
+        onnx_path (str): Path to the FP32 `.onnx` file.
+        output_path (str): Destination of the INT8 model.
+        calibration_images (list): Images used to calibrate the activation ranges.
+        imgsz (int): Input size the model was exported with.
+
+    Returns:
+        str: The path of the quantized model.
+    """
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    prepared_path = onnx_path.replace('.onnx', '_prepared.onnx')
+    quant_pre_process(onnx_path, prepared_path)
+
+    input_name = onnxruntime.InferenceSession(prepared_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    quantize_static(
+        prepared_path,
+        output_path,
+        calibration_reader(calibration_images, input_name, imgsz),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8
+    )
+    os.remove(prepared_path)
+    return output_path
+
+def export_model(model_path, export_format, img_size, model_version, data_yaml, split, int8, calibration_images, dynamic):
+    """
+    Export a trained YOLO model for CPU inference.
+
+    Args:
+        model_path (str): Path to the trained YOLO model file.
+        export_format (str): 'onnx' or 'openvino'.
+        img_size (int): Input size of the exported model.
+        model_version (int): YOLO model version (e.g., 8, 10).
+        data_yaml (str): Data YAML file providing the INT8 calibration images.
+        split (str): Split used for calibration.
+        int8 (bool): Also produce an INT8 quantized variant.
+        calibration_images (int): Number of calibration images for INT8 quantization.
+        dynamic (bool): Export with dynamic batch and input dimensions (ONNX only), as
+            needed for the rectangular batches of `aspect_batching`.
+
+    Returns:
+        list: Paths of the exported models.
+    """
+    model = load_yolo(model_path, model_version)
+
+    if export_format == 'openvino':
+        exported = [model.export(format='openvino', imgsz=img_size)]
+        if int8:
+            # ultralytics runs NNCF post-training quantization on the data YAML
+            exported.append(model.export(format='openvino', imgsz=img_size, int8=True, data=data_yaml))
+        return exported
+
+    onnx_path = model.export(format='onnx', imgsz=img_size, dynamic=dynamic, simplify=True)
+    exported = [onnx_path]
+    if int8:
+        images = split_images(data_yaml, split)
+        random.Random(0).shuffle(images)
+        exported.append(quantize_onnx(onnx_path, onnx_path.replace('.onnx', '_int8.onnx'), images[:calibration_images], img_size))
+    return exported
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the model export.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Export a trained YOLO model to ONNX or OpenVINO for CPU inference.")
+    parser.add_argument('--model', type=str, default="runs/soda_figure_segmentation/train/weights/best.pt", help="Path to the trained YOLO model file.")
+    parser.add_argument('--format', type=str, default="onnx", choices=["onnx", "openvino"], help="Export format.")
+    parser.add_argument('--imgsz', type=int, default=512, help="Input size of the exported model.")
+    parser.add_argument('--model_version', type=int, default=10, help="YOLO model version to use (e.g., 8, 10).")
+    parser.add_argument('--int8', action='store_true', help="Also export an INT8 quantized variant.")
+    parser.add_argument('--data', type=str, default="data/source_data.yml", help="Data YAML file providing the calibration images.")
+    parser.add_argument('--split', type=str, default="val", help="Dataset split used for calibration.")
+    parser.add_argument('--calibration_images', type=int, default=200, help="Number of images used for INT8 calibration.")
+    parser.add_argument('--dynamic', action='store_true', help="Export with dynamic batch and input dimensions (ONNX only).")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    exported = export_model(
+        model_path=args.model,
+        export_format=args.format,
+        img_size=args.imgsz,
+        model_version=args.model_version,
+        data_yaml=args.data,
+        split=args.split,
+        int8=args.int8,
+        calibration_images=args.calibration_images,
+        dynamic=args.dynamic
+    )
+    for path in exported:
+        print(f"Exported {path}")
+
+if __name__ == "__main__":
+    main()
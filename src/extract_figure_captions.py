@@ -1,22 +1,134 @@
 # src/extract_figure_captions.py
 
+import os
+import re
 import json
+import html
+import time
 import argparse
+import resource
+import tempfile
+import multiprocessing
+from html.entities import name2codepoint
 from bs4 import BeautifulSoup
-import os
+from caption_store import write_index, load_index
+
+# Start and end tags, with quoted attribute values possibly containing '>'
+TAG = re.compile(r'</?[a-zA-Z][^<>"\'=]*(?:=\s*(?:"[^"<]*"|\'[^\'<]*\'|[^\s"\'<>=`]+)[^<>"\'=]*)*>')
+# Anything html.parser would treat as markup once the simple tags are gone
+MARKUP = re.compile(r'<[a-zA-Z/!?]')
+# Elements whose content html.parser or BeautifulSoup do not treat as regular text
+SPECIAL = re.compile(r'<(?:script|style|textarea|title|xmp|iframe|noembed|noframes|noscript|plaintext|pre)\b', re.IGNORECASE)
+REFERENCE = re.compile(r'&(?:#(\d+)|#[xX]([0-9a-fA-F]+)|([a-zA-Z][a-zA-Z0-9]*));?')
+ASCII_SPACES = ' \n\t\x0c\r'
 
-def extract_captions(input_json, output_jsonl):
+def simple_references(text):
     """
-    Extract figure captions from the annotated JSON file and save to a JSONL file.
+    Whether every character reference in `text` is terminated and decodes the same way
+    in `html.unescape` as in BeautifulSoup (which maps e.g. `&#150;` through windows-1252).
+    """
+    for match in REFERENCE.finditer(text):
+        if not match.group(0).endswith(';'):
+            return False
+        decimal, hexadecimal, name = match.groups()
+        if name is not None:
+            if name not in name2codepoint:
+                return False
+            continue
+        codepoint = int(decimal) if decimal is not None else int(hexadecimal, 16)
+        if codepoint < 32 or 127 <= codepoint < 160 or 0xD800 <= codepoint < 0xE000 or codepoint > 0x10FFFF:
+            return False
+    return True
+
+def text_node(segment):
+    # BeautifulSoup collapses strings made only of ASCII whitespace to a single newline or space
+    text = html.unescape(segment)
+    if text and not text.strip(ASCII_SPACES):
+        return '\n' if '\n' in text else ' '
+    return text
+
+def strip_html(raw_caption):
+    """
+    Plain text of an HTML caption, identical to `BeautifulSoup(raw_caption, 'html.parser').get_text()`.
+
+    Captions made of plain tags and well-formed references are stripped with a regular
+    expression; anything else (comments, declarations, raw-text or whitespace-preserving
+    elements, unusual references) goes through BeautifulSoup.
+    """
+    if '<' not in raw_caption and '&' not in raw_caption:
+        return text_node(raw_caption)
+    if not SPECIAL.search(raw_caption):
+        segments = TAG.split(raw_caption)
+        if not any(MARKUP.search(segment) or not simple_references(segment) for segment in segments):
+            return ''.join(text_node(segment) for segment in segments)
+    return BeautifulSoup(raw_caption, 'html.parser').get_text()
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """
+    Yield the elements of a top-level JSON array one at a time, reading the file in chunks.
 
     Args:
-        input_json (str): Path to the input JSON file.
-        output_jsonl (str): Path to the output JSONL file.
+        path (str): Path to a JSON file holding an array.
+        chunk_size (int): Number of characters read at a time.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size)
+        position = len(buffer) - len(buffer.lstrip())
+        if buffer[position:position + 1] != '[':
+            raise ValueError(f"{path} does not contain a JSON array")
+        position += 1
+        eof = False
+
+        while True:
+            # Skip whitespace and separators up to the next element
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(buffer) or eof:
+                    break
+                buffer, position = f.read(chunk_size), 0
+                eof = not buffer
+
+            if position >= len(buffer):
+                raise ValueError(f"Unterminated JSON array in {path}")
+            if buffer[position] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+
+            yield item
+            position = end
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def legacy_extract_captions(input_json, output_jsonl):
+    """
+    The previous extraction: load the whole export and strip each caption with BeautifulSoup.
     """
     with open(input_json, 'r') as f:
         data = json.load(f)
 
-    with open(output_jsonl, 'w') as f:
+    offsets = {}
+    offset = 0
+    with open(output_jsonl, 'wb') as f:
         for item in data:
             figure_id = item['data']['figure_id']
             raw_caption = item['data']['caption']
@@ -26,16 +138,139 @@ def extract_captions(input_json, output_jsonl):
                 "figure_id": figure_id,
                 "figure_caption": plain_caption
             }
-            f.write(json.dumps(output) + '\n')
+            line = (json.dumps(output) + '\n').encode('utf-8')
+            offsets.setdefault(str(figure_id), [offset, len(line)])
+            f.write(line)
+            offset += len(line)
+
+    write_index(output_jsonl, offsets)
+
+def extract_captions(input_json, output_jsonl, workers=None, batch_size=2048, incremental=False):
+    """
+    Extract figure captions from the annotated JSON file and save to a JSONL file.
+
+    The export is parsed incrementally and the captions are stripped of HTML by a pool
+    of worker processes, one batch at a time while the next batch is being parsed; the
+    output is written in the order of the export. A byte-offset index
+    (`<output_jsonl>.idx`) is written alongside so that `caption_store.CaptionStore`
+    can look captions up by figure_id.
+
+    Args:
+        input_json (str): Path to the input JSON file.
+        output_jsonl (str): Path to the output JSONL file.
+        workers (int): Number of worker processes (defaults to the number of CPUs).
+        batch_size (int): Number of captions handed to the pool at a time.
+        incremental (bool): Append only the figures missing from an existing output.
+
+    Returns:
+        int: Number of captions written.
+    """
+    offsets = {}
+    offset = 0
+    known_ids = set()
+    mode = 'wb'
+    if incremental and os.path.exists(output_jsonl):
+        offsets = load_index(output_jsonl)
+        known_ids = set(offsets)
+        offset = os.path.getsize(output_jsonl)
+        mode = 'ab'
+
+    records = (
+        (item['data']['figure_id'], item['data']['caption'])
+        for item in iter_json_array(input_json)
+        if str(item['data']['figure_id']) not in known_ids
+    )
+
+    workers = workers or os.cpu_count()
+    chunksize = max(1, batch_size // (4 * workers))
+    written = 0
+    with multiprocessing.Pool(workers) as pool, open(output_jsonl, mode) as f:
+        def write(batch, captions):
+            nonlocal offset, written
+            for (figure_id, _), plain_caption in zip(batch, captions):
+                output = {
+                    "figure_id": figure_id,
+                    "figure_caption": plain_caption
+                }
+                line = (json.dumps(output) + '\n').encode('utf-8')
+                offsets.setdefault(str(figure_id), [offset, len(line)])
+                f.write(line)
+                offset += len(line)
+            written += len(batch)
+
+        pending = None
+        for batch in iter_batches(records, batch_size):
+            result = pool.map_async(strip_html, [caption for _, caption in batch], chunksize=chunksize)
+            if pending is not None:
+                write(pending[0], pending[1].get())
+            pending = (batch, result)
+        if pending is not None:
+            write(pending[0], pending[1].get())
+
+    write_index(output_jsonl, offsets)
+    return written
+
+def _measure(function, args, queue):
+    start = time.perf_counter()
+    function(*args)
+    seconds = time.perf_counter() - start
+    queue.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def measure(function, *args):
+    """
+    Run an extraction in a fresh process and return its wall time and peak RSS in KiB.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(function, args, queue))
+    process.start()
+    seconds, peak_rss_kib = queue.get()
+    process.join()
+    return seconds, peak_rss_kib
+
+def benchmark(input_json, workers=None):
+    """
+    Compare the streaming extraction against the previous implementation on the same export.
+
+    Returns:
+        dict: Wall time and peak memory of both, and whether their outputs are identical.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_output = os.path.join(tmp_dir, 'legacy.jsonl')
+        streaming_output = os.path.join(tmp_dir, 'streaming.jsonl')
+        legacy_seconds, legacy_rss = measure(legacy_extract_captions, input_json, legacy_output)
+        streaming_seconds, streaming_rss = measure(extract_captions, input_json, streaming_output, workers)
+
+        with open(legacy_output, 'rb') as legacy, open(streaming_output, 'rb') as streaming:
+            identical = legacy.read() == streaming.read()
+
+    return {
+        "legacy_seconds": legacy_seconds,
+        "streaming_seconds": streaming_seconds,
+        "speedup": legacy_seconds / streaming_seconds if streaming_seconds > 0 else 0.0,
+        "legacy_peak_rss_mib": legacy_rss / 1024,
+        "streaming_peak_rss_mib": streaming_rss / 1024,
+        "identical_output": identical
+    }
 
 def main():
     parser = argparse.ArgumentParser(description="Extract figure captions from annotated data")
     parser.add_argument('--input', type=str, required=True, help="Path to the input annotated_data.json file")
-    parser.add_argument('--output', type=str, required=True, help="Path to the output JSONL file")
+    parser.add_argument('--output', type=str, help="Path to the output JSONL file")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (defaults to the number of CPUs)")
+    parser.add_argument('--incremental', action='store_true', help="Only add the figures missing from an existing output")
+    parser.add_argument('--benchmark', action='store_true', help="Compare the streaming extraction with the previous implementation")
 
     args = parser.parse_args()
 
-    extract_captions(args.input, args.output)
+    if args.benchmark:
+        print(json.dumps(benchmark(args.input, args.workers), indent=4))
+        return
+    if not args.output:
+        parser.error("--output is required unless --benchmark is given")
+
+    written = extract_captions(args.input, args.output, workers=args.workers, incremental=args.incremental)
+    print(f"Wrote {written} captions to {args.output}")
 
 if __name__ == "__main__":
     main()
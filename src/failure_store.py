@@ -0,0 +1,287 @@
+# src/failure_store.py
+
+import os
+import html
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+import instrumentation
+
+# Marks the end of the records on the writer queue
+STOP = object()
+
+INDEX_FILE = "index.jsonl"
+
+GALLERY_STYLE = """
+body { font-family: sans-serif; margin: 2em; }
+section { border-top: 1px solid #ccc; padding: 1em 0; }
+.figure { max-width: 480px; max-height: 480px; }
+.panels { display: flex; flex-wrap: wrap; gap: 1em; }
+.panel { width: 240px; }
+.panel img { max-width: 240px; max-height: 240px; }
+.labels { font-weight: bold; }
+.caption { color: #444; font-size: 0.9em; white-space: pre-wrap; }
+"""
+
+def digest_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+class FailureStore:
+    """
+    Content-addressed store of the mismatched panels of matching runs.
+
+    Panel crops, figures and captions are written once per distinct content to
+    `blobs/<first two hex digits>/<sha256>.<ext>`, and every failure is a line of
+    `index.jsonl` referring to its blobs with the expected and predicted labels. A
+    figure with several failing panels is therefore stored once, and crops of different
+    figures cannot overwrite each other.
+
+    `add` only queues the failure: the files are read, hashed and written by a
+    background thread, and `close` waits for it.
+    """
+
+    def __init__(self, root="data/failures/", queue_size=256):
+        self.root = root
+        self.index_path = os.path.join(root, INDEX_FILE)
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        discard_torn_record(self.index_path)
+        self._known = set(self._read_index_keys())
+        self._digests = {}
+        self._errors = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write_records, daemon=True)
+        self._thread.start()
+
+    def _read_index_keys(self):
+        for record in read_index(self.root):
+            yield record_key(record)
+
+    def blob_path(self, digest, extension):
+        return os.path.join(self.root, "blobs", digest[:2], f"{digest}{extension}")
+
+    def _put_blob(self, data, extension):
+        """
+        Write `data` under its digest unless it is already stored, and return the digest.
+        """
+        digest = digest_bytes(data)
+        path = self.blob_path(digest, extension)
+        if os.path.exists(path):
+            instrumentation.count("failure_blobs_reused")
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        instrumentation.count("failure_blobs_written")
+        return digest
+
+    def _put_file(self, path):
+        """
+        Store a file; files already stored in this run are not read again as long as
+        their size and mtime are unchanged.
+        """
+        stat = os.stat(path)
+        signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(signature)
+        if digest is None:
+            with open(path, 'rb') as f:
+                digest = self._put_blob(f.read(), os.path.splitext(path)[1].lower())
+            self._digests[signature] = digest
+        else:
+            instrumentation.count("failure_blobs_reused")
+        return digest
+
+    def _store(self, failure):
+        record = {
+            "filename": failure["filename"],
+            "figure_id": failure["figure_id"],
+            "expected": failure["expected"],
+            "predicted": failure["predicted"],
+            "panel": self._put_file(failure["image_path"]),
+            "panel_ext": os.path.splitext(failure["image_path"])[1].lower(),
+            "figure": self._put_file(failure["figure_path"]) if os.path.exists(failure["figure_path"]) else None,
+            "figure_ext": os.path.splitext(failure["figure_path"])[1].lower(),
+            "caption": self._put_blob(failure["caption"].encode('utf-8'), ".txt")
+        }
+        key = record_key(record)
+        if key in self._known:
+            return None
+        self._known.add(key)
+        record["recorded"] = round(time.time(), 3)
+        return record
+
+    def _write_records(self):
+        with open(self.index_path, 'a') as index:
+            while True:
+                failure = self._queue.get()
+                if failure is STOP:
+                    break
+                if self._errors:
+                    continue
+                try:
+                    with instrumentation.stage("failure_write"):
+                        record = self._store(failure)
+                        if record is not None:
+                            # The blobs are written first, so every indexed record is complete
+                            index.write(json.dumps(record) + '\n')
+                            index.flush()
+                except Exception as e:
+                    self._errors.append(e)
+
+    def add(self, filename, figure_id, expected, predicted, image_path, figure_path, caption):
+        """
+        Queue a mismatched panel to be stored with its figure and caption.
+        """
+        if self._errors:
+            raise self._errors[0]
+        self._queue.put({
+            "filename": filename, "figure_id": figure_id, "expected": expected, "predicted": predicted,
+            "image_path": image_path, "figure_path": figure_path, "caption": caption
+        })
+
+    def close(self):
+        """
+        Wait until every queued failure is stored, and raise the first error of the writer.
+        """
+        if self._thread.is_alive():
+            self._queue.put(STOP)
+            self._thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def discard_torn_record(path, block_size=1 << 16):
+    """
+    Truncate the index after its last newline, dropping a record cut short by a crash,
+    so that the next record is not appended onto it.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            print(f"Discarding a torn record at the end of {path}")
+            f.truncate(position)
+
+def record_key(record):
+    """
+    Identity of a failure in the index: the same panel content, caption and prediction are only indexed once.
+    """
+    return (record["filename"], record["panel"], record["caption"], record["predicted"])
+
+def read_index(root):
+    path = os.path.join(root, INDEX_FILE)
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash
+                    continue
+
+def render_gallery(root="data/failures/", output=None):
+    """
+    Render the latest failure of every panel in the index as a static HTML page, grouped by figure.
+
+    Args:
+        root (str): Directory of the failure store.
+        output (str): Path of the HTML file, `gallery.html` in `root` by default. The
+            blobs are linked relative to it.
+
+    Returns:
+        int: The number of failures in the gallery.
+    """
+    output = output or os.path.join(root, "gallery.html")
+    latest = {}
+    for record in read_index(root):
+        latest[record["filename"]] = record
+    figures = {}
+    for record in latest.values():
+        figures.setdefault(record["figure_id"], []).append(record)
+
+    def link(digest, extension):
+        path = os.path.abspath(os.path.join(root, "blobs", digest[:2], f"{digest}{extension}"))
+        return html.escape(os.path.relpath(path, os.path.dirname(os.path.abspath(output))))
+
+    captions = {}
+    def caption(digest):
+        if digest not in captions:
+            with open(os.path.join(root, "blobs", digest[:2], f"{digest}.txt"), 'r', encoding='utf-8') as f:
+                captions[digest] = f.read()
+        return captions[digest]
+
+    sections = []
+    for figure_id, records in sorted(figures.items()):
+        records.sort(key=lambda record: record["filename"])
+        figure = records[0]["figure"]
+        parts = [f"<section><h2>{html.escape(str(figure_id))} ({len(records)} mismatched)</h2>"]
+        if figure:
+            parts.append(f'<a href="{link(figure, records[0]["figure_ext"])}"><img class="figure" src="{link(figure, records[0]["figure_ext"])}" loading="lazy"></a>')
+        parts.append(f'<p class="caption">{html.escape(caption(records[0]["caption"]))}</p><div class="panels">')
+        for record in records:
+            parts.append(
+                f'<div class="panel"><img src="{link(record["panel"], record["panel_ext"])}" loading="lazy">'
+                f'<div>{html.escape(record["filename"])}</div>'
+                f'<div class="labels">expected {html.escape(str(record["expected"]))}, predicted {html.escape(str(record["predicted"]))}</div></div>'
+            )
+        parts.append("</div></section>")
+        sections.append(''.join(parts))
+
+    page = (f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Label matching failures</title><style>{GALLERY_STYLE}</style></head>"
+            f"<body><h1>Label matching failures</h1><p>{len(latest)} panels in {len(figures)} figures</p>{''.join(sections)}</body></html>")
+    with open(output + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(page)
+    os.replace(output + '.tmp', output)
+    return len(latest)
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the failure store.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Inspect the content-addressed store of mismatched panels.")
+    parser.add_argument('command', choices=['gallery', 'stats'], help="Render the HTML gallery, or print the size of the store.")
+    parser.add_argument('--failure_dir', type=str, default='data/failures/', help="Directory of the failure store.")
+    parser.add_argument('--output', type=str, default=None, help="Path of the HTML gallery (gallery.html in the store by default).")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+
+    if args.command == 'gallery':
+        failures = render_gallery(args.failure_dir, args.output)
+        print(f"Rendered {failures} failures to {args.output or os.path.join(args.failure_dir, 'gallery.html')}")
+        return
+
+    records = list(read_index(args.failure_dir))
+    blobs = [os.path.join(root, name) for root, _, names in os.walk(os.path.join(args.failure_dir, "blobs")) for name in names]
+    print(f"{len(records)} failures of {len(set(record['filename'] for record in records))} panels, "
+          f"{len(blobs)} blobs ({sum(os.path.getsize(path) for path in blobs) / 1e6:.1f} MB)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+# src/image_encoding.py
+
+import os
+import io
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from PIL import Image
+from instrumentation import count
+
+# Longest side the model keeps for each detail level; larger images are tiled down server-side anyway
+DETAIL_MAX_SIDE = {"low": 512, "high": 2048}
+HIGH_DETAIL_SHORT_SIDE = 768
+JPEG_QUALITIES = (85, 75, 65, 50)
+
+def to_rgb(image):
+    """
+    Convert any PIL colour mode to one JPEG can store, compositing transparency on white.
+    """
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    if image.mode in ("RGBA", "LA", "PA"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    if image.mode in ("RGB", "L"):
+        return image
+    if image.mode.startswith("I") or image.mode == "F":
+        # 16-bit and float greyscale: rescale to 8 bits instead of clipping
+        if image.mode != "F":
+            image = image.convert("I")
+        low, high = image.getextrema()
+        scale = 255.0 / (high - low) if high > low else 1.0
+        return image.point(lambda value: (value - low) * scale).convert("L")
+    return image.convert("RGB")
+
+def target_size(width, height, detail="high", max_side=None):
+    """
+    Size an image is resized to before upload.
+
+    Args:
+        width (int): Original width in pixels.
+        height (int): Original height in pixels.
+        detail (str): "low", "high" or "auto" (treated as "high").
+        max_side (int): Optional tighter limit on the longest side.
+
+    Returns:
+        tuple: The (width, height) to encode; never larger than the original.
+    """
+    limit = DETAIL_MAX_SIDE.get(detail, DETAIL_MAX_SIDE["high"])
+    if max_side:
+        limit = min(limit, max_side)
+    scale = min(1.0, limit / max(width, height))
+    if detail != "low":
+        scale = min(scale, HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+class EncodedImage:
+    def __init__(self, data, width, height, detail):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.detail = detail
+
+    @property
+    def data_url(self):
+        return f"data:image/jpeg;base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+    def to_content_part(self):
+        """
+        The `image_url` content part of a chat message.
+        """
+        return {"type": "image_url", "image_url": {"url": self.data_url, "detail": self.detail}}
+
+class PanelEncoder:
+    """
+    Encode panel images as JPEG payloads within a size and byte budget.
+
+    Images are converted to a JPEG-compatible colour mode, downscaled to what the
+    model keeps for the chosen detail level, and re-compressed at decreasing quality
+    (then smaller sizes) until they fit `max_bytes`. Payloads are cached by the hash
+    of the source bytes and the settings, in memory and optionally on disk, so
+    retries and re-runs skip decoding entirely.
+    """
+
+    def __init__(self, detail="high", max_side=None, max_bytes=None, cache_dir=None, memory_cache_size=512):
+        if detail not in ("low", "high", "auto"):
+            raise ValueError(f"Unknown detail level: {detail}")
+        self.detail = detail
+        self.max_side = max_side
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.memory_cache_size = memory_cache_size
+        self._memory_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_key(self, data):
+        digest = hashlib.sha256(data)
+        digest.update(f"|{self.detail}|{self.max_side}|{self.max_bytes}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def target_size(self, width, height):
+        return target_size(width, height, self.detail, self.max_side)
+
+    def _compress(self, image):
+        width, height = image.size
+        while True:
+            for quality in JPEG_QUALITIES:
+                buffered = io.BytesIO()
+                image.save(buffered, format="JPEG", quality=quality, optimize=True)
+                data = buffered.getvalue()
+                if not self.max_bytes or len(data) <= self.max_bytes:
+                    return data, image.size
+            if min(width, height) <= 64:
+                return data, image.size
+            width, height = max(1, int(width * 0.75)), max(1, int(height * 0.75))
+            image = image.resize((width, height), Image.LANCZOS)
+
+    def _encode(self, data):
+        image = Image.open(io.BytesIO(data))
+        image.draft(None, self.target_size(*image.size))
+        return self._encode_image(image)
+
+    def _encode_image(self, image):
+        image = to_rgb(image)
+        size = self.target_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        return self._compress(image)
+
+    def _lookup(self, key):
+        with self._lock:
+            encoded = self._memory_cache.get(key)
+            if encoded is not None:
+                self.hits += 1
+                self._memory_cache.move_to_end(key)
+            return encoded
+
+    def _remember(self, key, encoded):
+        with self._lock:
+            self._memory_cache[key] = encoded
+            self._memory_cache.move_to_end(key)
+            while len(self._memory_cache) > self.memory_cache_size:
+                self._memory_cache.popitem(last=False)
+
+    def encode(self, panel):
+        """
+        Encode a panel image.
+
+        Args:
+            panel: The panel as bytes, a file-like object, a path or an in-memory PIL image.
+
+        Returns:
+            EncodedImage: The JPEG payload and its dimensions.
+        """
+        if isinstance(panel, Image.Image):
+            return self._encode_pil(panel)
+        if isinstance(panel, (str, os.PathLike)):
+            with open(panel, "rb") as f:
+                data = f.read()
+        elif isinstance(panel, bytes):
+            data = panel
+        else:
+            data = panel.getvalue() if hasattr(panel, "getvalue") else panel.read()
+
+        key = self.cache_key(data)
+        encoded = self._lookup(key)
+        if encoded is not None:
+            count("encoded_panel_cache_hits")
+            return encoded
+
+        cache_path = os.path.join(self.cache_dir, key[:2], f"{key}.jpg") if self.cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                payload = f.read()
+            with open(cache_path[:-4] + ".json", "r") as f:
+                width, height = json.load(f)["size"]
+            self.hits += 1
+            count("encoded_panel_cache_hits")
+            encoded = EncodedImage(payload, width, height, self.detail)
+            self._remember(key, encoded)
+            return encoded
+
+        self.misses += 1
+        count("encoded_panel_cache_misses")
+        payload, (width, height) = self._encode(data)
+        encoded = EncodedImage(payload, width, height, self.detail)
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path[:-4] + ".json", "w") as f:
+                json.dump({"size": [width, height]}, f)
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, cache_path)
+        self._remember(key, encoded)
+        return encoded
+
+    def _encode_pil(self, image):
+        # In-memory crops have no source file, so the memory cache is keyed by their pixels
+        key = self.cache_key(image.tobytes() + f"|{image.mode}|{image.size}".encode("utf-8"))
+        encoded = self._lookup(key)
+        if encoded is not None:
+            return encoded
+
+        self.misses += 1
+        payload, (width, height) = self._encode_image(image)
+        encoded = EncodedImage(payload, width, height, self.detail)
+        self._remember(key, encoded)
+        return encoded
+
+def legacy_encode(data):
+    """
+    The previous encoding: decode and re-save at full resolution with PIL's default JPEG settings.
+    """
+    buffered = io.BytesIO()
+    Image.open(io.BytesIO(data)).save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+def benchmark(image_dir, encoder, limit=None):
+    """
+    Measure payload bytes and encode time per panel against the previous full-resolution encoding.
+
+    Args:
+        image_dir (str): Directory with the panel crops (e.g. `data/segmented_images`).
+        encoder (PanelEncoder): The encoder to benchmark; use one without a disk cache.
+        limit (int): Maximum number of panels to encode.
+
+    Returns:
+        dict: Per-panel measurements and their totals.
+    """
+    filenames = sorted(f for f in os.listdir(image_dir) if f.lower().endswith((".png", ".jpg", ".jpeg")))[:limit]
+    panels = []
+    for filename in filenames:
+        with open(os.path.join(image_dir, filename), "rb") as f:
+            data = f.read()
+
+        start = time.perf_counter()
+        try:
+            legacy_bytes = len(legacy_encode(data))
+        except OSError as e:
+            # e.g. RGBA or palette PNGs, which the full-resolution JPEG path cannot write
+            print(f"Legacy encoding failed for {filename}: {e}")
+            legacy_bytes = None
+        legacy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        encoded = encoder.encode(data)
+        encode_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        encoder.encode(data)
+        cached_seconds = time.perf_counter() - start
+
+        panels.append({
+            "filename": filename,
+            "source_bytes": len(data),
+            "legacy_bytes": legacy_bytes,
+            "legacy_seconds": legacy_seconds,
+            "encoded_bytes": len(encoded.data),
+            "encoded_size": [encoded.width, encoded.height],
+            "encode_seconds": encode_seconds,
+            "cached_seconds": cached_seconds
+        })
+
+    legacy_ok = [panel for panel in panels if panel["legacy_bytes"] is not None]
+    summary = {
+        "panels": len(panels),
+        "detail": encoder.detail,
+        "max_side": encoder.max_side,
+        "max_bytes": encoder.max_bytes,
+        "legacy_failures": len(panels) - len(legacy_ok),
+        "legacy_bytes": sum(panel["legacy_bytes"] for panel in legacy_ok),
+        "encoded_bytes": sum(panel["encoded_bytes"] for panel in panels),
+        "encoded_bytes_same_panels": sum(panel["encoded_bytes"] for panel in legacy_ok),
+        "legacy_seconds": sum(panel["legacy_seconds"] for panel in panels),
+        "encode_seconds": sum(panel["encode_seconds"] for panel in panels),
+        "cached_seconds": sum(panel["cached_seconds"] for panel in panels)
+    }
+    return {"summary": summary, "panels": panels}
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the encoder benchmark.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the panel payload encoder on a directory of panel crops.")
+    parser.add_argument('--image_dir', type=str, default='data/segmented_images', help="Directory with the panel crops.")
+    parser.add_argument('--detail', type=str, default="high", choices=["low", "high", "auto"], help="Detail level requested from the model.")
+    parser.add_argument('--max_side', type=int, default=None, help="Maximum length of the longest side in pixels.")
+    parser.add_argument('--max_bytes', type=int, default=None, help="Maximum size of each JPEG payload in bytes.")
+    parser.add_argument('--limit', type=int, default=None, help="Maximum number of panels to encode.")
+    parser.add_argument('--output', type=str, default=None, help="Write the per-panel measurements to this JSON file.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    encoder = PanelEncoder(detail=args.detail, max_side=args.max_side, max_bytes=args.max_bytes)
+    results = benchmark(args.image_dir, encoder, limit=args.limit)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    summary = results["summary"]
+    panels = max(summary["panels"], 1)
+    print(json.dumps(summary, indent=4))
+    print(f"Bytes per panel: {summary['encoded_bytes'] / panels:.0f} (legacy {summary['legacy_bytes'] / max(panels - summary['legacy_failures'], 1):.0f})")
+    print(f"Encode time per panel: {summary['encode_seconds'] / panels * 1000:.2f} ms "
+          f"(legacy {summary['legacy_seconds'] / panels * 1000:.2f} ms, cached {summary['cached_seconds'] / panels * 1000:.3f} ms)")
+
+if __name__ == "__main__":
+    main()
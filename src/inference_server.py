@@ -0,0 +1,417 @@
+# src/inference_server.py
+
+import io
+import json
+import time
+import queue
+import base64
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+from detectors import load_detector, crop_panels
+from aspect_batching import AspectRatioBatcher
+
+# Tells the batching thread to stop
+STOP = object()
+
+class LatencyStats:
+    """
+    Rolling window of the queueing, inference and total latency of the last `window`
+    requests, and of the sizes of the batches they ran in.
+    """
+
+    def __init__(self, window=2048):
+        self.samples = {name: deque(maxlen=window) for name in ("queue_ms", "inference_ms", "total_ms")}
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record_batch(self, size):
+        with self._lock:
+            self.batches += 1
+            self.batch_sizes.append(size)
+
+    def record_request(self, queue_ms, inference_ms, total_ms):
+        with self._lock:
+            self.requests += 1
+            self.samples["queue_ms"].append(queue_ms)
+            self.samples["inference_ms"].append(inference_ms)
+            self.samples["total_ms"].append(total_ms)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self):
+        with self._lock:
+            summary = {"requests": self.requests, "batches": self.batches, "errors": self.errors}
+            for name, values in self.samples.items():
+                if values:
+                    array = np.fromiter(values, dtype=np.float64)
+                    summary[name] = {
+                        "mean": round(float(array.mean()), 2),
+                        "p50": round(float(np.percentile(array, 50)), 2),
+                        "p90": round(float(np.percentile(array, 90)), 2),
+                        "p99": round(float(np.percentile(array, 99)), 2),
+                        "max": round(float(array.max()), 2)
+                    }
+            if self.batch_sizes:
+                sizes, counts = np.unique(np.fromiter(self.batch_sizes, dtype=np.int64), return_counts=True)
+                summary["batch_sizes"] = {str(size): int(count) for size, count in zip(sizes, counts)}
+                summary["mean_batch_size"] = round(float(np.mean(self.batch_sizes)), 2)
+            return summary
+
+class DetectionRequest:
+    def __init__(self, image):
+        self.image = image
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.queue_ms = 0.0
+        self.inference_ms = 0.0
+        self.batch_size = 0
+
+class MicroBatcher:
+    """
+    Runs concurrent detection requests through one warm detector in micro-batches.
+
+    A single thread owns the detector: it takes the oldest waiting request and keeps
+    collecting others until `max_batch_size` requests are waiting or `max_wait`
+    seconds have passed since the oldest one arrived, then runs them as one batch.
+    With a `batcher`, a micro-batch is split by aspect-ratio bucket and every bucket
+    runs at its own rectangular shape (exported models need dynamic input shapes).
+
+    Args:
+        detector: Any detector from `detectors` (`detect(images, shape=None)`).
+        max_batch_size (int): Largest batch handed to the detector.
+        max_wait (float): Longest time a request waits for others to join its batch, in seconds.
+        batcher (AspectRatioBatcher): Optional aspect-ratio bucketing.
+    """
+
+    def __init__(self, detector, max_batch_size=8, max_wait=0.01, batcher=None):
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batcher = batcher
+        self.stats = LatencyStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """
+        Queue a PIL image for detection.
+
+        Returns:
+            DetectionRequest: Its `future` resolves to the `(n, 5)` xyxy + score array.
+        """
+        request = DetectionRequest(image)
+        self._queue.put(request)
+        return request
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = first.enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is STOP:
+                self._queue.put(STOP)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is STOP:
+                return
+            batch = self._collect(request)
+            self.stats.record_batch(len(batch))
+            shapes = {}
+            for request in batch:
+                shape = self.batcher.shape_for(*request.image.size) if self.batcher else None
+                shapes.setdefault(shape, []).append(request)
+            for shape, requests in shapes.items():
+                self._detect(shape, requests)
+
+    def _detect(self, shape, requests):
+        start = time.monotonic()
+        try:
+            detections = self.detector.detect([request.image for request in requests], shape=shape)
+        except Exception as e:
+            for request in requests:
+                self.stats.record_error()
+                request.future.set_exception(e)
+            return
+        inference_ms = (time.monotonic() - start) * 1000
+        for request, boxes in zip(requests, detections):
+            request.queue_ms = (start - request.enqueued) * 1000
+            request.inference_ms = inference_ms
+            request.batch_size = len(requests)
+            request.future.set_result(boxes)
+
+    def close(self):
+        self._queue.put(STOP)
+        self._thread.join()
+
+def encode_crop(crop, image_format="png"):
+    buffer = io.BytesIO()
+    crop.save(buffer, format="JPEG" if image_format == "jpeg" else "PNG", **({"quality": 90} if image_format == "jpeg" else {}))
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """
+    `POST /detect` takes a figure as the raw request body and answers with its panel
+    boxes; `?crops=png|jpeg` adds the base64-encoded crops and `?conf=` raises the
+    confidence threshold of the server. `GET /health` and `GET /latency` report the
+    server state and the rolling latency percentiles.
+    """
+
+    server_version = "PanelInference/0.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path.rstrip("/")
+        if path == "/health":
+            self._send_json(200, self.server.health())
+        elif path == "/latency":
+            self._send_json(200, self.server.batcher.stats.summary())
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        received = time.monotonic()
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip("/") != "/detect":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        query = urllib.parse.parse_qs(url.query)
+        crops = query.get("crops", [""])[0].lower()
+        crops = "png" if crops in ("1", "true", "yes") else crops
+        try:
+            conf = float(query.get("conf", [0.0])[0])
+        except ValueError:
+            self._send_json(400, {"error": "conf must be a number"})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            image = Image.open(io.BytesIO(self.rfile.read(length))).convert("RGB")
+        except OSError as e:
+            self._send_json(400, {"error": f"Cannot read the image: {e}"})
+            return
+
+        request = self.server.batcher.submit(image)
+        try:
+            detections = request.future.result(timeout=self.server.request_timeout)
+        except FutureTimeout:
+            self.server.batcher.stats.record_error()
+            self._send_json(503, {"error": "Timed out waiting for the detector"})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+
+        panels = []
+        for index, (box, score, crop) in enumerate(crop_panels(image, detections[detections[:, 4] >= conf])):
+            panel = {"index": index, "box": list(box), "score": score}
+            if crops in ("png", "jpeg"):
+                panel["crop"] = encode_crop(crop, crops)
+            panels.append(panel)
+
+        total_ms = (time.monotonic() - received) * 1000
+        self.server.batcher.stats.record_request(request.queue_ms, request.inference_ms, total_ms)
+        self._send_json(200, {
+            "width": image.width,
+            "height": image.height,
+            "panels": panels,
+            "timing": {
+                "queue_ms": round(request.queue_ms, 2),
+                "inference_ms": round(request.inference_ms, 2),
+                "total_ms": round(total_ms, 2),
+                "batch_size": request.batch_size
+            }
+        })
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher, model_path=None, request_timeout=60.0, verbose=False):
+        super().__init__(address, InferenceHandler)
+        self.batcher = batcher
+        self.model_path = model_path
+        self.request_timeout = request_timeout
+        self.verbose = verbose
+        self.started = time.time()
+
+    def health(self):
+        return {
+            "status": "ok",
+            "model": self.model_path,
+            "backend": type(self.batcher.detector).__name__,
+            "uptime_s": round(time.time() - self.started, 1),
+            "pending": self.batcher.pending(),
+            "max_batch_size": self.batcher.max_batch_size,
+            "max_wait_ms": self.batcher.max_wait * 1000
+        }
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+def start_inference_server(detector, host="127.0.0.1", port=0, max_batch_size=8, max_wait=0.01, batcher=None, **kwargs):
+    """
+    Serve a loaded detector on a background thread.
+
+    Args:
+        detector: Any detector from `detectors`.
+        host (str): Interface to bind.
+        port (int): Port to bind, 0 picks a free one.
+        max_batch_size (int): Largest micro-batch.
+        max_wait (float): Longest time a request waits for a batch to fill, in seconds.
+        batcher (AspectRatioBatcher): Optional aspect-ratio bucketing of each micro-batch.
+        **kwargs: Forwarded to `InferenceServer` (model_path, request_timeout, verbose).
+
+    Returns:
+        InferenceServer: The running server; `shutdown()` stops it.
+    """
+    server = InferenceServer((host, port), MicroBatcher(detector, max_batch_size, max_wait, batcher), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class InferenceClient:
+    """
+    Client of the inference server, e.g. for the Streamlit app.
+
+    Args:
+        base_url (str): Server address such as `http://127.0.0.1:8500`.
+        timeout (float): Request timeout in seconds.
+    """
+
+    def __init__(self, base_url="http://127.0.0.1:8500", timeout=60.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def health(self):
+        return self._get("/health")
+
+    def latency(self):
+        return self._get("/latency")
+
+    def detect(self, image, crops=None, conf=None):
+        """
+        Detect the panels of a figure.
+
+        Args:
+            image: Path, encoded image bytes or PIL image of the figure.
+            crops (str): "png" or "jpeg" to receive the panel crops, decoded into PIL images under `crop`.
+            conf (float): Confidence threshold, if higher than the server's.
+
+        Returns:
+            dict: `width`, `height`, `panels` (index, box, score and optional crop) and `timing`.
+        """
+        if isinstance(image, Image.Image):
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            data = buffer.getvalue()
+        elif isinstance(image, (bytes, bytearray)):
+            data = bytes(image)
+        else:
+            with open(image, 'rb') as f:
+                data = f.read()
+
+        query = {key: value for key, value in (("crops", crops), ("conf", conf)) if value}
+        url = f"{self.base_url}/detect" + (f"?{urllib.parse.urlencode(query)}" if query else "")
+        request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/octet-stream"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            result = json.loads(response.read())
+        for panel in result["panels"]:
+            if "crop" in panel:
+                panel["crop"] = Image.open(io.BytesIO(base64.b64decode(panel["crop"])))
+        return result
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the inference server.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Serve the panel detector over HTTP, batching concurrent requests on CPU.")
+    parser.add_argument('--model', type=str, default='runs/soda_figure_segmentation/train/weights/best.pt', help="Path to the trained YOLO model file, or its ONNX/OpenVINO export.")
+    parser.add_argument('--model_version', type=int, default=10, help="YOLO model version to use (e.g., 8, 10).")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Interface to bind.")
+    parser.add_argument('--port', type=int, default=8500, help="Port to bind.")
+    parser.add_argument('--imgsz', type=int, default=512, help="Image size for inference.")
+    parser.add_argument('--conf', type=float, default=0.3, help="Confidence threshold for detections.")
+    parser.add_argument('--iou', type=float, default=0.7, help="IoU threshold for non-maximum suppression.")
+    parser.add_argument('--max_det', type=int, default=20, help="Maximum number of panels per figure.")
+    parser.add_argument('--threads', type=int, default=0, help="Intra-op threads of the ONNX Runtime/OpenVINO backends (0 lets them decide).")
+    parser.add_argument('--max_batch_size', type=int, default=8, help="Largest number of figures detected in one batch.")
+    parser.add_argument('--max_wait_ms', type=float, default=10.0, help="Longest time a request waits for others to join its batch.")
+    parser.add_argument('--bucketed', action='store_true', help="Split each batch by aspect-ratio bucket with rectangular inputs (ONNX/OpenVINO models must be exported with --dynamic).")
+    parser.add_argument('--bucket_step', type=int, default=64, help="Granularity of the bucket shapes in pixels.")
+    parser.add_argument('--request_timeout', type=float, default=60.0, help="Seconds a request waits for its detections before failing.")
+    parser.add_argument('--verbose', action='store_true', help="Log every request.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    detector = load_detector(args.model, args.model_version, imgsz=args.imgsz, conf=args.conf, iou=args.iou,
+                             max_det=args.max_det, device="cpu", intra_op_threads=args.threads)
+    # The first inference initialises the backend; pay for it before accepting requests
+    detector.detect([Image.new("RGB", (args.imgsz, args.imgsz), (255, 255, 255))])
+
+    batcher = MicroBatcher(
+        detector,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        batcher=AspectRatioBatcher(args.imgsz, args.max_batch_size, args.bucket_step) if args.bucketed else None
+    )
+    server = InferenceServer((args.host, args.port), batcher, model_path=args.model,
+                             request_timeout=args.request_timeout, verbose=args.verbose)
+    print(f"Serving {args.model} on {server.base_url} (batches of up to {args.max_batch_size}, {args.max_wait_ms} ms max wait)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+if __name__ == "__main__":
+    main()
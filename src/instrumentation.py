@@ -0,0 +1,227 @@
+# src/instrumentation.py
+
+import re
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Upper bounds of the size histogram buckets in bytes and tokens
+SIZE_BUCKETS = tuple(2 ** exponent for exponent in range(6, 25, 2))
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus layout, with the exact count, sum,
+    minimum and maximum of the observed values.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Quantile estimated by linear interpolation within its bucket, as `histogram_quantile` does.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else min(self.min, self.buckets[0])
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(self.max, max(self.min, lower + (upper - lower) * (rank - seen) / count))
+            seen += count
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6),
+            "min": round(self.min, 6),
+            "p50": round(self.quantile(0.5), 6),
+            "p90": round(self.quantile(0.9), 6),
+            "p99": round(self.quantile(0.99), 6),
+            "max": round(self.max, 6)
+        }
+
+class Stage:
+    """
+    Context manager timing one pass through a stage into the `<name>_seconds` histogram.
+    """
+
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(f"{self.name}_seconds", time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.count(f"{self.name}_errors")
+        return False
+
+class NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Metrics:
+    """
+    Counters and histograms of one run, safe to update from threads and coroutines.
+
+    Histogram names ending in `_seconds` get latency buckets, the others size buckets.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(LATENCY_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS)
+            histogram.observe(value)
+
+    def ratios(self):
+        """
+        Hit ratio of every `<cache>_hits` counter that has a `<cache>_misses` counterpart.
+        """
+        ratios = {}
+        for name, hits in self.counters.items():
+            if name.endswith("_hits"):
+                cache = name[:-len("_hits")]
+                lookups = hits + self.counters.get(f"{cache}_misses", 0)
+                ratios[f"{cache}_hit_ratio"] = round(hits / lookups, 4) if lookups else None
+        return ratios
+
+    def summary(self):
+        with self._lock:
+            return {
+                "started": self.started,
+                "elapsed_seconds": round(time.time() - self.started, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "ratios": self.ratios(),
+                "histograms": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+            }
+
+    def prometheus(self, prefix="soda"):
+        """
+        The metrics in the Prometheus text exposition format (e.g. for the node exporter textfile collector).
+        """
+        def metric_name(name):
+            return f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                name = metric_name(name)
+                lines += [f"# TYPE {name}_total counter", f"{name}_total {value}"]
+            for name, ratio in sorted(self.ratios().items()):
+                if ratio is not None:
+                    name = metric_name(name)
+                    lines += [f"# TYPE {name} gauge", f"{name} {ratio}"]
+            for name, histogram in sorted(self.histograms.items()):
+                name = metric_name(name)
+                lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{"+Inf" if bound == float("inf") else bound}"}} {cumulative}')
+                lines += [f"{name}_sum {histogram.sum}", f"{name}_count {histogram.count}"]
+        return '\n'.join(lines) + '\n'
+
+# None while instrumentation is disabled, so that every hook costs a single check
+metrics = None
+
+def configure_metrics(enabled=True):
+    """
+    Enable (with fresh counters) or disable the instrumentation of the run.
+
+    Returns:
+        Metrics: The new registry, or None when disabled.
+    """
+    global metrics
+    metrics = Metrics() if enabled else None
+    return metrics
+
+def stage(name):
+    """
+    Time a block of code: `with stage("encode"): ...`.
+    """
+    if metrics is None:
+        return NULL_STAGE
+    return Stage(metrics, name)
+
+def count(name, value=1):
+    if metrics is not None:
+        metrics.count(name, value)
+
+def observe(name, value):
+    if metrics is not None:
+        metrics.observe(name, value)
+
+@contextmanager
+def recording(path):
+    """
+    Instrument the enclosed run and write its metrics to `path` when it ends, even if
+    it fails; nothing is recorded if `path` is empty.
+    """
+    if not path:
+        yield None
+        return
+    registry = configure_metrics()
+    try:
+        yield registry
+    finally:
+        dump_metrics(path)
+        configure_metrics(False)
+
+def dump_metrics(path):
+    """
+    Write the metrics of the run to `path`: Prometheus text for `.prom` and `.txt` files, JSON otherwise.
+    """
+    if metrics is None:
+        return
+    with open(path, 'w') as f:
+        if path.endswith(('.prom', '.txt')):
+            f.write(metrics.prometheus())
+        else:
+            json.dump(metrics.summary(), f, indent=4)
+    print(f"Wrote the run metrics to {path}")
@@ -0,0 +1,333 @@
+# src/label_recognizer.py
+
+import os
+import json
+import string
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from tqdm import tqdm
+from description_cache import load_cache
+
+# Glyphs recognised as panel labels; lowercase labels are reported in upper case, like the crop filenames
+ALPHABET = string.ascii_uppercase + string.ascii_lowercase
+# Side of the normalised glyph images that are compared
+GLYPH_SIZE = 16
+# Score gap to the best other label under which a match is considered ambiguous
+MIN_MARGIN = 0.15
+DEFAULT_CONFIDENCE = 0.8
+
+def ink_mask(gray, min_contrast=64):
+    """
+    Binarise a corner so that the glyph pixels, dark or light, are True, or return None
+    if the corner is too uniform to contain one.
+
+    The background is the median grey level; ink is whatever lies past the midpoint
+    towards the extreme farthest from it, which keeps a small label separate from
+    the noise or texture around it.
+    """
+    background = int(np.median(gray))
+    low, high = int(gray.min()), int(gray.max())
+    if high - background >= background - low:
+        if high - background < min_contrast:
+            return None
+        return gray > (background + high) // 2
+    if background - low < min_contrast:
+        return None
+    return gray < (background + low + 1) // 2
+
+def row_runs(row):
+    """
+    (start, end) of the runs of ink in one mask row.
+    """
+    changes = np.flatnonzero(np.diff(np.concatenate([[0], row.view(np.int8), [0]])))
+    return zip(changes[::2].tolist(), changes[1::2].tolist())
+
+def connected_components(mask, max_runs=None):
+    """
+    8-connected components of a mask, as `(top, left, bottom, right)` boxes and the
+    `(row, start, end)` runs of ink of each component.
+
+    Runs of ink are merged with the overlapping runs of the previous row (union-find),
+    which keeps the Python work proportional to the number of runs rather than pixels.
+    Returns None when the mask has more than `max_runs` runs (textured content).
+    """
+    parent = []
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    runs, previous = [], []
+    for y, row in enumerate(mask):
+        current = []
+        for start, end in row_runs(row):
+            node = len(parent)
+            parent.append(node)
+            runs.append((node, y, start, end))
+            for other, other_start, other_end in previous:
+                if other_start <= end and start <= other_end:
+                    parent[find(other)] = find(node)
+            current.append((node, start, end))
+        previous = current
+        if max_runs is not None and len(runs) > max_runs:
+            return None
+
+    components = {}
+    for node, y, start, end in runs:
+        components.setdefault(find(node), []).append((y, start, end))
+    return [
+        ((component[0][0], min(start for _, start, _ in component), component[-1][0] + 1, max(end for _, _, end in component)), component)
+        for component in components.values()
+    ]
+
+def normalise_glyph(mask):
+    """
+    Centre a glyph mask in a square, scale it to `GLYPH_SIZE` and return it as a zero-mean unit vector.
+
+    The slight blur makes the correlation tolerant to stroke width and font differences.
+    """
+    height, width = mask.shape
+    side = max(height, width)
+    square = np.zeros((side, side), dtype=np.uint8)
+    top, left = (side - height) // 2, (side - width) // 2
+    square[top:top + height, left:left + width] = mask * 255
+    glyph = Image.fromarray(square).resize((GLYPH_SIZE, GLYPH_SIZE), Image.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    glyph = np.asarray(glyph, dtype=np.float32).ravel()
+    glyph -= glyph.mean()
+    norm = np.linalg.norm(glyph)
+    return glyph / norm if norm > 0 else glyph
+
+def render_glyph(character, font, bold=False):
+    size = font.size * 2
+    image = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(image).text((size // 4, size // 4), character, fill=255, font=font)
+    if bold:
+        image = image.filter(ImageFilter.MaxFilter(max(3, font.size // 16 * 2 + 1)))
+    mask = np.asarray(image) > 127
+    rows, columns = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    return mask[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+
+def build_templates(fonts=None, size=64):
+    """
+    Normalised glyphs of every character of `ALPHABET`, regular and bold.
+
+    Args:
+        fonts (list): Paths of TrueType fonts; Pillow's bundled sans-serif font is always included.
+        size (int): Rendering size in pixels.
+
+    Returns:
+        tuple: The `(n, GLYPH_SIZE ** 2)` template matrix and the label of every row.
+    """
+    faces = [ImageFont.load_default(size)] + [ImageFont.truetype(path, size) for path in fonts or []]
+    templates, labels = [], []
+    for font in faces:
+        for character in ALPHABET:
+            for bold in (False, True):
+                templates.append(normalise_glyph(render_glyph(character, font, bold)))
+                labels.append(character.upper())
+    return np.stack(templates), labels
+
+class LabelPrediction:
+    def __init__(self, label, confidence, box=None):
+        self.label = label
+        self.confidence = confidence
+        self.box = box
+
+    def to_dict(self):
+        return {"panel_label": self.label, "confidence": round(self.confidence, 4)}
+
+class LabelRecognizer:
+    """
+    CPU-only recogniser of the printed letter most panel crops carry in a corner.
+
+    Each corner of the crop is binarised against its background (either polarity), split into connected
+    components, and every glyph-shaped component is compared with rendered letters by
+    normalised correlation. The confidence of a label is its best
+    correlation, scaled down when another label scores within `MIN_MARGIN` of it, so
+    that ambiguous shapes (I/l, blobs of plot content) are left to the LLM.
+
+    Args:
+        fonts (list): Extra TrueType fonts to render templates with.
+        corner_fraction (float): Share of the width and height searched at each corner.
+        max_corner (int): Upper bound of the searched corner side in pixels.
+        min_glyph (int): Smallest glyph height in pixels.
+    """
+
+    def __init__(self, fonts=None, corner_fraction=0.3, max_corner=160, min_glyph=8):
+        self.fonts = list(fonts or [])
+        self.templates, self.template_labels = build_templates(fonts)
+        self.labels = sorted(set(self.template_labels))
+        self.label_index = np.array([self.labels.index(label) for label in self.template_labels])
+        self.corner_fraction = corner_fraction
+        self.max_corner = max_corner
+        self.min_glyph = min_glyph
+
+    def corners(self, gray):
+        height, width = gray.shape
+        corner_height = min(height, max(self.min_glyph * 4, min(self.max_corner, int(height * self.corner_fraction))))
+        corner_width = min(width, max(self.min_glyph * 4, min(self.max_corner, int(width * self.corner_fraction))))
+        for top in (0, height - corner_height):
+            for left in (0, width - corner_width):
+                yield top, left, gray[top:top + corner_height, left:left + corner_width]
+
+    def candidates(self, gray):
+        """
+        Normalised glyph vectors of the label-shaped components in the corners, and their boxes.
+        """
+        glyphs, boxes = [], []
+        for top, left, corner in self.corners(gray):
+            mask = ink_mask(corner)
+            if mask is None:
+                continue
+            components = connected_components(mask, max_runs=mask.shape[0] * 8)
+            if components is None:
+                continue
+            corner_height, corner_width = mask.shape
+            for (box_top, box_left, box_bottom, box_right), component in components:
+                height, width = box_bottom - box_top, box_right - box_left
+                if height < self.min_glyph or height > corner_height * 0.6 or not 0.15 <= width / height <= 1.6:
+                    continue
+                # Components cut by the inner edges of the corner are not whole glyphs
+                if (box_bottom == corner_height and top == 0 and corner_height < gray.shape[0]) or \
+                   (box_right == corner_width and left == 0 and corner_width < gray.shape[1]):
+                    continue
+                glyph = np.zeros((height, width), dtype=bool)
+                for y, start, end in component:
+                    glyph[y - box_top, start - box_left:end - box_left] = True
+                if not 0.08 <= glyph.mean() <= 0.9:
+                    continue
+                # A label is set apart from the content: little other ink in a ring around it
+                ring = mask[max(0, box_top - 2):box_bottom + 2, max(0, box_left - 2):box_right + 2]
+                if ring.sum() - glyph.sum() > 0.05 * ring.size:
+                    continue
+                glyphs.append(normalise_glyph(glyph))
+                boxes.append((left + box_left, top + box_top, left + box_right, top + box_bottom))
+        return glyphs, boxes
+
+    def recognize(self, image):
+        """
+        Recognise the label of a panel crop.
+
+        Args:
+            image: A PIL image, or a path or file object PIL can open.
+
+        Returns:
+            LabelPrediction: The label (None if no glyph was found) and its confidence in [0, 1].
+        """
+        if isinstance(image, Image.Image):
+            gray = np.asarray(image.convert("L"))
+        else:
+            with Image.open(image) as opened:
+                gray = np.asarray(opened.convert("L"))
+        glyphs, boxes = self.candidates(gray)
+        if not glyphs:
+            return LabelPrediction(None, 0.0)
+
+        correlations = np.stack(glyphs) @ self.templates.T
+        # Best correlation of every candidate with every label
+        scores = np.full((len(glyphs), len(self.labels)), -1.0, dtype=np.float32)
+        np.maximum.at(scores.T, self.label_index, correlations.T)
+        ranked = np.sort(scores, axis=1)
+        best, runner_up = ranked[:, -1], ranked[:, -2]
+        confidences = np.clip(best, 0.0, 1.0) * np.clip((best - runner_up) / MIN_MARGIN, 0.0, 1.0)
+
+        candidate = int(np.argmax(confidences))
+        label = self.labels[int(np.argmax(scores[candidate]))]
+        return LabelPrediction(label, float(confidences[candidate]), boxes[candidate])
+
+def ground_truth_label(filename):
+    return os.path.splitext(filename)[0].rsplit('_', 1)[1]
+
+def cached_label(description):
+    try:
+        return json.loads(description.replace("```json", "").replace("```", "")).get("panel_label")
+    except (json.JSONDecodeError, AttributeError):
+        return None
+
+def evaluate(image_dir, cache_file, recognizer, thresholds, limit=None):
+    """
+    Compare the local labels with the cached LLM answers at several confidence thresholds.
+
+    For every threshold, panels at or above it would be labelled locally and skip the
+    LLM; the report gives how many calls that saves, the accuracy of the local labels
+    and of the LLM on those panels, and the accuracy of the combined run against the
+    LLM alone. Only panels with both a crop and a cached description are counted.
+
+    Args:
+        image_dir (str): Directory with the panel crops, named `<figure_id>_<label>.png`.
+        cache_file (str): Panel description cache (legacy .json, .jsonl or .sqlite).
+        recognizer (LabelRecognizer): The recogniser to evaluate.
+        thresholds (list): Confidence thresholds to report.
+        limit (int): Maximum number of panels to evaluate.
+
+    Returns:
+        dict: Totals and one entry per threshold.
+    """
+    cache = load_cache(cache_file)
+    filenames = sorted(filename for filename in cache if os.path.exists(os.path.join(image_dir, filename)))[:limit]
+
+    truth, local, confidence, llm = [], [], [], []
+    for filename in tqdm(filenames, desc="Recognising labels"):
+        prediction = recognizer.recognize(os.path.join(image_dir, filename))
+        truth.append(ground_truth_label(filename))
+        local.append(prediction.label)
+        confidence.append(prediction.confidence)
+        llm.append(cached_label(cache[filename]))
+
+    truth, local, llm = np.array(truth, dtype=object), np.array(local, dtype=object), np.array(llm, dtype=object)
+    confidence = np.array(confidence)
+    local_correct, llm_correct = local == truth, llm == truth
+    count = len(filenames)
+
+    def ratio(numerator, denominator):
+        return float(numerator / denominator) if denominator else None
+
+    report = {"panels": count, "llm_accuracy": ratio(llm_correct.sum(), count), "thresholds": []}
+    for threshold in thresholds:
+        confident = confidence >= threshold
+        combined = np.where(confident, local_correct, llm_correct)
+        report["thresholds"].append({
+            "threshold": threshold,
+            "llm_calls_saved": int(confident.sum()),
+            "llm_calls_saved_ratio": ratio(confident.sum(), count),
+            "local_accuracy": ratio(local_correct[confident].sum(), confident.sum()),
+            "llm_accuracy_on_local_panels": ratio(llm_correct[confident].sum(), confident.sum()),
+            "combined_accuracy": ratio(combined.sum(), count)
+        })
+    return report
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the label recogniser evaluation.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Evaluate the local panel-label recogniser against the cached LLM answers.")
+    parser.add_argument('--image_dir', type=str, default='data/segmented_images/', help="Directory with the panel crops.")
+    parser.add_argument('--cache', type=str, default='data/panel_description_cache.jsonl', help="Panel description cache with the LLM answers.")
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.5, 0.6, 0.7, 0.8, 0.9], help="Confidence thresholds to report.")
+    parser.add_argument('--fonts', type=str, nargs='*', default=None, help="Extra TrueType fonts to render the label templates with.")
+    parser.add_argument('--limit', type=int, default=None, help="Maximum number of panels to evaluate.")
+    parser.add_argument('--output', type=str, default=None, help="Write the report to this JSON file.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    report = evaluate(args.image_dir, args.cache, LabelRecognizer(fonts=args.fonts), args.thresholds, args.limit)
+
+    print(f"{report['panels']} panels, LLM accuracy {report['llm_accuracy']}")
+    for row in report["thresholds"]:
+        print(f"confidence >= {row['threshold']:.2f}: {row['llm_calls_saved']} LLM calls saved "
+              f"({row['llm_calls_saved_ratio'] or 0:.1%}), local accuracy {row['local_accuracy']}, "
+              f"LLM accuracy on those panels {row['llm_accuracy_on_local_panels']}, combined accuracy {row['combined_accuracy']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -1,140 +1,813 @@
 import os
 import json
+import asyncio
+import hashlib
+import argparse
 from io import BytesIO
 from PIL import Image
-from assistants import map_panel_to_description
-import shutil
+import assistants
+import instrumentation
+from assistants import map_panel_to_description, amap_panel_to_description, map_figure_to_descriptions, amap_figure_to_descriptions
+from description_cache import open_cache, set_filename_alias
+from caption_store import CaptionStore
+from batch_requests import BatchLedger, ShardWriter, iter_batch_results, PENDING, DONE, FAILED
+from label_recognizer import LabelRecognizer, DEFAULT_CONFIDENCE, cached_label
+from caption_segmenter import panel_context
+from content_keys import image_digests, text_hash, content_key, NearDuplicateIndex, DEFAULT_MAX_DISTANCE
+from evaluation_shards import parse_shard, shard_of, inputs_fingerprint, load_shard, is_current, write_shard, merge_shards
+from failure_store import FailureStore
+from dataset_manifest import find_manifest, read_metadata, update_manifest, split_crop_name
 from tqdm import tqdm
 
 def load_image(image_path):
-    with open(image_path, 'rb') as f:
-        return BytesIO(f.read())
-
-def save_failure(image_path, caption, figure_path, output_dir, predicted_label):
-    os.makedirs(output_dir, exist_ok=True)
-
-    image_filename = os.path.basename(image_path)
-    output_image_path = os.path.join(output_dir, image_filename)
-    with open(output_image_path, 'wb') as f:
-        f.write(load_image(image_path).getvalue())
-
-    caption_filename = image_filename.replace('.png', '.txt')
-    output_caption_path = os.path.join(output_dir, caption_filename)
-    with open(output_caption_path, 'w') as f:
-        f.write(f"Caption: {caption}\nPredicted Label: {predicted_label}")
-
-    figure_filename = os.path.basename(figure_path)
-    output_figure_path = os.path.join(output_dir, figure_filename)
-    shutil.copyfile(figure_path, output_figure_path)
-
-def evaluate_accuracy(image_dir, captions_file, test_figures_dir, failure_dir, cache_file):
-    total_images = 0
-    correct_matches = 0
-    false_positives = 0
-    false_negatives = 0
-
-    # Load cached results
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r') as f:
-            cached_results = json.load(f)
-    else:
-        cached_results = {}
-
-    with open(captions_file, 'r') as f:
-        captions = [json.loads(line) for line in f]
+    with instrumentation.stage("image_load"), open(image_path, 'rb') as f:
+        data = f.read()
+    instrumentation.count("image_load_bytes", len(data))
+    return BytesIO(data)
+
+def clean_description(panel_description_json):
+    return panel_description_json.replace("```json", "").replace("```", "")
+
+def list_test_crops(image_dir, test_figures_dir):
+    """
+    `(filename, figure_id, panel_label)` of the panel crops in `image_dir` of the test figures.
+
+    They are read from the manifest of the test split when it maps the crops of
+    `image_dir` (see `dataset_manifest.py`), and by listing both directories otherwise.
+    """
+    path = find_manifest(test_figures_dir)
+    metadata = read_metadata(path) if path else None
+    if metadata is not None and metadata.get("crops_dir") and os.path.abspath(metadata["crops_dir"]) == os.path.abspath(image_dir):
+        return update_manifest(metadata["data"], metadata["split"], os.path.dirname(path)).crops()
 
     test_figures = set(os.path.splitext(f)[0] for f in os.listdir(test_figures_dir) if f.endswith('.jpg'))
+    crops = []
+    for filename in os.listdir(image_dir):
+        parsed = split_crop_name(filename)
+        if parsed is not None and parsed[0] in test_figures:
+            crops.append((filename, *parsed))
+    return crops
+
+def collect_panels(image_dir, captions, test_figures_dir, shard=None):
+    """
+    List the test-set panels in `image_dir` together with their figure caption.
+
+    Args:
+        image_dir (str): Directory with the panel crops, named `<figure_id>_<label>.png`.
+        captions (CaptionStore): Figure captions keyed by figure_id.
+        test_figures_dir (str): Directory with the test figures.
+        shard (tuple): Only list the panels of the figures of shard `(index, count)`.
+
+    Returns:
+        list: One dict per panel with filename, figure_id, panel_label, image_path and caption.
+    """
+    panels = []
+    for filename, figure_id, panel_label in list_test_crops(image_dir, test_figures_dir):
+        if shard is not None and shard_of(figure_id, shard[1]) != shard[0]:
+            continue
+
+        caption = captions.get(figure_id)
+        if not caption:
+            print(f"Caption for figure ID {figure_id} not found. Skipping.")
+            continue
+
+        panels.append({
+            "filename": filename,
+            "figure_id": figure_id,
+            "panel_label": panel_label,
+            "image_path": os.path.join(image_dir, filename),
+            "caption": caption
+        })
+    return panels
+
+def describe_panel(panel):
+    try:
+        return clean_description(map_panel_to_description(load_image(panel['image_path']), panel['caption']))
+    except Exception as e:
+        print(f"Error processing {panel['filename']}: {e}")
+        return None
+
+async def adescribe_panel(panel):
+    try:
+        return clean_description(await amap_panel_to_description(load_image(panel['image_path']), panel['caption']))
+    except Exception as e:
+        print(f"Error processing {panel['filename']}: {e}")
+        return None
+
+def describe_panels(panels, on_result):
+    """
+    Describe the panels one request at a time.
+
+    Args:
+        panels (list): Panels as returned by `collect_panels`.
+        on_result (callable): Called with `(filename, description)` for every new description.
+
+    Returns:
+        list: The cleaned descriptions in input order, None where the request failed.
+    """
+    descriptions = []
+    for panel in tqdm(panels, desc="Describing panels"):
+        description = describe_panel(panel)
+        if description is not None:
+            on_result(panel['filename'], description)
+        descriptions.append(description)
+    return descriptions
+
+async def describe_panels_async(panels, on_result, concurrency):
+    """
+    Describe the panels keeping up to `concurrency` requests in flight.
+
+    Panels are only read from disk once a request slot is free, so memory stays
+    bounded by the concurrency rather than by the size of the test set.
+
+    Args:
+        panels (list): Panels as returned by `collect_panels`.
+        on_result (callable): Called with `(filename, description)` as each description completes.
+        concurrency (int): Maximum number of concurrent requests.
+
+    Returns:
+        list: The cleaned descriptions in input order, None where the request failed.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = tqdm(total=len(panels), desc="Describing panels")
+
+    async def describe(panel):
+        async with semaphore:
+            description = await adescribe_panel(panel)
+            progress.update(1)
+        if description is not None:
+            on_result(panel['filename'], description)
+        return description
+
+    try:
+        return await asyncio.gather(*(describe(panel) for panel in panels))
+    finally:
+        progress.close()
+
+def group_panels_by_figure(panels, max_images_per_request):
+    """
+    Group panels by figure, splitting figures with many panels into several requests.
+
+    Args:
+        panels (list): Panels as returned by `collect_panels`.
+        max_images_per_request (int): Maximum number of panel images sent in one request.
+
+    Returns:
+        list: Lists of panels of the same figure, in order of first appearance.
+    """
+    figures = {}
+    for panel in panels:
+        figures.setdefault(panel['figure_id'], []).append(panel)
+
+    groups = []
+    for figure_panels in figures.values():
+        for start in range(0, len(figure_panels), max_images_per_request):
+            groups.append(figure_panels[start:start + max_images_per_request])
+    return groups
+
+def parse_figure_descriptions(response, group):
+    """
+    Split a figure-level answer into one description per panel of `group`.
+
+    The answer must be a JSON array (optionally wrapped in an object) with one
+    `{panel_label, panel_caption}` object per image, in the order the images were sent.
+
+    Returns:
+        list: Descriptions in the same format as the per-panel answers, or None if the
+        answer cannot be mapped onto the panels.
+    """
+    try:
+        items = json.loads(clean_description(response))
+    except json.JSONDecodeError:
+        return None
+
+    if isinstance(items, dict):
+        items = [items] if "panel_label" in items else next((value for value in items.values() if isinstance(value, list)), None)
+    if not isinstance(items, list) or len(items) != len(group):
+        return None
+    if not all(isinstance(item, dict) and "panel_label" in item for item in items):
+        return None
+
+    return [json.dumps(item, indent=4) for item in items]
+
+def describe_figure(group):
+    try:
+        response = map_figure_to_descriptions([load_image(panel['image_path']) for panel in group], group[0]['caption'])
+    except Exception as e:
+        print(f"Error processing figure {group[0]['figure_id']}: {e}")
+        return None
+    return parse_figure_descriptions(response, group)
+
+async def adescribe_figure(group):
+    try:
+        response = await amap_figure_to_descriptions([load_image(panel['image_path']) for panel in group], group[0]['caption'])
+    except Exception as e:
+        print(f"Error processing figure {group[0]['figure_id']}: {e}")
+        return None
+    return parse_figure_descriptions(response, group)
+
+def describe_figures(groups, on_result, fallback_panels):
+    """
+    Describe the panels one figure-level request at a time.
+
+    Groups whose answer cannot be mapped onto their panels are described again with
+    per-panel requests.
+
+    Args:
+        groups (list): Panel groups as returned by `group_panels_by_figure`.
+        on_result (callable): Called with `(filename, description)` for every new description.
+        fallback_panels (list): Collects the panels that needed a per-panel request.
+    """
+    for group in tqdm(groups, desc="Describing figures"):
+        descriptions = describe_figure(group)
+        if descriptions is None:
+            print(f"Falling back to per-panel requests for figure {group[0]['figure_id']}")
+            fallback_panels.extend(group)
+            descriptions = [describe_panel(panel) for panel in group]
+
+        for panel, description in zip(group, descriptions):
+            if description is not None:
+                on_result(panel['filename'], description)
+
+async def describe_figures_async(groups, on_result, concurrency, fallback_panels):
+    """
+    Describe the panel groups keeping up to `concurrency` requests in flight.
+
+    Args:
+        groups (list): Panel groups as returned by `group_panels_by_figure`.
+        on_result (callable): Called with `(filename, description)` as each description completes.
+        concurrency (int): Maximum number of concurrent requests.
+        fallback_panels (list): Collects the panels that needed a per-panel request.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = tqdm(total=len(groups), desc="Describing figures")
+
+    async def describe(group):
+        async with semaphore:
+            descriptions = await adescribe_figure(group)
+
+        if descriptions is None:
+            print(f"Falling back to per-panel requests for figure {group[0]['figure_id']}")
+            fallback_panels.extend(group)
+            descriptions = []
+            for panel in group:
+                async with semaphore:
+                    descriptions.append(await adescribe_panel(panel))
+
+        for panel, description in zip(group, descriptions):
+            if description is not None:
+                on_result(panel['filename'], description)
+        progress.update(1)
+
+    try:
+        await asyncio.gather(*(describe(group) for group in groups))
+    finally:
+        progress.close()
+
+def estimate_panel_image_tokens(panel):
+    width, height = assistants.encoder.target_size(*Image.open(panel['image_path']).size)
+    return assistants.estimate_image_tokens(width, height, assistants.encoder.detail)
+
+def estimate_panel_prompt_tokens(panel):
+    return (assistants.estimate_text_tokens(assistants.SYSTEM_PROMPT)
+            + assistants.estimate_text_tokens(panel['caption'])
+            + estimate_panel_image_tokens(panel))
+
+def estimate_figure_prompt_tokens(group):
+    tokens = assistants.estimate_text_tokens(assistants.FIGURE_SYSTEM_PROMPT) + assistants.estimate_text_tokens(group[0]['caption'])
+    for position, panel in enumerate(group, start=1):
+        tokens += assistants.estimate_text_tokens(f"Image {position}:") + estimate_panel_image_tokens(panel)
+    return tokens
+
+def report_grouping_savings(groups, fallback_panels):
+    """
+    Print the requests and estimated prompt tokens of the figure-grouped run against
+    what describing every panel separately would have cost.
+
+    Returns:
+        dict: The request and token counts of both modes.
+    """
+    panels = [panel for group in groups for panel in group]
+    fallback_filenames = set(panel['filename'] for panel in fallback_panels)
+
+    per_panel_tokens = sum(estimate_panel_prompt_tokens(panel) for panel in panels)
+    grouped_tokens = sum(
+        estimate_figure_prompt_tokens(group) for group in groups
+    ) + sum(estimate_panel_prompt_tokens(panel) for panel in panels if panel['filename'] in fallback_filenames)
+
+    report = {
+        "panels": len(panels),
+        "per_panel_requests": len(panels),
+        "grouped_requests": len(groups) + len(fallback_panels),
+        "fallback_panels": len(fallback_panels),
+        "per_panel_prompt_tokens_estimate": per_panel_tokens,
+        "grouped_prompt_tokens_estimate": grouped_tokens,
+        "observed_prompt_tokens": assistants.usage_totals["prompt_tokens"],
+        "observed_completion_tokens": assistants.usage_totals["completion_tokens"]
+    }
+
+    if panels:
+        print(f"Requests: {report['grouped_requests']} instead of {report['per_panel_requests']} "
+              f"({report['grouped_requests'] / report['per_panel_requests']:.1%}, {len(fallback_panels)} panels fell back to per-panel requests)")
+        print(f"Estimated prompt tokens: {grouped_tokens} instead of {per_panel_tokens} "
+              f"({grouped_tokens / per_panel_tokens:.1%}); observed {report['observed_prompt_tokens']}")
+    return report
+
+def assign_content_keys(panels):
+    """
+    Set the description cache key of every panel: a digest of the decoded pixels and a
+    perceptual hash of the crop, a hash of the figure caption and the prompt version, so
+    answers are reused across re-encoding, renamed files and other splits as long as
+    pixels and caption match.
+    """
+    for panel in tqdm(panels, desc="Hashing panels"):
+        with instrumentation.stage("content_key"):
+            pixels, image_digest = image_digests(panel['image_path'])
+            panel['key'] = content_key(pixels, image_digest, text_hash(panel['caption']), assistants.PROMPT_VERSION)
+
+def reuse_cached_descriptions(panels, cached_results, max_distance=DEFAULT_MAX_DISTANCE, recognizer=None,
+                              min_confidence=DEFAULT_CONFIDENCE):
+    """
+    Make the cached answers of the panels available under their content keys.
 
-    for filename in tqdm(os.listdir(image_dir), desc="Processing images"):
-        if filename.endswith(".png"):
-            figure_id, panel_label = filename.rsplit('_', 1)
-            panel_label = panel_label.split('.')[0]
+    Legacy filename-keyed answers are migrated first: the answer of every panel whose
+    filename is cached but whose content key is not is stored again under its content
+    key, whichever run, shard or image directory wrote the other keys. Panels still
+    missing then take the answer of the nearest cached crop of the same caption and
+    prompt version, if its hash is at most `max_distance` bits away (e.g. the same
+    panel cut with a slightly different box). The hash barely sees the panel label, so
+    a candidate is skipped if it is the crop of another panel of the same figure in
+    this run, or if `recognizer` confidently reads a label that disagrees with the
+    cached one.
 
-            if figure_id not in test_figures:
+    Returns:
+        dict: Number of panels found by exact key, migrated, matched as near
+        duplicates and near-duplicate candidates rejected.
+    """
+    report = {"exact": 0, "migrated": 0, "near_duplicates": 0, "rejected": 0}
+    migrated = {panel['key']: cached_results[panel['filename']] for panel in panels
+                if panel['key'] not in cached_results and panel['filename'] in cached_results}
+    if migrated:
+        cached_results.update(migrated)
+        report["migrated"] = len(migrated)
+        print(f"Migrated {len(migrated)} filename-keyed descriptions to content keys")
+    keys = list(cached_results.keys())
+
+    index = NearDuplicateIndex(keys, max_distance) if max_distance else None
+    figure_keys = {}
+    for panel in panels:
+        figure_keys.setdefault(panel['figure_id'], set()).add(panel['key'])
+    for panel in panels:
+        if panel['key'] in cached_results:
+            report["exact"] += 1
+            continue
+        if index is None:
+            continue
+        prediction = None
+        for candidate, _ in index.candidates(panel['key']):
+            if candidate in figure_keys[panel['figure_id']]:
+                # Another panel of this figure: the hash may only differ by the label
+                report["rejected"] += 1
                 continue
+            description = cached_results[candidate]
+            if recognizer is not None:
+                if prediction is None:
+                    with instrumentation.stage("local_label"):
+                        prediction = recognizer.recognize(panel['image_path'])
+                if prediction.confidence >= min_confidence and prediction.label != cached_label(description):
+                    report["rejected"] += 1
+                    continue
+            cached_results.put(panel['key'], description)
+            report["near_duplicates"] += 1
+            break
+    report["exact"] -= report["migrated"]
+    instrumentation.count("description_cache_near_duplicates", report["near_duplicates"])
+    instrumentation.count("description_cache_near_duplicates_rejected", report["rejected"])
+    if report["near_duplicates"] or report["rejected"]:
+        print(f"Reused the descriptions of {report['near_duplicates']} near-duplicate panels "
+              f"({report['rejected']} candidates rejected as other panels or by their label)")
+    return report
+
+def report_scheduling(uncached, cached_results):
+    """
+    Print the retries and rate limiting of the requests, and the panels still without a description.
+    """
+    report = assistants.scheduler.report()
+    print(f"Requests: {report['requests']} ({report['retries']} retries: {report['rate_limited']} rate limited, "
+          f"{report['timeouts']} timeouts, {report['server_errors']} server errors); final concurrency {report['concurrency']}")
+    missing = [panel['filename'] for panel in uncached if panel['key'] not in cached_results]
+    if missing:
+        print(f"{len(missing)} panels could not be described and are left out of the accuracy; rerun to retry them")
+    return report
+
+def recognize_labels(panels, recognizer):
+    """
+    Recognise the label of every panel on the CPU.
+
+    Args:
+        panels (list): Panels as returned by `collect_panels`.
+        recognizer (LabelRecognizer): The local label recogniser, or None to recognise nothing.
+
+    Returns:
+        dict: The `LabelPrediction` of each panel, keyed by filename.
+    """
+    if recognizer is None:
+        return {}
+    predictions = {}
+    for panel in tqdm(panels, desc="Recognising labels"):
+        with instrumentation.stage("local_label"):
+            predictions[panel['filename']] = recognizer.recognize(panel['image_path'])
+    return predictions
+
+def confident_labels(predictions, min_confidence):
+    """
+    The labels predicted with at least `min_confidence`, keyed by filename; none if it is None.
+    """
+    if min_confidence is None:
+        return {}
+    return {filename: prediction.label for filename, prediction in predictions.items() if prediction.confidence >= min_confidence}
 
-            image_path = os.path.join(image_dir, filename)
-            panel_image = load_image(image_path)
+def narrow_captions(panels, captions, labels):
+    """
+    Replace the caption of the panels with a predicted label by the preamble and the
+    segments of that label (see `caption_segmenter`).
 
-            caption = next((item['figure_caption'] for item in captions if item['figure_id'] == figure_id), None)
-            if not caption:
-                print(f"Caption for figure ID {figure_id} not found. Skipping.")
+    Args:
+        panels (list): Panels as returned by `collect_panels`; their caption is replaced in place.
+        captions (CaptionStore): Figure captions and their stored segmentations.
+        labels (dict): Predicted labels keyed by filename.
+
+    Returns:
+        dict: Number of narrowed panels and the estimated caption tokens before and after.
+    """
+    report = {"panels": len(panels), "narrowed_panels": 0, "full_caption_tokens": 0, "caption_tokens": 0}
+    for panel in panels:
+        full_tokens = assistants.estimate_text_tokens(panel['caption'])
+        label = labels.get(panel['filename'])
+        if label is not None:
+            context = panel_context(panel['caption'], captions.segments(panel['figure_id']), label)
+            if context != panel['caption']:
+                panel['caption'] = context
+                report["narrowed_panels"] += 1
+        report["full_caption_tokens"] += full_tokens
+        report["caption_tokens"] += assistants.estimate_text_tokens(panel['caption'])
+
+    if report["full_caption_tokens"]:
+        print(f"Narrowed the caption of {report['narrowed_panels']} of {len(panels)} panels to their segment: "
+              f"{report['caption_tokens']} caption tokens instead of {report['full_caption_tokens']} "
+              f"({report['caption_tokens'] / report['full_caption_tokens']:.1%})")
+    return report
+
+def report_local_labels(panels, local_labels, cached_keys, cached_results):
+    """
+    Print the LLM calls the local labels saved and how they agree with the cached LLM answers.
+
+    Args:
+        panels (list): Panels as returned by `collect_panels`.
+        local_labels (dict): Local labels as returned by `confident_labels`.
+        cached_keys (set): Cache keys of the panels already cached before this run.
+        cached_results: The panel description cache.
+
+    Returns:
+        dict: Panel counts and the agreement with the LLM where both labels are known.
+    """
+    saved = sum(1 for panel in panels if panel['filename'] in local_labels and panel['key'] not in cached_keys)
+    compared = agreed = 0
+    for panel in panels:
+        if panel['filename'] in local_labels and panel['key'] in cached_results:
+            try:
+                llm_label = json.loads(cached_results[panel['key']]).get("panel_label")
+            except json.JSONDecodeError:
                 continue
+            compared += 1
+            agreed += llm_label == local_labels[panel['filename']]
+    report = {"panels": len(panels), "local_labels": len(local_labels), "llm_calls_saved": saved,
+              "compared_with_llm": compared, "agreed_with_llm": agreed}
+    print(f"Labelled {len(local_labels)} of {len(panels)} panels locally, saving {saved} LLM calls"
+          + (f"; they agree with {agreed} of the {compared} cached LLM labels" if compared else ""))
+    return report
 
-            if filename in cached_results:
-                panel_description_json = cached_results[filename]
+def evaluation_settings(recognizer=None, label_confidence=DEFAULT_CONFIDENCE, segment_confidence=None,
+                        group_by_figure=False, max_hash_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Settings that decide the predicted labels, recorded in the fingerprint of every shard result.
+    """
+    return {
+        "prompt_version": assistants.PROMPT_VERSION,
+        "local_labels": None if recognizer is None or label_confidence is None else {"confidence": label_confidence, "fonts": recognizer.fonts},
+        "segment_confidence": segment_confidence,
+        "group_by_figure": group_by_figure,
+        "max_hash_distance": max_hash_distance
+    }
+
+def shard_fingerprints(image_dir, captions_file, test_figures_dir, count, settings):
+    """
+    Current input fingerprint of each of the `count` shards, to tell which stored shard results are stale.
+    """
+    with CaptionStore(captions_file) as captions:
+        panels = collect_panels(image_dir, captions, test_figures_dir)
+    shards = {index: [] for index in range(count)}
+    for panel in panels:
+        shards[shard_of(panel['figure_id'], count)].append(panel)
+    return {index: inputs_fingerprint(shard_panels, settings) for index, shard_panels in shards.items()}
+
+def evaluate_accuracy(image_dir, captions_file, test_figures_dir, failure_dir, cache_file, concurrency=1,
+                      group_by_figure=False, max_images_per_request=8, recognizer=None, label_confidence=DEFAULT_CONFIDENCE,
+                      segment_confidence=None, max_hash_distance=DEFAULT_MAX_DISTANCE, shard=(0, 1),
+                      shard_dir='data/results_shards/', force=False):
+    """
+    Evaluate the label predictions of the panels of one shard of the test figures.
+
+    The shard results are stored in `shard_dir` and reused as long as the panels, their
+    captions and the settings are unchanged and every panel was described, unless `force`.
+
+    Returns:
+        dict: The shard result as written by `write_shard`.
+    """
+    index, count = shard
+    settings = evaluation_settings(recognizer, label_confidence, segment_confidence, group_by_figure, max_hash_distance)
+
+    with open_cache(cache_file) as cached_results, CaptionStore(captions_file) as captions:
+        panels = collect_panels(image_dir, captions, test_figures_dir, shard)
+        fingerprint = inputs_fingerprint(panels, settings)
+        stored = load_shard(shard_dir, index, count)
+        if not force and is_current(stored, fingerprint):
+            print(f"Shard {index}/{count} is up to date ({stored['counts']['panels']} panels)")
+            instrumentation.count("shards_reused")
+            return stored
+
+        assign_content_keys(panels)
+        reuse_cached_descriptions(panels, cached_results, max_hash_distance, recognizer)
+        keys = {panel['filename']: panel['key'] for panel in panels}
+
+        def on_result(filename, description):
+            with instrumentation.stage("cache_write"):
+                cached_results.put(keys[filename], description)
+
+        # Confidently recognised panels are scored with their local label and never sent to the LLM
+        predictions = recognize_labels(panels, recognizer)
+        local_labels = confident_labels(predictions, label_confidence)
+        cached_keys = set(panel['key'] for panel in panels if panel['key'] in cached_results)
+        uncached = [panel for panel in panels if panel['key'] not in cached_keys and panel['filename'] not in local_labels]
+        instrumentation.count("description_cache_hits", len(cached_keys))
+        instrumentation.count("description_cache_misses", len(panels) - len(cached_keys))
+        instrumentation.count("local_labels", len(local_labels))
+        if segment_confidence is not None and not group_by_figure:
+            # Figure-level requests keep the whole caption, which all their panels share
+            narrow_captions(uncached, captions, confident_labels(predictions, segment_confidence))
+
+        with instrumentation.stage("describe"):
+            if group_by_figure:
+                groups = group_panels_by_figure(uncached, max_images_per_request)
+                fallback_panels = []
+                if concurrency > 1:
+                    asyncio.run(describe_figures_async(groups, on_result, concurrency, fallback_panels))
+                else:
+                    describe_figures(groups, on_result, fallback_panels)
+                report_grouping_savings(groups, fallback_panels)
+            elif concurrency > 1:
+                asyncio.run(describe_panels_async(uncached, on_result, concurrency))
             else:
-                try:
-                    panel_description_json = map_panel_to_description(panel_image, caption)
-                    panel_description_json = panel_description_json.replace("```json", "").replace("```", "")
-                    cached_results[filename] = panel_description_json
-
-                    # Save cached result after each iteration
-                    with open(cache_file, 'w') as f:
-                        json.dump(cached_results, f, indent=4)
-                except Exception as e:
-                    print(f"Error processing {filename}: {e}")
+                describe_panels(uncached, on_result)
+        report_scheduling(uncached, cached_results)
+        if local_labels:
+            report_local_labels(panels, local_labels, cached_keys, cached_results)
+
+        outcomes = []
+        failures = []
+        with FailureStore(failure_dir) as failure_store:
+            for panel in tqdm(panels, desc="Processing images"):
+                filename = panel['filename']
+                outcome = {"filename": filename, "expected": panel['panel_label'], "predicted": None, "described": False}
+                outcomes.append(outcome)
+                if filename in local_labels:
+                    predicted_label = local_labels[filename]
+                elif panel['key'] not in cached_results:
                     continue
+                else:
+                    # Lets filename-keyed readers (`load_cache`, the notebooks) find the description
+                    set_filename_alias(cached_results, filename, panel['key'])
+                    try:
+                        with instrumentation.stage("cache_read"):
+                            panel_description = json.loads(cached_results[panel['key']])
+                    except json.JSONDecodeError as e:
+                        print(f"Error decoding JSON for {filename}: {e}")
+                        continue
+                    predicted_label = panel_description.get("panel_label")
 
-            try:
-                panel_description = json.loads(panel_description_json)
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON for {filename}: {e}")
+                outcome["predicted"] = predicted_label
+                outcome["described"] = True
+                if predicted_label != panel['panel_label']:
+                    figure_path = os.path.join(test_figures_dir, f"{panel['figure_id']}.jpg")
+                    failure = {"filename": filename, "figure_id": panel['figure_id'], "expected": panel['panel_label'],
+                               "predicted": predicted_label, "image_path": panel['image_path'], "figure_path": figure_path}
+                    failure_store.add(caption=panel['caption'], **failure)
+                    failures.append(failure)
+
+    return write_shard(shard_dir, index, count, fingerprint, outcomes, failures)
+
+def batch_custom_id(group, figure_level):
+    """
+    Stable custom_id of a Batch API request: the panel filename, or the figure and a
+    digest of its panels for figure-level requests.
+    """
+    if not figure_level:
+        return f"panel:{group[0]['filename']}"
+    digest = hashlib.sha1('\n'.join(panel['filename'] for panel in group).encode('utf-8')).hexdigest()[:12]
+    return f"figure:{group[0]['figure_id']}:{digest}"
+
+def batch_ledger_path(batch_dir):
+    return os.path.join(batch_dir, 'ledger.jsonl')
+
+def write_batch(image_dir, captions_file, test_figures_dir, cache_file, batch_dir, group_by_figure=False,
+                max_images_per_request=8, include_pending=False, recognizer=None, label_confidence=DEFAULT_CONFIDENCE,
+                segment_confidence=None, max_hash_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Write the requests of every uncached panel to Batch API input shards in `batch_dir`.
+
+    Panels whose request is already pending in the ledger are skipped, so running this
+    again before the results are ingested does not duplicate requests. With a
+    `recognizer`, confidently labelled panels are skipped as well, and with a
+    `segment_confidence` the per-panel requests carry the caption segment of the
+    predicted label only.
+
+    Returns:
+        list: Paths of the written shards.
+    """
+    with open_cache(cache_file) as cached_results, CaptionStore(captions_file) as captions, BatchLedger(batch_ledger_path(batch_dir)) as ledger:
+        pending = set() if include_pending else ledger.pending_filenames()
+        panels = collect_panels(image_dir, captions, test_figures_dir)
+        assign_content_keys(panels)
+        reuse_cached_descriptions(panels, cached_results, max_hash_distance, recognizer)
+        panels = [panel for panel in panels if panel['key'] not in cached_results and panel['filename'] not in pending]
+        predictions = recognize_labels(panels, recognizer)
+        local_labels = confident_labels(predictions, label_confidence)
+        panels = [panel for panel in panels if panel['filename'] not in local_labels]
+        if segment_confidence is not None and not group_by_figure:
+            narrow_captions(panels, captions, confident_labels(predictions, segment_confidence))
+
+        writer = ShardWriter(batch_dir, ledger)
+        if group_by_figure:
+            for group in tqdm(group_panels_by_figure(panels, max_images_per_request), desc="Writing figure requests"):
+                messages = assistants.build_figure_messages([load_image(panel['image_path']) for panel in group], group[0]['caption'])
+                writer.write(batch_custom_id(group, True), [panel['filename'] for panel in group], assistants.request_body(messages),
+                             [panel['key'] for panel in group])
+        else:
+            for panel in tqdm(panels, desc="Writing panel requests"):
+                messages = assistants.build_panel_messages(load_image(panel['image_path']), panel['caption'])
+                writer.write(batch_custom_id([panel], False), [panel['filename']], assistants.request_body(messages), [panel['key']])
+        shards = writer.close()
+
+    print(f"Wrote {len(panels)} panels to {len(shards)} shards in {batch_dir} ({len(pending)} panels already pending)")
+    return shards
+
+def ingest_batch(results_file, cache_file, batch_dir):
+    """
+    Merge a Batch API output file into the panel description cache.
+
+    Requests are looked up in the ledger: answers are cached and marked done, failed
+    requests and unparseable answers are marked failed so that `write_batch` writes
+    their panels again, and custom_ids already ingested are ignored.
+
+    Returns:
+        dict: Number of ingested, failed, duplicate and unknown results.
+    """
+    counts = {"ingested": 0, "failed": 0, "duplicates": 0, "unknown": 0}
+    with open_cache(cache_file) as cached_results, BatchLedger(batch_ledger_path(batch_dir)) as ledger:
+        for custom_id, content, error in iter_batch_results(results_file):
+            entry = ledger.get(custom_id)
+            if entry is None:
+                counts["unknown"] += 1
+                continue
+            if entry["status"] == DONE:
+                counts["duplicates"] += 1
                 continue
 
-            predicted_label = panel_description.get("panel_label")
-            if predicted_label == panel_label:
-                correct_matches += 1
-            else:
-                figure_path = os.path.join(test_figures_dir, f"{figure_id}.jpg")
-                save_failure(image_path, caption, figure_path, failure_dir, predicted_label)
-                
-                if predicted_label:  # If a label was predicted, it's a false positive
-                    false_positives += 1
-                else:  # If no label was predicted but it should have been, it's a false negative
-                    false_negatives += 1
-                    
-            total_images += 1
-
-    accuracy = correct_matches / total_images if total_images > 0 else 0
-    return accuracy, false_positives, false_negatives
-
-def save_results(results_file, accuracy, false_positives, false_negatives):
-    results = {
-        "accuracy": accuracy,
-        "false_positives": false_positives,
-        "false_negatives": false_negatives
-    }
+            filenames = entry["filenames"]
+            descriptions = None
+            if content is not None:
+                descriptions = parse_figure_descriptions(content, filenames) if custom_id.startswith("figure:") else [clean_description(content)]
+            if descriptions is None:
+                print(f"Request {custom_id} failed: {error or 'the answer does not match its panels'}")
+                ledger.set(custom_id, filenames, FAILED, entry["shard"], entry.get("keys"))
+                counts["failed"] += 1
+                continue
+
+            cached_results.update(dict(zip(entry.get("keys") or filenames, descriptions)))
+            for filename, key in zip(filenames, entry.get("keys") or []):
+                set_filename_alias(cached_results, filename, key)
+            ledger.set(custom_id, filenames, DONE, entry["shard"], entry.get("keys"))
+            counts["ingested"] += 1
+
+        pending = sum(1 for _ in ledger.entries(PENDING))
+    print(f"Ingested {counts['ingested']} requests, {counts['failed']} failed, {counts['duplicates']} already ingested, "
+          f"{counts['unknown']} unknown; {pending} still pending")
+    return counts
+
+def save_results(results_file, results):
     with open(results_file, 'w') as f:
         json.dump(results, f, indent=4)
 
-def load_results(results_file):
-    if os.path.exists(results_file):
-        with open(results_file, 'r') as f:
-            return json.load(f)
-    return None
+def parse_arguments():
+    """
+    Parse command-line arguments for the panel label matching evaluation.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Match segmented panels to their panel captions and evaluate the label accuracy.")
+    parser.add_argument('--image_dir', type=str, default='data/segmented_images/', help="Directory with the panel crops.")
+    parser.add_argument('--captions', type=str, default='data/figure_captions.jsonl', help="Path to the figure captions JSONL file.")
+    parser.add_argument('--test_figures', type=str, default='data/soda_panelization_figures/test/images', help="Directory with the test figures.")
+    parser.add_argument('--failure_dir', type=str, default='data/failures/', help="Content-addressed store of the mismatched panels, their figures and captions.")
+    parser.add_argument('--cache', type=str, default='data/panel_description_cache.jsonl', help="Path to the panel description cache (.jsonl or .sqlite); the legacy .json file next to it is migrated on first use.")
+    parser.add_argument('--results', type=str, default='data/results.json', help="Path to the results JSON file.")
+    parser.add_argument('--shard', type=str, default=None, help="Only evaluate shard i/N of the test figures (e.g. 0/4), split by a hash of the figure_id.")
+    parser.add_argument('--merge', type=int, default=None, metavar='N', help="Merge the results of the N shards of a sharded run into --results.")
+    parser.add_argument('--shard_dir', type=str, default='data/results_shards/', help="Directory of the per-shard results and failures.")
+    parser.add_argument('--force', action='store_true', help="Evaluate the shard again even if its stored results are up to date.")
+    parser.add_argument('--concurrency', type=int, default=1, help="Number of LLM requests kept in flight (1 runs them serially).")
+    parser.add_argument('--detail', type=str, default="high", choices=["low", "high", "auto"], help="Detail level requested for the panel images.")
+    parser.add_argument('--max_side', type=int, default=None, help="Maximum length of the longest side of the uploaded panels.")
+    parser.add_argument('--max_bytes', type=int, default=None, help="Maximum size of each uploaded panel in bytes.")
+    parser.add_argument('--encoded_cache_dir', type=str, default='data/encoded_panels/', help="Directory where encoded panel payloads are cached.")
+    parser.add_argument('--group_by_figure', action='store_true', help="Describe all the panels of a figure in a single request.")
+    parser.add_argument('--max_images_per_request', type=int, default=8, help="Maximum number of panel images per figure-level request.")
+    parser.add_argument('--local_labels', action='store_true', help="Recognise the panel labels on the CPU and only ask the LLM about the uncertain panels.")
+    parser.add_argument('--label_confidence', type=float, default=DEFAULT_CONFIDENCE, help="Confidence from which a local label is used instead of the LLM.")
+    parser.add_argument('--label_fonts', type=str, nargs='*', default=None, help="Extra TrueType fonts for the local label templates.")
+    parser.add_argument('--segment_captions', action='store_true', help="Send per-panel requests only the caption segment of the locally predicted label.")
+    parser.add_argument('--segment_confidence', type=float, default=0.5, help="Confidence from which a predicted label selects the caption segment.")
+    parser.add_argument('--max_hash_distance', type=int, default=DEFAULT_MAX_DISTANCE, help="Bits the perceptual hash of a near-duplicate crop may differ by to reuse its cached description (0 only reuses identical crops).")
+    parser.add_argument('--write_batch', action='store_true', help="Write the requests of the uncached panels to Batch API shards instead of calling the API.")
+    parser.add_argument('--ingest_batch', type=str, default=None, help="Merge this Batch API output file into the cache.")
+    parser.add_argument('--batch_dir', type=str, default='data/batch/', help="Directory with the Batch API shards and their ledger.")
+    parser.add_argument('--include_pending', action='store_true', help="With --write_batch, also write panels whose requests are still pending.")
+    parser.add_argument('--rpm', type=int, default=None, help="Requests-per-minute budget (learned from the rate-limit headers if omitted).")
+    parser.add_argument('--tpm', type=int, default=None, help="Tokens-per-minute budget (learned from the rate-limit headers if omitted).")
+    parser.add_argument('--max_retries', type=int, default=6, help="Retries of a rate-limited, timed-out or failed request.")
+    parser.add_argument('--timeout', type=float, default=None, help="Request timeout in seconds.")
+    parser.add_argument('--metrics', type=str, default=None, help="Record per-stage timings, tokens, bytes and cache hit ratios and write them to this file (.prom for the Prometheus text format, JSON otherwise).")
+
+    return parser.parse_args()
 
 def main():
-    image_dir = 'data/segmented_images/'
-    captions_file = 'data/figure_captions.jsonl'
-    test_figures_dir = 'data/soda_panelization_figures/test/images'
-    failure_dir = 'data/failures/'
-    cache_file = 'data/panel_description_cache.json'
-    results_file = 'data/results.json'
-
-    # Check if results are already computed and saved
-    results = load_results(results_file)
-    if results:
-        accuracy = results["accuracy"]
-        false_positives = results["false_positives"]
-        false_negatives = results["false_negatives"]
-    else:
-        accuracy, false_positives, false_negatives = evaluate_accuracy(image_dir, captions_file, test_figures_dir, failure_dir, cache_file)
-        save_results(results_file, accuracy, false_positives, false_negatives)
-
-    print(f"Accuracy: {accuracy * 100:.2f}%")
-    print(f"False Positives: {false_positives}")
-    print(f"False Negatives: {false_negatives}")
+    args = parse_arguments()
+    with instrumentation.recording(args.metrics):
+        run_matching(args)
+
+def run_matching(args):
+    assistants.configure_encoder(detail=args.detail, max_side=args.max_side, max_bytes=args.max_bytes, cache_dir=args.encoded_cache_dir)
+    assistants.configure_scheduler(rpm=args.rpm, tpm=args.tpm, max_concurrency=args.concurrency, max_retries=args.max_retries, timeout=args.timeout)
+    recognizer = LabelRecognizer(fonts=args.label_fonts) if args.local_labels or args.segment_captions else None
+    label_confidence = args.label_confidence if args.local_labels else None
+    segment_confidence = args.segment_confidence if args.segment_captions else None
+
+    if args.write_batch:
+        write_batch(args.image_dir, args.captions, args.test_figures, args.cache, args.batch_dir,
+                    group_by_figure=args.group_by_figure, max_images_per_request=args.max_images_per_request,
+                    include_pending=args.include_pending, recognizer=recognizer, label_confidence=label_confidence,
+                    segment_confidence=segment_confidence, max_hash_distance=args.max_hash_distance)
+        return
+    if args.ingest_batch:
+        ingest_batch(args.ingest_batch, args.cache, args.batch_dir)
+        return
+
+    shard = parse_shard(args.shard) if args.shard else (0, 1)
+    if args.merge is None:
+        # Shard results are reused as long as their inputs are unchanged
+        result = evaluate_accuracy(
+            args.image_dir, args.captions, args.test_figures, args.failure_dir, args.cache,
+            concurrency=args.concurrency,
+            group_by_figure=args.group_by_figure,
+            max_images_per_request=args.max_images_per_request,
+            recognizer=recognizer,
+            label_confidence=label_confidence,
+            segment_confidence=segment_confidence,
+            max_hash_distance=args.max_hash_distance,
+            shard=shard,
+            shard_dir=args.shard_dir,
+            force=args.force
+        )
+        if shard[1] > 1:
+            counts = result["counts"]
+            print(f"Shard {shard[0]}/{shard[1]}: {counts['correct']} of {counts['total']} panels correct, "
+                  f"{counts['missing']} without a description. Merge the shards with --merge {shard[1]}.")
+            return
+
+    count = args.merge or 1
+    settings = evaluation_settings(recognizer, label_confidence, segment_confidence, args.group_by_figure, args.max_hash_distance)
+    fingerprints = shard_fingerprints(args.image_dir, args.captions, args.test_figures, count, settings)
+    results, rerun = merge_shards(args.shard_dir, count, fingerprints)
+    for index, reason in rerun:
+        print(f"Shard {index}/{count} needs to be run again ({reason}): --shard {index}/{count}")
+    if results is None:
+        return
+    save_results(args.results, results)
+
+    print(f"Accuracy: {results['accuracy'] * 100:.2f}%")
+    print(f"False Positives: {results['false_positives']}")
+    print(f"False Negatives: {results['false_negatives']}")
 
 if __name__ == "__main__":
     main()
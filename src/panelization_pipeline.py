@@ -0,0 +1,333 @@
+# src/panelization_pipeline.py
+
+import os
+import json
+import queue
+import argparse
+import threading
+from PIL import Image
+from tqdm import tqdm
+import assistants
+import instrumentation
+from assistants import map_panel_to_description, map_figure_to_descriptions
+from caption_store import CaptionStore
+from description_cache import open_cache
+from content_keys import pixel_digest, image_hash, text_hash, content_key
+from detectors import load_detector, crop_panels
+from aspect_batching import AspectRatioBatcher
+from panel_label_matching import clean_description, parse_figure_descriptions
+
+# Marks the end of a stage's output on its queue
+END = object()
+
+def list_figures(figures_dir):
+    """
+    List the figure images of a directory as `(figure_id, path)` pairs.
+    """
+    return [
+        (os.path.splitext(filename)[0], os.path.join(figures_dir, filename))
+        for filename in sorted(os.listdir(figures_dir))
+        if filename.lower().endswith(('.jpg', '.jpeg', '.png'))
+    ]
+
+def crop_key(crop, caption):
+    """
+    Description cache key of an in-memory crop, the same as `assign_content_keys` gives its file.
+    """
+    with instrumentation.stage("content_key"):
+        return content_key(pixel_digest(crop), image_hash(crop), text_hash(caption), assistants.PROMPT_VERSION)
+
+def describe_crops(crops, caption, max_images_per_request, cache=None):
+    """
+    Describe the crops of one figure with figure-level requests, falling back to
+    per-panel requests when an answer cannot be mapped onto the crops.
+
+    With a description `cache`, crops whose content key is cached are not sent, and
+    new answers are stored under their keys.
+
+    Returns:
+        list: One parsed `{panel_label, panel_caption}` dict (or None) per crop.
+    """
+    answers = [None] * len(crops)
+    keys = [None] * len(crops)
+    if cache is not None:
+        keys = [crop_key(crop, caption) for crop in crops]
+        answers = [cache.get(key) for key in keys]
+        hits = sum(1 for answer in answers if answer is not None)
+        instrumentation.count("description_cache_hits", hits)
+        instrumentation.count("description_cache_misses", len(crops) - hits)
+
+    missing = [index for index, answer in enumerate(answers) if answer is None]
+    for start in range(0, len(missing), max_images_per_request):
+        indices = missing[start:start + max_images_per_request]
+        group = [crops[index] for index in indices]
+        try:
+            parsed = parse_figure_descriptions(map_figure_to_descriptions(group, caption), group)
+        except Exception as e:
+            print(f"Error describing {len(group)} panels at once: {e}")
+            parsed = None
+
+        if parsed is None:
+            parsed = []
+            for crop in group:
+                try:
+                    parsed.append(clean_description(map_panel_to_description(crop, caption)))
+                except Exception as e:
+                    print(f"Error describing a panel: {e}")
+                    parsed.append(None)
+
+        for index, description in zip(indices, parsed):
+            answers[index] = description
+            if description is not None and cache is not None:
+                cache.put(keys[index], description)
+
+    descriptions = []
+    for answer in answers:
+        try:
+            descriptions.append(json.loads(answer) if answer is not None else None)
+        except json.JSONDecodeError:
+            descriptions.append(None)
+    return descriptions
+
+class PanelizationPipeline:
+    """
+    Streaming figure -> panels -> captions pipeline.
+
+    Figures flow through bounded queues between a loader thread, a detection thread
+    that runs the detector on batches of figures (grouped into aspect-ratio buckets
+    when a `batcher` is given) and crops the panels in memory, and
+    `concurrency` description threads calling the LLM. Results are yielded per figure
+    in input order; crops only reach the disk when `debug_crops_dir` is set. Answers are
+    looked up in and added to the description `cache` by content key, so replays only
+    pay for new panels.
+    """
+
+    def __init__(self, detector, captions=None, batch_size=8, queue_size=32, concurrency=4,
+                 max_images_per_request=8, describe=True, debug_crops_dir=None, batcher=None, cache=None):
+        self.detector = detector
+        self.batcher = batcher
+        self.captions = captions
+        self.cache = cache
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.max_images_per_request = max_images_per_request
+        self.describe = describe and captions is not None
+        self.debug_crops_dir = debug_crops_dir
+        if debug_crops_dir:
+            os.makedirs(debug_crops_dir, exist_ok=True)
+
+    def _load(self, figures, figures_queue, errors):
+        try:
+            for sequence, (figure_id, path) in enumerate(figures):
+                try:
+                    image = Image.open(path).convert("RGB")
+                except OSError as e:
+                    print(f"Error loading {path}: {e}")
+                    image = None
+                figures_queue.put((sequence, figure_id, image))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            figures_queue.put(END)
+
+    def _detect_batch(self, shape, batch, crops_queue):
+        detections = self.detector.detect([image for _, _, image in batch], shape=shape)
+        for (sequence, figure_id, image), boxes in zip(batch, detections):
+            panels = crop_panels(image, boxes)
+            if self.debug_crops_dir:
+                # Not `<figure_id>_<label>.png`: the panels are in detection order, not labelled
+                for index, (_, _, crop) in enumerate(panels):
+                    crop.save(os.path.join(self.debug_crops_dir, f"{figure_id}_panel{index:02d}.png"))
+            crops_queue.put((sequence, figure_id, panels))
+
+    def _detect(self, figures_queue, crops_queue, errors):
+        # Figures wait in per-shape buckets (a single square bucket without a batcher)
+        # until a bucket is full, or the input stalls or ends
+        finished = False
+        buckets = {}
+        try:
+            while not finished:
+                try:
+                    item = figures_queue.get(timeout=0.05 if buckets else None)
+                except queue.Empty:
+                    item = None
+                finished = item is END
+
+                if item is None or item is END:
+                    for shape in list(buckets):
+                        self._detect_batch(shape, buckets.pop(shape), crops_queue)
+                    continue
+
+                sequence, figure_id, image = item
+                if image is None:
+                    crops_queue.put((sequence, figure_id, None))
+                    continue
+
+                shape = self.batcher.shape_for(*image.size) if self.batcher else None
+                bucket = buckets.setdefault(shape, [])
+                bucket.append(item)
+                if len(bucket) == self.batch_size:
+                    self._detect_batch(shape, buckets.pop(shape), crops_queue)
+        except Exception as e:
+            errors.append(e)
+            # Unblock the loader so that the pipeline can shut down
+            while not finished:
+                finished = figures_queue.get() is END
+        finally:
+            for _ in range(self.concurrency):
+                crops_queue.put(END)
+
+    def _describe(self, crops_queue, results_queue, errors):
+        try:
+            while True:
+                item = crops_queue.get()
+                if item is END:
+                    break
+                sequence, figure_id, panels = item
+                record = {"figure_id": figure_id}
+                if panels is None:
+                    record["error"] = "figure could not be loaded"
+                    results_queue.put((sequence, record))
+                    continue
+
+                caption = self.captions.get(figure_id) if self.captions is not None else None
+                descriptions = [None] * len(panels)
+                if self.describe and caption and panels:
+                    descriptions = describe_crops([crop for _, _, crop in panels], caption, self.max_images_per_request, self.cache)
+                elif self.describe and panels:
+                    record["error"] = "caption not found"
+
+                record["panels"] = [
+                    {
+                        "index": index,
+                        "box": list(box),
+                        "score": score,
+                        "panel_label": (description or {}).get("panel_label"),
+                        "panel_caption": (description or {}).get("panel_caption")
+                    }
+                    for index, ((box, score, _), description) in enumerate(zip(panels, descriptions))
+                ]
+                results_queue.put((sequence, record))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            results_queue.put(END)
+
+    def run(self, figures):
+        """
+        Run the pipeline over `(figure_id, path)` pairs.
+
+        Yields:
+            dict: One record per figure, in input order, with its panels' boxes,
+            detection scores, labels and captions.
+        """
+        figures_queue = queue.Queue(maxsize=self.queue_size)
+        crops_queue = queue.Queue(maxsize=self.queue_size)
+        results_queue = queue.Queue(maxsize=self.queue_size)
+        errors = []
+
+        threads = [
+            threading.Thread(target=self._load, args=(figures, figures_queue, errors), daemon=True),
+            threading.Thread(target=self._detect, args=(figures_queue, crops_queue, errors), daemon=True)
+        ] + [
+            threading.Thread(target=self._describe, args=(crops_queue, results_queue, errors), daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Describers finish out of order; hold results back until their predecessors are out
+        pending = {}
+        next_sequence = 0
+        running = self.concurrency
+        while running:
+            item = results_queue.get()
+            if item is END:
+                running -= 1
+                continue
+            sequence, record = item
+            pending[sequence] = record
+            while next_sequence in pending:
+                yield pending.pop(next_sequence)
+                next_sequence += 1
+
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        for sequence in sorted(pending):
+            yield pending[sequence]
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the panelization pipeline.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Detect, crop and describe the panels of compound figures in one streaming pass.")
+    parser.add_argument('--figures', type=str, default='data/soda_panelization_figures/test/images', help="Directory with the figure images.")
+    parser.add_argument('--captions', type=str, default='data/figure_captions.jsonl', help="Path to the figure captions JSONL file.")
+    parser.add_argument('--output', type=str, default='data/panelization.jsonl', help="Path to the output JSONL file (one line per figure).")
+    parser.add_argument('--model', type=str, default='runs/soda_figure_segmentation/train/weights/best.pt', help="Path to the trained YOLO model file, or its ONNX/OpenVINO export.")
+    parser.add_argument('--model_version', type=int, default=10, help="YOLO model version to use (e.g., 8, 10).")
+    parser.add_argument('--imgsz', type=int, default=512, help="Image size for inference.")
+    parser.add_argument('--conf', type=float, default=0.3, help="Confidence threshold for detections.")
+    parser.add_argument('--iou', type=float, default=0.7, help="IoU threshold for non-maximum suppression.")
+    parser.add_argument('--max_det', type=int, default=20, help="Maximum number of panels per figure.")
+    parser.add_argument('--device', type=str, default="cpu", help="Device to run the detector on.")
+    parser.add_argument('--threads', type=int, default=0, help="Intra-op threads of the ONNX Runtime/OpenVINO backends (0 lets them decide).")
+    parser.add_argument('--batch', type=int, default=8, help="Number of figures per detection batch.")
+    parser.add_argument('--bucketed', action='store_true', help="Batch figures by aspect-ratio bucket with rectangular inputs (ONNX/OpenVINO models must be exported with --dynamic).")
+    parser.add_argument('--bucket_step', type=int, default=64, help="Granularity of the bucket shapes in pixels.")
+    parser.add_argument('--queue_size', type=int, default=32, help="Capacity of the queues between stages.")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of description threads.")
+    parser.add_argument('--max_images_per_request', type=int, default=8, help="Maximum number of panel images per LLM request.")
+    parser.add_argument('--detail', type=str, default="high", choices=["low", "high", "auto"], help="Detail level requested for the panel images.")
+    parser.add_argument('--rpm', type=int, default=None, help="Requests-per-minute budget (learned from the rate-limit headers if omitted).")
+    parser.add_argument('--tpm', type=int, default=None, help="Tokens-per-minute budget (learned from the rate-limit headers if omitted).")
+    parser.add_argument('--max_retries', type=int, default=6, help="Retries of a rate-limited, timed-out or failed request.")
+    parser.add_argument('--no_descriptions', action='store_true', help="Only detect and crop the panels.")
+    parser.add_argument('--cache', type=str, default='data/panel_description_cache.jsonl', help="Panel description cache (.jsonl or .sqlite) shared with panel_label_matching.py.")
+    parser.add_argument('--debug_crops_dir', type=str, default=None, help="Also write the panel crops to this directory.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    assistants.configure_encoder(detail=args.detail)
+    assistants.configure_scheduler(rpm=args.rpm, tpm=args.tpm, max_concurrency=args.concurrency, max_retries=args.max_retries)
+    detector = load_detector(args.model, args.model_version, imgsz=args.imgsz, conf=args.conf, iou=args.iou,
+                             max_det=args.max_det, device=args.device, intra_op_threads=args.threads)
+    figures = list_figures(args.figures)
+    captions = None if args.no_descriptions else CaptionStore(args.captions)
+    cache = None
+    try:
+        cache = None if args.no_descriptions else open_cache(args.cache)
+        pipeline = PanelizationPipeline(
+            detector,
+            captions=captions,
+            batch_size=args.batch,
+            queue_size=args.queue_size,
+            concurrency=args.concurrency,
+            max_images_per_request=args.max_images_per_request,
+            describe=not args.no_descriptions,
+            debug_crops_dir=args.debug_crops_dir,
+            batcher=AspectRatioBatcher(args.imgsz, args.batch, args.bucket_step) if args.bucketed else None,
+            cache=cache
+        )
+
+        with open(args.output, 'w') as f:
+            for record in tqdm(pipeline.run(figures), total=len(figures), desc="Panelizing figures"):
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+    finally:
+        if cache is not None:
+            cache.close()
+        if captions is not None:
+            captions.close()
+    print(f"Wrote {len(figures)} figures to {args.output}")
+
+if __name__ == "__main__":
+    main()
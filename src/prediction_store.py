@@ -0,0 +1,149 @@
+# src/prediction_store.py
+
+import os
+import json
+import hashlib
+import numpy as np
+
+def file_digest(path):
+    """
+    SHA-256 of a model file, or of every file of a model directory (e.g. an OpenVINO export).
+    """
+    digest = hashlib.sha256()
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    for file_path in paths:
+        digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def image_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class StoredPredictions:
+    """
+    Detections of one model and preprocessing configuration, as memory-mapped columns.
+
+    `image_index` (int32), `boxes` (float32 xyxy) and `scores` (float32) have one row per
+    box, sorted by image index; `images` lists the image names in index order together
+    with the size and mtime they had when they were predicted.
+    """
+
+    def __init__(self, metadata, image_index, boxes, scores):
+        self.metadata = metadata
+        self.image_index = image_index
+        self.boxes = boxes
+        self.scores = scores
+        self.positions = {name: position for position, (name, _) in enumerate(metadata["images"])}
+        self.offsets = np.searchsorted(image_index, np.arange(len(metadata["images"]) + 1))
+
+    def __len__(self):
+        return len(self.metadata["images"])
+
+    def get(self, position, conf=0.0):
+        start, end = self.offsets[position], self.offsets[position + 1]
+        detections = np.concatenate([self.boxes[start:end], self.scores[start:end, None]], axis=1)
+        return detections[detections[:, 4] >= conf]
+
+    def lookup(self, image_paths, conf=0.0):
+        """
+        Detections of the given images above `conf`, or None for images that were not
+        predicted or have changed on disk since.
+        """
+        detections = []
+        for path in image_paths:
+            position = self.positions.get(os.path.basename(path))
+            if position is None or self.metadata["images"][position][1] != image_signature(path):
+                detections.append(None)
+            else:
+                detections.append(self.get(position, conf))
+        return detections
+
+class PredictionStore:
+    """
+    Directory of detector outputs keyed by model checkpoint hash and preprocessing settings.
+
+    Each entry is written as `<key>.image_index.npy`, `<key>.boxes.npy`, `<key>.scores.npy`
+    and a `<key>.json` manifest. The manifest is replaced last and records the number of
+    boxes, so entries whose columns do not match it are ignored.
+    """
+
+    COLUMNS = ("image_index", "boxes", "scores")
+
+    def __init__(self, root="runs/predictions"):
+        self.root = root
+        self._digests = {}
+
+    def key(self, model_path, settings):
+        """
+        Entry key of a model file and the settings that affect its raw detections
+        (input size, NMS IoU, max_det, storage confidence, batching mode).
+        """
+        if model_path not in self._digests:
+            self._digests[model_path] = file_digest(model_path)
+        payload = json.dumps({"model": self._digests[model_path], "settings": settings}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def _path(self, key, suffix):
+        return os.path.join(self.root, f"{key}.{suffix}")
+
+    def load(self, key):
+        """
+        Open a stored entry without reading its columns into memory, or return None.
+        """
+        manifest_path = self._path(key, "json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            metadata = json.load(f)
+        columns = [np.load(self._path(key, f"{column}.npy"), mmap_mode='r') for column in self.COLUMNS]
+        if any(len(column) != metadata["boxes"] for column in columns):
+            return None
+        return StoredPredictions(metadata, *columns)
+
+    def save(self, key, image_paths, detections, metadata=None):
+        """
+        Write the detections of `image_paths` (`(n, 5)` xyxy + score arrays) as an entry.
+        """
+        images = [[os.path.basename(path), image_signature(path)] for path in image_paths]
+        self._write(key, images, detections, metadata)
+
+    def merge(self, key, image_paths, detections, metadata=None):
+        """
+        Add or replace the detections of some images in an entry, keeping the other stored images.
+        """
+        images = [[os.path.basename(path), image_signature(path)] for path in image_paths]
+        stored = self.load(key)
+        if stored is not None:
+            replaced = {name for name, _ in images}
+            kept = [(entry, stored.get(position)) for position, entry in enumerate(stored.metadata["images"]) if entry[0] not in replaced]
+            images = [entry for entry, _ in kept] + images
+            detections = [boxes for _, boxes in kept] + list(detections)
+        self._write(key, images, detections, metadata)
+
+    def _write(self, key, images, detections, metadata):
+        os.makedirs(self.root, exist_ok=True)
+        counts = [len(boxes) for boxes in detections]
+        stacked = np.concatenate([np.asarray(boxes, dtype=np.float32).reshape(-1, 5) for boxes in detections]) if detections else np.zeros((0, 5), dtype=np.float32)
+        columns = {
+            "image_index": np.repeat(np.arange(len(detections), dtype=np.int32), counts),
+            "boxes": np.ascontiguousarray(stacked[:, :4]),
+            "scores": np.ascontiguousarray(stacked[:, 4])
+        }
+        for column, values in columns.items():
+            path = self._path(key, f"{column}.npy")
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(path + '.tmp', path)
+
+        manifest = dict(metadata or {})
+        manifest["images"] = images
+        manifest["boxes"] = int(sum(counts))
+        manifest_path = self._path(key, "json")
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
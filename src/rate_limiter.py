@@ -0,0 +1,300 @@
+# src/rate_limiter.py
+
+import re
+import time
+import random
+import asyncio
+import threading
+import openai
+from instrumentation import observe
+
+# Status codes worth retrying besides 429 (overloaded or failing upstream)
+RETRYABLE_STATUS = {408, 409, 500, 502, 503, 504}
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def parse_duration(value):
+    """
+    Seconds in an OpenAI reset header such as `1s`, `6m0s` or `20ms`, or None.
+    """
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * DURATION_SECONDS[unit] for amount, unit in parts)
+
+def retry_after(headers):
+    """
+    Delay requested by a `retry-after-ms` or `retry-after` header, in seconds.
+    """
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            return None
+    return None
+
+def reset_delay(headers):
+    """
+    Time until the exhausted request or token budget of a 429 response is reset, in seconds.
+    """
+    if headers is None:
+        return None
+    resets = [
+        parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        for kind in ("requests", "tokens")
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+class TokenBucket:
+    """
+    Per-minute budget refilled continuously; a `capacity` of None means unlimited.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.tokens = capacity or 0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until `amount` is available; takes it and returns 0 if it already is.
+        """
+        if self.capacity is None:
+            return 0.0
+        self._refill(now)
+        # A single request larger than the budget only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.capacity
+
+    def give(self, amount, now):
+        if self.capacity is not None:
+            self._refill(now)
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def observe(self, limit, remaining, now):
+        """
+        Align the bucket with the limit and remaining budget reported by the server.
+        """
+        self._refill(now)
+        if limit:
+            if self.capacity is None:
+                self.tokens = limit
+            self.capacity = limit
+        if remaining is not None and self.capacity is not None:
+            self.tokens = min(self.tokens, remaining)
+
+class RateLimitScheduler:
+    """
+    Admission control, retries and adaptive concurrency for the LLM requests.
+
+    Each request waits for a free concurrency slot and for room in the requests- and
+    tokens-per-minute buckets. The buckets are resized from the `x-ratelimit-*`
+    response headers, so they work without configured limits. 429s, timeouts and 5xx
+    responses are retried after the `retry-after` delay, or an exponential backoff with
+    full jitter, and halve the concurrency limit. Each success raises it again by one
+    slot per `limit` successes (AIMD), up to `max_concurrency`.
+
+    The same scheduler serves threads and asyncio tasks.
+
+    Args:
+        rpm (int): Requests per minute, None to learn it from the headers.
+        tpm (int): Tokens per minute, None to learn it from the headers.
+        max_concurrency (int): Upper bound of the adaptive concurrency limit.
+        max_retries (int): Retries of a request before its error is raised.
+        base_delay (float): First backoff delay in seconds.
+        max_delay (float): Upper bound of the backoff delay in seconds.
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_concurrency=1, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.blocked_until = 0.0
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "timeouts": 0, "server_errors": 0, "failures": 0, "wait_seconds": 0.0}
+        self._lock = threading.Lock()
+
+    def concurrency(self):
+        return max(1, int(self.limit))
+
+    def _admit(self, estimated_tokens):
+        """
+        Take a slot and the budget for one request, or return how long to wait before retrying.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.in_flight >= self.concurrency():
+                return 0.05
+            wait = self.requests.wait_time(1, now)
+            if wait > 0:
+                return wait
+            wait = self.tokens.wait_time(estimated_tokens, now)
+            if wait > 0:
+                self.requests.give(1, now)
+                return wait
+            self.in_flight += 1
+            self.stats["requests"] += 1
+            return 0.0
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _on_success(self, headers, estimated_tokens, used_tokens):
+        with self._lock:
+            now = time.monotonic()
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            if used_tokens is not None and used_tokens < estimated_tokens:
+                self.tokens.give(estimated_tokens - used_tokens, now)
+            self._observe(headers, now)
+
+    def _on_error(self, error, attempt):
+        """
+        Classify a failed attempt; returns the delay before the next one, or None to give up.
+        """
+        status = getattr(error, "status_code", None)
+        headers = error.response.headers if isinstance(error, openai.APIStatusError) else None
+        with self._lock:
+            now = time.monotonic()
+            if isinstance(error, openai.APITimeoutError):
+                self.stats["timeouts"] += 1
+            elif isinstance(error, openai.APIConnectionError):
+                self.stats["server_errors"] += 1
+            elif status == 429:
+                self.stats["rate_limited"] += 1
+            elif status in RETRYABLE_STATUS:
+                self.stats["server_errors"] += 1
+            else:
+                return None
+            if attempt >= self.max_retries:
+                self.stats["failures"] += 1
+                return None
+
+            self.stats["retries"] += 1
+            self.limit = max(1.0, self.limit / 2)
+            self._observe(headers, now)
+            delay = retry_after(headers) or reset_delay(headers)
+            if delay is None:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            else:
+                # Spread the retries of concurrent requests told to wait the same time
+                delay = min(self.max_delay, delay * random.uniform(1.0, 1.25))
+            if status == 429:
+                # Hold back every request, not only this one, until the server is ready again
+                self.blocked_until = max(self.blocked_until, now + delay)
+            return delay
+
+    def _observe(self, headers, now):
+        if not headers:
+            return
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is None and remaining is None:
+                continue
+            bucket.observe(int(limit) if limit else None, int(remaining) if remaining is not None else None, now)
+
+    def _wait(self, seconds):
+        with self._lock:
+            self.stats["wait_seconds"] += seconds
+        observe("scheduler_wait_seconds", seconds)
+
+    def call(self, request, estimated_tokens=0):
+        """
+        Run `request()`, which must return an OpenAI raw response, under the limits.
+
+        Returns:
+            The parsed response.
+        """
+        attempt = 0
+        while True:
+            wait = self._admit(estimated_tokens)
+            if wait > 0:
+                self._wait(wait)
+                time.sleep(wait)
+                continue
+            failure = None
+            try:
+                raw = request()
+            except openai.OpenAIError as error:
+                failure = error
+            finally:
+                # Also on cancellation or unexpected errors, which would otherwise leak the slot
+                self._release()
+            if failure is not None:
+                delay = self._on_error(failure, attempt)
+                if delay is None:
+                    raise failure
+                attempt += 1
+                self._wait(delay)
+                time.sleep(delay)
+                continue
+            return self._parse(raw, estimated_tokens)
+
+    async def acall(self, request, estimated_tokens=0):
+        """
+        Asynchronous variant of `call`; `request()` returns an awaitable raw response.
+        """
+        attempt = 0
+        while True:
+            wait = self._admit(estimated_tokens)
+            if wait > 0:
+                self._wait(wait)
+                await asyncio.sleep(wait)
+                continue
+            failure = None
+            try:
+                raw = await request()
+            except openai.OpenAIError as error:
+                failure = error
+            finally:
+                # Also on cancellation or unexpected errors, which would otherwise leak the slot
+                self._release()
+            if failure is not None:
+                delay = self._on_error(failure, attempt)
+                if delay is None:
+                    raise failure
+                attempt += 1
+                self._wait(delay)
+                await asyncio.sleep(delay)
+                continue
+            return self._parse(raw, estimated_tokens)
+
+    def _parse(self, raw, estimated_tokens):
+        response = raw.parse()
+        used_tokens = response.usage.total_tokens if response.usage is not None else None
+        self._on_success(raw.headers, estimated_tokens, used_tokens)
+        return response
+
+    def report(self):
+        with self._lock:
+            return dict(self.stats, concurrency=self.concurrency(), rpm=self.requests.capacity, tpm=self.tokens.capacity)
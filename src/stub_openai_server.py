@@ -0,0 +1,226 @@
+# src/stub_openai_server.py
+
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def stub_description(position):
+    label = chr(ord("A") + position % 26)
+    return {"panel_label": label, "panel_caption": f"Panel {label}: Stub description of the panel."}
+
+def count_images(request):
+    count = 0
+    for message in request.get("messages", []):
+        if isinstance(message.get("content"), list):
+            count += sum(1 for part in message["content"] if part.get("type") == "image_url")
+    return count
+
+def stub_content(request):
+    """
+    Answer with one description for single-image prompts and a JSON array with one
+    description per image for figure-level prompts.
+    """
+    images = count_images(request)
+    if images > 1:
+        return json.dumps([stub_description(position) for position in range(images)], indent=4)
+    return json.dumps(stub_description(0), indent=4)
+
+class StubChatCompletionsHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the OpenAI chat-completions endpoint.
+
+    Every POST to `/chat/completions` (with or without the `/v1` prefix) sleeps for
+    the configured latency and answers with a canned completion (see `stub_content`),
+    so the matching drivers can be exercised without network access or API costs.
+
+    To exercise the rate-limit handling, the server can enforce a requests-per-window
+    limit, answer a fraction of the requests with 429s and add latency spikes; every
+    response carries OpenAI-style `x-ratelimit-*` headers.
+    """
+
+    server_version = "StubOpenAI/0.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client timed out and went away
+            pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        if self.path.rstrip("/") not in ("/chat/completions", "/v1/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        self.server.record_request()
+        allowed, headers = self.server.rate_limit()
+        if not allowed or random.random() < self.server.error_rate:
+            self.server.record_rate_limited()
+            if allowed:
+                headers["retry-after-ms"] = str(int(self.server.retry_after * 1000))
+            self._send_json(429, {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+            return
+
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if random.random() < self.server.spike_rate:
+            delay += self.server.spike_latency
+        if delay > 0:
+            time.sleep(delay)
+
+        self._send_json(200, {
+            "id": f"chatcmpl-stub-{self.server.request_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.server.content or stub_content(request)},
+                    "finish_reason": "stop"
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        }, headers)
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, content=None, verbose=False,
+                 rpm=None, window=60.0, error_rate=0.0, retry_after=1.0, spike_rate=0.0, spike_latency=0.0):
+        super().__init__(address, StubChatCompletionsHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.content = content
+        self.verbose = verbose
+        self.rpm = rpm
+        self.window = window
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.spike_rate = spike_rate
+        self.spike_latency = spike_latency
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._accepted = deque()
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.request_count += 1
+
+    def record_rate_limited(self):
+        with self._lock:
+            self.rate_limited_count += 1
+
+    def rate_limit(self):
+        """
+        Count a request against the sliding-window limit.
+
+        Returns:
+            tuple: Whether the request is allowed, and the `x-ratelimit-*` headers to send.
+        """
+        if self.rpm is None:
+            return True, {}
+        with self._lock:
+            now = time.monotonic()
+            while self._accepted and self._accepted[0] <= now - self.window:
+                self._accepted.popleft()
+            allowed = len(self._accepted) < self.rpm
+            if allowed:
+                self._accepted.append(now)
+            reset = self._accepted[0] + self.window - now if self._accepted else 0.0
+            return allowed, {
+                "x-ratelimit-limit-requests": str(self.rpm),
+                "x-ratelimit-remaining-requests": str(self.rpm - len(self._accepted)),
+                "x-ratelimit-reset-requests": f"{max(reset, 0.0):.3f}s"
+            }
+
+    def process_request_thread(self, request, client_address):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+def start_stub_server(host="127.0.0.1", port=0, **kwargs):
+    """
+    Start the stub server on a background thread.
+
+    Args:
+        host (str): Interface to bind.
+        port (int): Port to bind, 0 picks a free one.
+        **kwargs: Forwarded to `StubOpenAIServer` (latency, jitter, content, verbose,
+            rpm, window, error_rate, retry_after, spike_rate, spike_latency).
+
+    Returns:
+        StubOpenAIServer: The running server; use `base_url` as `OPENAI_BASE_URL` and `shutdown()` to stop it.
+    """
+    server = StubOpenAIServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def parse_arguments():
+    """
+    Parse command-line arguments for the stub server.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Run a local stub of the OpenAI chat-completions endpoint.")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Interface to bind.")
+    parser.add_argument('--port', type=int, default=8000, help="Port to bind.")
+    parser.add_argument('--latency', type=float, default=0.5, help="Seconds to wait before answering each request.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra uniformly distributed latency in seconds.")
+    parser.add_argument('--rpm', type=int, default=None, help="Requests accepted per --window before answering 429.")
+    parser.add_argument('--window', type=float, default=60.0, help="Length of the rate-limit window in seconds.")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="Fraction of the requests answered with a 429 regardless of the limit.")
+    parser.add_argument('--retry_after', type=float, default=1.0, help="Seconds sent in the retry-after-ms header of those 429s.")
+    parser.add_argument('--spike_rate', type=float, default=0.0, help="Fraction of the requests delayed by --spike_latency.")
+    parser.add_argument('--spike_latency', type=float, default=5.0, help="Extra seconds of a latency spike.")
+    parser.add_argument('--verbose', action='store_true', help="Log every request.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    server = StubOpenAIServer((args.host, args.port), latency=args.latency, jitter=args.jitter, verbose=args.verbose,
+                              rpm=args.rpm, window=args.window, error_rate=args.error_rate, retry_after=args.retry_after,
+                              spike_rate=args.spike_rate, spike_latency=args.spike_latency)
+    print(f"Stub OpenAI server listening on {server.base_url} (latency {args.latency}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
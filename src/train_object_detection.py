@@ -1,9 +1,106 @@
 # src/train_object_detection.py
 
+import os
 import argparse
 from ultralytics import YOLO, YOLOv10
+from ultralytics.data import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.models.yolov10.train import YOLOv10DetectionTrainer
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import de_parallel
+from dataset_splits import label_path
+from training_cache import find_cache
 
-def train_model(data_path, epochs, img_size, device, batch_size, workers, project, model_version):
+# Read by the trainers rather than passed to them, since multi-GPU runs re-create the
+# trainer in subprocesses from its class and the ultralytics arguments only
+IMAGE_CACHE_ENV = "SODA_TRAINING_IMAGE_CACHE"
+
+class CachedYOLODataset(YOLODataset):
+    """
+    YOLO dataset reading pre-resized images and labels from a `TrainingImageCache`
+    instead of decoding and resizing the source files every epoch.
+
+    Cache entries are looked up by image path, since `set_rectangle` reorders
+    `im_files` and `labels` by aspect ratio for rectangular (and every validation)
+    batches, after which dataset position `i` is no longer cache entry `i`.
+    """
+
+    def __init__(self, image_cache, *args, **kwargs):
+        self.image_cache = image_cache
+        self.cache_index = {path: index for index, path in enumerate(image_cache.image_paths)}
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        im_files = list(self.image_cache.image_paths)
+        if self.fraction < 1:
+            im_files = im_files[:round(len(im_files) * self.fraction)]
+        return im_files
+
+    def get_labels(self):
+        self.label_files = [label_path(im_file) for im_file in self.im_files]
+        labels = []
+        for im_file in self.im_files:
+            index = self.cache_index[im_file]
+            rows = self.image_cache.labels_of(index)
+            h0, w0 = (int(value) for value in self.image_cache.shape[index, :2])
+            labels.append({
+                "im_file": im_file,
+                "shape": (h0, w0),
+                "cls": rows[:, 0:1],
+                "bboxes": rows[:, 1:],
+                "segments": [],
+                "keypoints": None,
+                "normalized": True,
+                "bbox_format": "xywh"
+            })
+        return labels
+
+    def load_image(self, i, rect_mode=True):
+        image, original_shape, resized_shape = self.image_cache.load(self.cache_index[self.im_files[i]], bgr=True)
+        if self.augment:
+            # Mosaic draws its other images from the buffer; reads are cheap, so only indices are kept
+            self.buffer.append(i)
+            if len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return image, original_shape, resized_shape
+
+class CachedImagesMixin:
+    """
+    Builds the datasets of the splits found in the image cache named by `IMAGE_CACHE_ENV`,
+    and the usual ones for the others.
+    """
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        image_cache = find_cache(os.environ.get(IMAGE_CACHE_ENV), img_path, self.args.imgsz)
+        if image_cache is None:
+            return super().build_dataset(img_path, mode=mode, batch=batch)
+        gs = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        return CachedYOLODataset(
+            image_cache,
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=gs,
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode} (cached): "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == "train" else 1.0
+        )
+
+class CachedDetectionTrainer(CachedImagesMixin, DetectionTrainer):
+    pass
+
+class CachedYOLOv10DetectionTrainer(CachedImagesMixin, YOLOv10DetectionTrainer):
+    pass
+
+def train_model(data_path, epochs, img_size, device, batch_size, workers, project, model_version, image_cache=None):
     """
     Train a YOLO model with the specified parameters.
 
@@ -16,14 +113,22 @@ def train_model(data_path, epochs, img_size, device, batch_size, workers, projec
         workers (int): Number of data loading workers.
         project (str): Directory to save training results.
         model_version (int): YOLO model version to use (e.g., 8, 10).
+        image_cache (str): Directory of the caches built by `training_cache.py`, read
+            instead of the image files for the splits cached at `img_size`.
     """
     if model_version < 10:
         model = YOLO(f"yolov{model_version}x.pt")  # load a pretrained model (recommended for training)
     else:
         model = YOLOv10.from_pretrained('jameslahm/yolov10x')
 
+    trainer = None
+    if image_cache:
+        os.environ[IMAGE_CACHE_ENV] = image_cache
+        trainer = CachedDetectionTrainer if model_version < 10 else CachedYOLOv10DetectionTrainer
+
     # Train the model
     results = model.train(
+        trainer=trainer,
         data=data_path,
         epochs=epochs,
         imgsz=img_size,
@@ -50,6 +155,7 @@ def parse_arguments():
     parser.add_argument('--workers', type=int, default=16, help="Number of data loading workers.")
     parser.add_argument('--project', type=str, default="runs/train", help="Directory to save training results.")
     parser.add_argument('--model_version', type=int, default=10, help="YOLO model version to use (e.g., 8, 10).")
+    parser.add_argument('--image_cache', type=str, default=None, help="Read the splits cached by training_cache.py from this directory (e.g. data/training_cache).")
 
     return parser.parse_args()
 
@@ -66,7 +172,8 @@ def main():
         batch_size=args.batch,
         workers=args.workers,
         project=args.project,
-        model_version=args.model_version
+        model_version=args.model_version,
+        image_cache=args.image_cache
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,355 @@
+# src/training_cache.py
+
+import os
+import math
+import json
+import time
+import random
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from dataset_splits import split_images, split_images_dir, image_size, image_labels
+from prediction_store import image_signature
+
+# Bump when the stored layout or the resizing changes, so caches are rebuilt
+CACHE_VERSION = 1
+MAX_SHARD_BYTES = 1 << 30
+COLUMNS = ("shard", "offset", "shape", "label_offsets", "labels")
+
+def cached_size(width, height, imgsz):
+    """
+    `(width, height)` of an image once its longest side is scaled to `imgsz`, rounded
+    as the ultralytics loader rounds it (small images are scaled up as well).
+    """
+    ratio = imgsz / max(width, height)
+    return min(math.ceil(width * ratio), imgsz), min(math.ceil(height * ratio), imgsz)
+
+def read_labels(image_path):
+    """
+    YOLO labels of an image as a float32 `(n, 5)` array of `class, x, y, w, h`.
+
+    Coordinates are normalised, so they hold for the resized image as well; they are
+    clipped to the image and duplicate rows are dropped, as ultralytics does when it
+    verifies a label file.
+    """
+    labels = image_labels(image_path).copy()
+    if not len(labels):
+        return labels
+    labels[:, 1:] = np.clip(labels[:, 1:], 0, 1)
+    _, first = np.unique(labels, axis=0, return_index=True)
+    return labels[np.sort(first)]
+
+def decode_resized(path, size):
+    """
+    Decode an image straight to `size`, letting JPEG decoding skip the resolution it
+    does not need (DCT scaling) before the final resize.
+    """
+    with Image.open(path) as image:
+        image.draft("RGB", size)
+        image = image.convert("RGB")
+        if image.size != size:
+            image = image.resize(size, Image.BILINEAR)
+        return np.asarray(image)
+
+_shards = {}
+
+def _write_image(task):
+    path, shard_path, offset, height, width = task
+    if shard_path not in _shards:
+        _shards[shard_path] = np.load(shard_path, mmap_mode='r+')
+    pixels = decode_resized(path, (width, height))
+    _shards[shard_path][offset:offset + pixels.size] = pixels.reshape(-1)
+    return pixels.size
+
+class TrainingImageCache:
+    """
+    Images of one dataset split resized once to the training size, read from memory-mapped shards.
+
+    The RGB pixels of every image are stored back to back in flat uint8 `pixels_<n>.npy`
+    shards. `shard` and `offset` give where image `i` starts, `shape` holds its original
+    and resized `(h0, w0, h, w)`, and the labels of image `i` are the rows
+    `label_offsets[i]:label_offsets[i + 1]` of `labels` (`class, x, y, w, h`). The
+    `manifest.json`, written last, lists the source images with the size and mtime
+    they had when they were cached.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json"), 'r') as f:
+            self.manifest = json.load(f)
+        for column in COLUMNS:
+            setattr(self, column, np.load(os.path.join(directory, f"{column}.npy"), mmap_mode='r'))
+        self.image_paths = [os.path.join(self.manifest["images_dir"], name) for name, _ in self.manifest["images"]]
+        self._shards = None
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    @property
+    def imgsz(self):
+        return self.manifest["imgsz"]
+
+    def _shard(self, index):
+        # Opened on first use so that every data loader worker maps the shards itself
+        if self._shards is None:
+            self._shards = [np.load(os.path.join(self.directory, name), mmap_mode='r') for name in self.manifest["shards"]]
+        return self._shards[index]
+
+    def image(self, i):
+        """
+        Read-only `(h, w, 3)` RGB view of the resized image `i`.
+        """
+        _, _, height, width = (int(value) for value in self.shape[i])
+        offset = int(self.offset[i])
+        return self._shard(int(self.shard[i]))[offset:offset + height * width * 3].reshape(height, width, 3)
+
+    def load(self, i, bgr=False):
+        """
+        Writable copy of image `i` with its original and resized `(h, w)`, as `BaseDataset.load_image` returns them.
+        """
+        h0, w0, height, width = (int(value) for value in self.shape[i])
+        pixels = self.image(i)
+        return np.ascontiguousarray(pixels[..., ::-1] if bgr else pixels), (h0, w0), (height, width)
+
+    def labels_of(self, i):
+        return np.asarray(self.labels[self.label_offsets[i]:self.label_offsets[i + 1]])
+
+    def is_stale(self):
+        """
+        Whether images were added, removed or changed in the split since it was cached.
+        """
+        cached = {name: signature for name, signature in self.manifest["images"]}
+        try:
+            current = split_images(self.manifest["data"], self.manifest["split"])
+        except (OSError, KeyError):
+            return True
+        if len(current) != len(cached):
+            return True
+        for path in current:
+            signature = cached.get(os.path.basename(path))
+            if signature is None or signature != image_signature(path):
+                return True
+        return False
+
+def cache_dir(cache_root, split, imgsz):
+    return os.path.join(cache_root, f"{split}_{imgsz}")
+
+def build_cache(data_yaml, split, imgsz, cache_root="data/training_cache", workers=None, max_shard_bytes=MAX_SHARD_BYTES, force=False):
+    """
+    Resize the images of a split once to the training size and write them as memory-mapped shards.
+
+    The resized size of every image is known from its header, so the shards are
+    allocated up front and the worker processes decode and write their images into
+    them in place.
+
+    Args:
+        data_yaml (str): Path to the data YAML file (e.g. `data/source_data.yml`).
+        split (str): Split name ('train', 'val' or 'test').
+        imgsz (int): Training image size; the longest side of every image is scaled to it.
+        cache_root (str): Directory holding the caches, one `<split>_<imgsz>` subdirectory each.
+        workers (int): Number of worker processes (defaults to the number of CPUs).
+        max_shard_bytes (int): Largest size of a pixel shard.
+        force (bool): Rebuild the cache even if it is up to date.
+
+    Returns:
+        TrainingImageCache: The cache of the split.
+    """
+    directory = cache_dir(cache_root, split, imgsz)
+    if not force and os.path.exists(os.path.join(directory, "manifest.json")):
+        cache = TrainingImageCache(directory)
+        if cache.manifest.get("version") == CACHE_VERSION and not cache.is_stale():
+            print(f"{split}: {len(cache)} images already cached in {directory}")
+            return cache
+
+    os.makedirs(directory, exist_ok=True)
+    # Without its manifest the cache is ignored until it has been completely rewritten
+    if os.path.exists(os.path.join(directory, "manifest.json")):
+        os.remove(os.path.join(directory, "manifest.json"))
+
+    image_paths = split_images(data_yaml, split)
+    shapes = np.zeros((len(image_paths), 4), dtype=np.int32)
+    shards = np.zeros(len(image_paths), dtype=np.int32)
+    offsets = np.zeros(len(image_paths), dtype=np.int64)
+    shard_sizes = [0]
+    for i, path in enumerate(image_paths):
+        w0, h0 = image_size(path)
+        width, height = cached_size(w0, h0, imgsz)
+        size = width * height * 3
+        if shard_sizes[-1] and shard_sizes[-1] + size > max_shard_bytes:
+            shard_sizes.append(0)
+        shapes[i] = (h0, w0, height, width)
+        shards[i] = len(shard_sizes) - 1
+        offsets[i] = shard_sizes[-1]
+        shard_sizes[-1] += size
+
+    shard_names = [f"pixels_{index:03d}.npy" for index in range(len(shard_sizes))]
+    for name in os.listdir(directory):
+        if name.startswith("pixels_") and name not in shard_names:
+            os.remove(os.path.join(directory, name))
+    for name, size in zip(shard_names, shard_sizes):
+        np.lib.format.open_memmap(os.path.join(directory, name), mode='w+', dtype=np.uint8, shape=(size,)).flush()
+
+    labels = [read_labels(path) for path in image_paths]
+    columns = {
+        "shard": shards,
+        "offset": offsets,
+        "shape": shapes,
+        "label_offsets": np.concatenate([[0], np.cumsum([len(rows) for rows in labels])]).astype(np.int64),
+        "labels": np.concatenate(labels) if labels else np.zeros((0, 5), dtype=np.float32)
+    }
+    for column, values in columns.items():
+        path = os.path.join(directory, f"{column}.npy")
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, values)
+        os.replace(path + '.tmp', path)
+
+    tasks = [
+        (path, os.path.join(directory, shard_names[shards[i]]), int(offsets[i]), int(shapes[i, 2]), int(shapes[i, 3]))
+        for i, path in enumerate(image_paths)
+    ]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # The shards are shared mappings, so the pages written by the workers outlive them
+        written = sum(executor.map(_write_image, tasks, chunksize=16))
+    elapsed = time.perf_counter() - start
+
+    manifest = {
+        "version": CACHE_VERSION,
+        "data": data_yaml,
+        "split": split,
+        "images_dir": split_images_dir(data_yaml, split),
+        "imgsz": imgsz,
+        "shards": shard_names,
+        "bytes": int(written),
+        "images": [[os.path.basename(path), image_signature(path)] for path in image_paths]
+    }
+    manifest_path = os.path.join(directory, "manifest.json")
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    print(f"{split}: cached {len(image_paths)} images ({written / 2 ** 30:.2f} GiB in {len(shard_names)} shards) "
+          f"in {elapsed:.1f}s ({len(image_paths) / max(elapsed, 1e-9):.1f} images/sec)")
+    return TrainingImageCache(directory)
+
+def find_cache(cache_root, images_dir, imgsz):
+    """
+    The up-to-date cache of the split stored in `images_dir` at `imgsz`, or None.
+    """
+    if not cache_root or not isinstance(images_dir, str) or not os.path.isdir(cache_root):
+        return None
+    for name in sorted(os.listdir(cache_root)):
+        directory = os.path.join(cache_root, name)
+        if not os.path.exists(os.path.join(directory, "manifest.json")):
+            continue
+        cache = TrainingImageCache(directory)
+        if cache.imgsz != imgsz or os.path.abspath(cache.manifest["images_dir"]) != os.path.abspath(images_dir.rstrip(os.sep)):
+            continue
+        if cache.manifest.get("version") != CACHE_VERSION or cache.is_stale():
+            print(f"Warning: the image cache {directory} is out of date, rebuild it with `python src/training_cache.py`.")
+            return None
+        return cache
+    return None
+
+def decode_like_ultralytics(path, imgsz):
+    """
+    What the ultralytics loader does per image and epoch: a full decode, then a resize
+    of the longest side to `imgsz`.
+    """
+    try:
+        import cv2
+    except ImportError:
+        with Image.open(path) as image:
+            image = image.convert("RGB")
+            return np.asarray(image.resize(cached_size(*image.size, imgsz), Image.BILINEAR))
+    image = cv2.imread(path)
+    height, width = image.shape[:2]
+    return cv2.resize(image, cached_size(width, height, imgsz), interpolation=cv2.INTER_LINEAR)
+
+_benchmark_cache = None
+
+def _open_benchmark_cache(directory):
+    global _benchmark_cache
+    _benchmark_cache = TrainingImageCache(directory)
+
+def _load_cached(indices):
+    return sum(_benchmark_cache.load(i, bgr=True)[0].size > 0 for i in indices)
+
+def _load_decoded(indices):
+    return sum(decode_like_ultralytics(_benchmark_cache.image_paths[i], _benchmark_cache.imgsz).size > 0 for i in indices)
+
+def benchmark(cache, epochs=3, workers=16, limit=None, chunk=32):
+    """
+    Images/sec of loading a split from its source files and from the cache, per epoch.
+
+    Every epoch visits the images in a new random order across `workers` processes, as
+    the training data loader does. The first epoch includes starting the workers and,
+    for cold files, reading them from disk; later epochs show the steady state.
+
+    Args:
+        cache (TrainingImageCache): The cache of the split.
+        epochs (int): Number of epochs per loader.
+        workers (int): Number of worker processes.
+        limit (int): Only load this many images per epoch.
+        chunk (int): Images per task sent to a worker.
+
+    Returns:
+        dict: For each loader, the images/sec of every epoch, of the first one and the
+        mean of the later ones, and the steady-state speedup of the cache.
+    """
+    indices = list(range(len(cache)))[:limit]
+    report = {"images": len(indices), "workers": workers, "imgsz": cache.imgsz}
+    for name, loader in (("decode", _load_decoded), ("cache", _load_cached)):
+        rates = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_open_benchmark_cache, initargs=(cache.directory,)) as executor:
+            for _ in range(epochs):
+                random.shuffle(indices)
+                chunks = [indices[start:start + chunk] for start in range(0, len(indices), chunk)]
+                start = time.perf_counter()
+                loaded = sum(executor.map(loader, chunks))
+                rates.append(loaded / (time.perf_counter() - start))
+        report[name] = {
+            "epochs": [round(rate, 1) for rate in rates],
+            "first_epoch": round(rates[0], 1),
+            "steady_state": round(float(np.mean(rates[1:] or rates)), 1)
+        }
+    report["steady_state_speedup"] = round(report["cache"]["steady_state"] / report["decode"]["steady_state"], 2)
+    return report
+
+def parse_arguments():
+    """
+    Parse command-line arguments for building the training image cache.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Resize the dataset splits once to the training size and store them as memory-mapped shards.")
+    parser.add_argument('--data', type=str, default="data/source_data.yml", help="Path to the data YAML file.")
+    parser.add_argument('--splits', type=str, nargs='+', default=["train", "val"], help="Splits to cache.")
+    parser.add_argument('--imgsz', type=int, default=720, help="Training image size.")
+    parser.add_argument('--cache_dir', type=str, default="data/training_cache", help="Directory of the caches.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (defaults to the number of CPUs).")
+    parser.add_argument('--max_shard_gb', type=float, default=1.0, help="Largest size of a pixel shard in GiB.")
+    parser.add_argument('--force', action='store_true', help="Rebuild the caches even if they are up to date.")
+    parser.add_argument('--benchmark', action='store_true', help="Compare the images/sec of loading each split from its files and from the cache.")
+    parser.add_argument('--benchmark_epochs', type=int, default=3, help="Epochs per loader in the benchmark.")
+    parser.add_argument('--benchmark_limit', type=int, default=None, help="Images per benchmark epoch (defaults to the whole split).")
+    parser.add_argument('--output', type=str, default=None, help="Write the benchmark report to this JSON file.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    reports = {}
+    for split in args.splits:
+        cache = build_cache(args.data, split, args.imgsz, args.cache_dir, workers=args.workers,
+                            max_shard_bytes=int(args.max_shard_gb * 2 ** 30), force=args.force)
+        if args.benchmark:
+            reports[split] = benchmark(cache, epochs=args.benchmark_epochs, workers=args.workers or os.cpu_count(), limit=args.benchmark_limit)
+            print(json.dumps(reports[split], indent=4))
+    if args.output and reports:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 #!/bin/bash
 
-# Start Streamlit
-# streamlit run src/app.py &
+# Start the panel detection server (CPU) and the Streamlit app using it
+python src/inference_server.py --model runs/soda_figure_segmentation/train/weights/best.pt --port 8500 &
+streamlit run src/app.py &
 
 # Start JupyterLab
 jupyter lab --ip=0.0.0.0 --port=9240 --no-browser --allow-root
\ No newline at end of file
@@ -0,0 +1,38 @@
+# tests/conftest.py
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# The clients of `assistants` are created on import and need a key, even for the stub
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+from stub_openai_server import start_stub_server
+
+@pytest.fixture
+def stub_server():
+    """
+    Start a stub chat-completions server on a free port, yield a function pointing the
+    `assistants` clients at it, and stop it afterwards.
+    """
+    import assistants
+
+    servers = []
+    clients = (assistants.client, assistants.async_client, assistants.scheduler, assistants.encoder)
+
+    def start(max_concurrency=16, max_retries=2, **kwargs):
+        server = start_stub_server(port=0, **kwargs)
+        servers.append(server)
+        assistants.client = assistants.openai.OpenAI(max_retries=0, base_url=server.base_url, api_key="stub")
+        assistants.async_client = assistants.openai.AsyncOpenAI(max_retries=0, base_url=server.base_url, api_key="stub")
+        assistants.configure_scheduler(max_concurrency=max_concurrency, max_retries=max_retries)
+        assistants.configure_encoder()
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    assistants.client, assistants.async_client, assistants.scheduler, assistants.encoder = clients
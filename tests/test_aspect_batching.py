@@ -0,0 +1,19 @@
+# tests/test_aspect_batching.py
+
+import pytest
+from aspect_batching import bucket_shape, AspectRatioBatcher
+
+@pytest.mark.parametrize("imgsz", [420, 512, 500, 640])
+@pytest.mark.parametrize("size", [(1600, 1200), (1200, 1600), (800, 800), (3000, 400), (37, 990)])
+def test_bucket_shapes_are_stride_aligned(imgsz, size):
+    height, width = bucket_shape(*size, imgsz)
+    assert height % 32 == 0 and width % 32 == 0
+    assert max(height, width) == -(-imgsz // 32) * 32
+
+def test_unaligned_imgsz_is_rounded_up():
+    assert bucket_shape(1600, 1200, 420) == (384, 448)
+    assert bucket_shape(1200, 1600, 420) == (448, 384)
+
+def test_similar_aspect_ratios_share_a_bucket():
+    batcher = AspectRatioBatcher(imgsz=420, batch_size=4)
+    assert batcher.shape_for(1600, 1200) == batcher.shape_for(1580, 1190)
@@ -0,0 +1,72 @@
+# tests/test_async_matching.py
+
+import json
+import asyncio
+from PIL import Image
+import stub_openai_server
+import panel_label_matching
+from benchmark_suite import generate_dataset
+from extract_figure_captions import extract_captions
+
+def echo_caption(request):
+    # Answer with the caption as the panel label, so that answers can be told apart
+    caption = request["messages"][1]["content"][0]["text"]
+    return json.dumps({"panel_label": caption, "panel_caption": f"Panel {caption}: Stub description."})
+
+def make_panels(directory, count):
+    panels = []
+    for position in range(count):
+        path = directory / f"figure{position}_A.png"
+        Image.new("RGB", (64, 48), (position * 20 % 256, 80, 160)).save(path)
+        panels.append({
+            "filename": path.name,
+            "figure_id": f"figure{position}",
+            "panel_label": "A",
+            "image_path": str(path),
+            "caption": f"caption-{position}"
+        })
+    return panels
+
+def test_describe_panels_async_keeps_input_order(stub_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(stub_openai_server, "stub_content", echo_caption)
+    # The jitter makes the requests complete out of order
+    stub_server(latency=0.01, jitter=0.05)
+    panels = make_panels(tmp_path, 12)
+    completed = []
+
+    descriptions = asyncio.run(panel_label_matching.describe_panels_async(
+        panels, lambda filename, description: completed.append(filename), concurrency=6))
+
+    assert [json.loads(description)["panel_label"] for description in descriptions] == [panel["caption"] for panel in panels]
+    assert sorted(completed) == sorted(panel["filename"] for panel in panels)
+
+def test_describe_panels_async_respects_concurrency(stub_server, tmp_path):
+    server = stub_server(latency=0.05)
+    panels = make_panels(tmp_path, 16)
+
+    descriptions = asyncio.run(panel_label_matching.describe_panels_async(panels, lambda *args: None, concurrency=3))
+
+    assert all(description is not None for description in descriptions)
+    assert server.request_count == len(panels)
+    assert 2 <= server.max_in_flight <= 3
+
+def test_evaluate_accuracy_serves_from_cache(stub_server, tmp_path):
+    server = stub_server(latency=0.005)
+    paths = generate_dataset(str(tmp_path / "dataset"), figures=4, seed=1)
+    captions_file = str(tmp_path / "figure_captions.jsonl")
+    extract_captions(paths["annotated"], captions_file, workers=1)
+    cache_file = str(tmp_path / "cache.jsonl")
+
+    def run(name):
+        return panel_label_matching.evaluate_accuracy(
+            paths["segmented"], captions_file, paths["figures"], str(tmp_path / "failures"), cache_file,
+            concurrency=4, recognizer=None, label_confidence=None, shard_dir=str(tmp_path / name), force=True
+        )
+
+    cold = run("cold")
+    cold_requests = server.request_count
+    warm = run("warm")
+
+    assert cold_requests == cold["counts"]["panels"] > 0
+    assert server.request_count == cold_requests
+    assert warm["counts"] == cold["counts"]
@@ -0,0 +1,105 @@
+# tests/test_rate_limiter.py
+
+import time
+import asyncio
+import httpx
+import openai
+import pytest
+import assistants
+from rate_limiter import RateLimitScheduler, parse_duration, retry_after, reset_delay
+
+MESSAGES = [{"role": "user", "content": "caption"}]
+
+def rate_limit_error(headers):
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "http://stub/v1/chat/completions"))
+    return openai.RateLimitError("Rate limit reached for requests", response=response, body=None)
+
+def complete(scheduler):
+    return scheduler.call(lambda: assistants.client.chat.completions.with_raw_response.create(model="gpt-4o", messages=MESSAGES))
+
+def test_parse_duration():
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("1.5s") == pytest.approx(1.5)
+    assert parse_duration("6m0s") == pytest.approx(360.0)
+    assert parse_duration("2") == pytest.approx(2.0)
+    assert parse_duration("soon") is None
+    assert parse_duration(None) is None
+
+def test_retry_after_prefers_milliseconds():
+    assert retry_after({"retry-after-ms": "250", "retry-after": "3"}) == pytest.approx(0.25)
+    assert retry_after({"retry-after": "3"}) == pytest.approx(3.0)
+    assert retry_after({}) is None
+
+def test_reset_delay_only_for_exhausted_budgets():
+    headers = {
+        "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-remaining-tokens": "500", "x-ratelimit-reset-tokens": "6m0s"
+    }
+    assert reset_delay(headers) == pytest.approx(1.0)
+    headers["x-ratelimit-remaining-tokens"] = "0"
+    assert reset_delay(headers) == pytest.approx(360.0)
+    assert reset_delay({"x-ratelimit-remaining-requests": "3", "x-ratelimit-reset-requests": "1s"}) is None
+
+def test_429_honours_retry_after_ms_and_halves_concurrency():
+    scheduler = RateLimitScheduler(max_concurrency=8)
+    before = time.monotonic()
+    delay = scheduler._on_error(rate_limit_error({"retry-after-ms": "250"}), attempt=0)
+
+    assert 0.25 <= delay <= 0.25 * 1.25
+    assert scheduler.blocked_until >= before + 0.25
+    assert scheduler.concurrency() == 4
+    assert scheduler.stats["rate_limited"] == 1 and scheduler.stats["retries"] == 1
+    assert scheduler._on_error(rate_limit_error({}), attempt=scheduler.max_retries) is None
+    assert scheduler.stats["failures"] == 1
+
+def test_aimd_concurrency():
+    scheduler = RateLimitScheduler(max_concurrency=8)
+    for expected in (4, 2, 1, 1):
+        scheduler._on_error(rate_limit_error({"retry-after-ms": "1"}), attempt=0)
+        assert scheduler.concurrency() == expected
+    # One more slot per `limit` successes, up to the maximum
+    scheduler._on_success({}, 0, None)
+    assert scheduler.concurrency() == 2
+    for _ in range(100):
+        scheduler._on_success({}, 0, None)
+    assert scheduler.concurrency() == 8
+
+def test_limits_learned_from_headers(stub_server):
+    stub_server(rpm=100, window=60.0)
+    scheduler = assistants.scheduler
+    complete(scheduler)
+
+    assert scheduler.requests.capacity == 100
+    assert scheduler.requests.tokens <= 99
+
+def test_retries_injected_429s(stub_server):
+    server = stub_server(max_concurrency=4, max_retries=50, error_rate=0.5, retry_after=0.005)
+    scheduler = assistants.scheduler
+    for _ in range(20):
+        complete(scheduler)
+
+    assert server.rate_limited_count > 0
+    assert scheduler.stats["rate_limited"] == server.rate_limited_count
+    assert scheduler.stats["retries"] == server.rate_limited_count
+    assert scheduler.stats["failures"] == 0
+    assert scheduler.in_flight == 0
+
+def test_429_without_retry_after_waits_for_the_reset():
+    scheduler = RateLimitScheduler(max_concurrency=2)
+    delay = scheduler._on_error(rate_limit_error({
+        "x-ratelimit-limit-requests": "3", "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "50ms"
+    }), attempt=0)
+
+    assert 0.05 <= delay <= 0.05 * 1.25
+    assert scheduler.requests.capacity == 3
+
+@pytest.mark.parametrize("error", [asyncio.CancelledError, RuntimeError])
+def test_acall_releases_the_slot_on_any_exception(error):
+    scheduler = RateLimitScheduler(max_concurrency=2)
+
+    async def request():
+        raise error()
+
+    with pytest.raises(error):
+        asyncio.run(scheduler.acall(request))
+    assert scheduler.in_flight == 0